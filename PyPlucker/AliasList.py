@@ -11,11 +11,21 @@ Copyright 2000 by Holger Duerer <holly@starship.python.net>
 Distributable under the GNU General Public License Version 2 or newer.
 """
 
+from collections import OrderedDict
+
 from PyPlucker.Url import URL
 
 class AliasList:
 
-    def __init__ (self, aDict=None):
+    """Maintain a mapping from URLs to the URLs they have been moved to.
+
+    Chains of moves are resolved union-find style: every lookup points
+    the URLs it passed on directly at the final URL, so that following
+    a long chain again costs a single step.  URL strings are normalised
+    through a bounded memo, so the same string is not parsed over and
+    over again."""
+
+    def __init__ (self, aDict=None, memo_size=4096):
         """Initialize an empty AliasList.  (Unless the passed
         dictionary already contains state from a previous AliasList
         instance.)"""
@@ -23,6 +33,25 @@ class AliasList:
             self._dict = {}
         else:
             self._dict = aDict
+        # _parent is _dict with chains shortened by earlier lookups
+        self._parent = self._dict.copy ()
+        self._memo = OrderedDict ()
+        self._memo_size = memo_size
+
+
+    def _normalize (self, url):
+        """Return 'url' as a string without fragment"""
+        if type (url) != str:
+            return URL (url).as_string (with_fragment=0)
+        result = self._memo.get (url)
+        if result is None:
+            result = URL (url).as_string (with_fragment=0)
+            self._memo[url] = result
+            if len (self._memo) > self._memo_size:
+                self._memo.popitem (last=False)
+        else:
+            self._memo.move_to_end (url)
+        return result
 
 
     def as_dict(self):
@@ -30,19 +59,36 @@ class AliasList:
 
 
     def add (self, old_url, new_url):
-        old_url = URL (old_url).as_string (with_fragment=0)
-        new_url = URL (new_url).as_string (with_fragment=0)
+        old_url = self._normalize (old_url)
+        new_url = self._normalize (new_url)
 
         if old_url != new_url:
-            self._dict[old_url] = new_url
+            if old_url in self._dict and self._dict[old_url] != new_url:
+                # An existing alias is redirected, shortcuts taken
+                # through it are no longer valid
+                self._dict[old_url] = new_url
+                self._parent = self._dict.copy ()
+            else:
+                self._dict[old_url] = new_url
+                self._parent[old_url] = new_url
 
 
     def get (self, url):
-        url = URL (url).as_string (with_fragment=0)
-        while 1:
-            if url not in self._dict:
-                return url
-            url = self._dict[url]
+        url = self._normalize (url)
+        parent = self._parent
+        if url not in parent:
+            return url
+        path = []
+        seen = {}
+        while url in parent and url not in seen:
+            path.append (url)
+            seen[url] = 1
+            url = parent[url]
+        # path compression: point everything passed at the result
+        for item in path:
+            if item != url:
+                parent[item] = url
+        return url
 
 
     def __repr__ (self):
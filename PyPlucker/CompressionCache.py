@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+CompressionCache.py
+
+An on-disk cache of compressed record bodies.
+
+Most records of a regularly repeated build (a nightly channel, say)
+are byte for byte the same as last time.  The cache maps a hash of an
+uncompressed record body and of the compression settings (method,
+level, owner-id key) to the compressed bytes, so that those records
+need not be compressed again.
+
+Every entry is a file named by its hash, written atomically, so
+several processes (see Writer --writer-jobs) can share a cache.  A hit
+touches the file; when the cache has grown beyond its size, evict()
+removes the least recently used entries.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import os, hashlib
+
+from PyPlucker.UtilFns import message
+
+
+class CompressionCache:
+
+    """A cache of compressed data in 'directory', holding at most
+    'max_size' bytes after evict().  Bodies smaller than MIN_SIZE
+    bytes are cheaper to compress than to look up and are not
+    cached."""
+
+    MIN_SIZE = 512
+
+    def __init__ (self, directory, max_size=64 * 1024 * 1024):
+        self._directory = directory
+        self._max_size = max_size
+        if not os.path.isdir (directory):
+            os.makedirs (directory)
+
+
+    def key (self, data, mode):
+        """The key of 'data' compressed with 'mode', a string naming
+        the compression settings"""
+        digest = hashlib.blake2b (mode.encode ('utf-8'), digest_size=20)
+        digest.update (b"\0")
+        digest.update (data)
+        return digest.hexdigest ()
+
+
+    def _filename (self, key):
+        # 256 subdirectories keep the directories small
+        return os.path.join (self._directory, key[:2], key[2:])
+
+
+    def get (self, key):
+        """Return the compressed data stored under 'key', or None"""
+        filename = self._filename (key)
+        try:
+            f = open (filename, 'rb')
+        except OSError:
+            return None
+        try:
+            data = f.read ()
+        finally:
+            f.close ()
+        try:
+            # mark it as recently used for evict()
+            os.utime (filename)
+        except OSError:
+            pass
+        return data
+
+
+    def put (self, key, data):
+        """Store the compressed 'data' under 'key'"""
+        filename = self._filename (key)
+        tmpname = "%s.%d.tmp" % (filename, os.getpid ())
+        try:
+            if not os.path.isdir (os.path.dirname (filename)):
+                os.makedirs (os.path.dirname (filename), exist_ok=True)
+            f = open (tmpname, 'wb')
+            try:
+                f.write (data)
+            finally:
+                f.close ()
+            os.replace (tmpname, filename)
+        except OSError as text:
+            # a full disk should not break the build, only slow it down
+            message(2, "Cannot write compression cache entry %s: %s" % (filename, text))
+            try:
+                os.unlink (tmpname)
+            except OSError:
+                pass
+
+
+    def evict (self):
+        """Remove the least recently used entries until the cache holds
+        at most max_size bytes.  Returns the number of entries removed."""
+        entries = []
+        total = 0
+        for subdir in os.listdir (self._directory):
+            path = os.path.join (self._directory, subdir)
+            if not os.path.isdir (path):
+                continue
+            for name in os.listdir (path):
+                filename = os.path.join (path, name)
+                try:
+                    st = os.stat (filename)
+                except OSError:
+                    continue
+                entries.append ((st.st_mtime, st.st_size, filename))
+                total = total + st.st_size
+        removed = 0
+        if total > self._max_size:
+            entries.sort ()
+            for (mtime, size, filename) in entries:
+                if total <= self._max_size:
+                    break
+                try:
+                    os.unlink (filename)
+                except OSError:
+                    continue
+                total = total - size
+                removed = removed + 1
+            message(2, "Removed %d entries from the compression cache, %d bytes left" % (removed, total))
+        return removed
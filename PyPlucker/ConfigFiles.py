@@ -43,12 +43,43 @@ class _ConfigGetter:
         return int (self.get_string (option))
 
 
+    def get_options (self):
+        """Return the names of all options in this section"""
+        try:
+            return self._config.options (self._section)
+        except:
+            return []
+
+
+
 
 
+# Options which are checked to be valid numbers and booleans when the
+# configuration is frozen
+_INT_OPTIONS = ('verbosity', 'bpp', 'home_maxdepth', 'maxwidth', 'maxheight',
+                'image_compression_limit', 'retrieval_timeout',
+                'status_line_length', 'seen_capacity', 'memprofile_top',
+                'memprofile_frames', 'writer_jobs',
+                'compression_cache_size', 'compression_predictor_threshold')
+_BOOL_OPTIONS = ('use_cache', 'zlib_compression', 'depth_first', 'ignore_robots',
+                 'home_stayonhost', 'home_stayondomain', 'seamless_fragments',
+                 'link_fragments', 'tables', 'no_urlinfo', 'no_image_alt',
+                 'launchable_bit', 'backup_bit', 'copyprevention_bit', 'icon',
+                 'try_reduce_bpp', 'try_reduce_dimension', 'auto_scale_images',
+                 'indent_paragraphs', 'color_paragraphs', 'memprofile',
+                 'doc_lazy_matching', 'compression_predictor',
+                 'sort_urls')
+
 
 class Configuration:
     """A Class to maintain information about all possivble user
-    settable options from various .ini config files."""
+    settable options from various .ini config files.
+
+    Once all options are known, call freeze().  This resolves the
+    values from all config files into one dictionary, checks the
+    options in _INT_OPTIONS and _BOOL_OPTIONS, and from then on the
+    typed results of get_string/get_int/get_bool are cached.  Values
+    given with set() still override the files and clear the cache."""
 
     def __init__ (self, pluckerhome, pluckerdir, extra_sections=[], error_logger=None):
         """Load .ini files from all possible places and present one
@@ -63,6 +94,8 @@ class Configuration:
             self._sections = ['POSIX']
         self._sections = self._sections + extra_sections
         self._dict = {}
+        self._resolved = None
+        self._cache = {}
 
         self.maybe_load_config (SYS_CONFIG_FILE, error_logger)
         self.maybe_load_config (USER_CONFIG_FILE, error_logger)
@@ -102,9 +135,48 @@ class Configuration:
             self._configs.reverse ()
 
 
+    def freeze (self):
+        """Resolve all options from the config files into one
+        dictionary and validate them.  Raises a ValueError for an
+        invalid value.  Calling it again does nothing."""
+        if self._resolved is not None:
+            return
+        options = {}
+        for getter in self._configs:
+            for option in getter.get_options ():
+                options[option] = 1
+        resolved = {}
+        for option in options.keys ():
+            # same rule as for the unfrozen lookup below: first
+            # non-empty value wins
+            result = None
+            for getter in self._configs:
+                result = result or getter.get_string (option)
+            resolved[option] = result
+        self._resolved = resolved
+        self._cache = {}
+
+        for option in _INT_OPTIONS:
+            value = self._get_string (option)
+            if value is not None:
+                try:
+                    int (value)
+                except ValueError:
+                    raise ValueError ("Illegal non-integer value %s found for option '%s'" % (repr (value), option))
+        for option in _BOOL_OPTIONS:
+            if self._get_string (option) is not None:
+                try:
+                    self.get_bool (option)
+                except RuntimeError as text:
+                    raise ValueError (str (text))
+
+
     def _get_string (self, option):
         if option in self._dict:
             return self._dict[option]
+        if self._resolved is not None:
+            # config parser options are always lower case
+            return self._resolved.get (option.lower ())
         aList = list(map (lambda x, o=option: x.get_string (o), self._configs))
         result = reduce (lambda a, b: a or b, aList, None)
         return result
@@ -114,28 +186,49 @@ class Configuration:
     ## re-written so that they never return None. -- wcj
 
     def get_string (self, option, default=None):
+        key = ('s', option, default)
+        if key in self._cache:
+            return self._cache[key]
         if not (default is None):
             assert (type(default) == str)
         result = self._get_string(option)
         if result is None:
-            return default
-        else:
-            return result
+            result = default
+        if self._resolved is not None:
+            self._cache[key] = result
+        return result
 
 
     def get_int (self, option, default=None):
+        key = ('i', option, default)
+        if key in self._cache:
+            return self._cache[key]
         if not (default is None):
             assert (type(default) == int or type(default) == int)
         if option in self._dict:
-            return int (self._dict[option])
-        result = self._get_string (option)
-        if result is None:
-            return int (default)
+            result = int (self._dict[option])
         else:
-            return int (result)
+            result = self._get_string (option)
+            if result is None:
+                result = int (default)
+            else:
+                result = int (result)
+        if self._resolved is not None:
+            self._cache[key] = result
+        return result
 
 
     def get_bool (self, option, default=None):
+        key = ('b', option, default)
+        if key in self._cache:
+            return self._cache[key]
+        result = self._get_bool (option, default)
+        if self._resolved is not None:
+            self._cache[key] = result
+        return result
+
+
+    def _get_bool (self, option, default):
         res = self._get_string (option)
         if res is None:
             if default is None:
@@ -154,4 +247,5 @@ class Configuration:
 
     def set (self, option, value):
         self._dict[option] = value
+        self._cache = {}
 
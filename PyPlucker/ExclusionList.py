@@ -12,10 +12,74 @@ Distributable under the GNU General Public License Version 2 or newer.
 
 """
 
-import re, string, sys
+import re, string, sys, heapq
+from collections import OrderedDict
 from PyPlucker.UtilFns import error, message
 
 
+# Characters which end the literal prefix of a regexp
+_REGEXP_SPECIALS = ".^$*+?{}[]()"
+
+
+def _literal_prefix (regexp):
+    """Return the literal string every match of 'regexp' (with
+    re.match) has to start with.  This is conservative: it may return
+    a shorter prefix than possible (e.g. '' for anything using '|')."""
+    if '|' in regexp:
+        return ""
+    prefix = []
+    i = 0
+    while i < len (regexp):
+        c = regexp[i]
+        if c == '\\':
+            if i + 1 >= len (regexp) or regexp[i+1].isalnum ():
+                # a class like \d or a back reference
+                break
+            literal = regexp[i+1]
+            next_i = i + 2
+        elif c in _REGEXP_SPECIALS:
+            break
+        else:
+            literal = c
+            next_i = i + 1
+        quantifier = regexp[next_i:next_i+1]
+        if quantifier and quantifier in "*?{":
+            # the literal might not be there at all
+            break
+        prefix.append (literal)
+        if quantifier == '+':
+            break
+        i = next_i
+    return "".join (prefix)
+
+
+def _host_key (text):
+    """Return 'protocol://host/' at the start of 'text' or None if
+    'text' doesn't start with a complete one."""
+    i = text.find ("://")
+    if i < 0:
+        return None
+    j = text.find ("/", i + 3)
+    if j < 0:
+        return None
+    return text[:j+1]
+
+
+class _Rule:
+    """One entry of an ExclusionList."""
+
+    __slots__ = ('rank', 'prio', 'action', 'regexp', 'pattern', 'prefix', 'hits')
+
+    def __init__ (self, rank, prio, action, regexp, pattern):
+        self.rank = rank
+        self.prio = prio
+        self.action = action
+        self.regexp = regexp
+        self.pattern = pattern
+        self.prefix = _literal_prefix (regexp)
+        self.hits = 0
+
+
 class ExclusionList:
 
     """A class to maintain information about what URLs to exclude from
@@ -35,11 +99,66 @@ class ExclusionList:
          - prio is an integer
          - action is either a plus or a minus ('+' or '-')
          - regexp is a valid regular expression
+
+    Regexps are compiled when they are added.  Rules whose regexp
+    starts with a literal 'protocol://host/' are only tried for URLs
+    on that host, and the results of the last 'cache_size' checks are
+    remembered.  The number of checks decided by each rule is counted,
+    see get_statistics().
     """
 
-    def __init__ (self, include_by_default=1):
+    def __init__ (self, include_by_default=1, cache_size=10000):
         self._items = {}
         self._default_action = include_by_default
+        self._default_hits = 0
+        self._count = 0
+        self._host_rules = {}
+        self._other_rules = []
+        self._rules_dirty = 0
+        self._cache = OrderedDict ()
+        self._cache_size = cache_size
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+
+    def _add_item (self, prio, action, regexp):
+        try:
+            pattern = re.compile (regexp)
+        except re.error:
+            message(2, "Invalid exclusion regexp: %s" % str(regexp))
+            return
+        self._count = self._count + 1
+        new_item = _Rule (self._count, prio, action, regexp, pattern)
+        if prio in self._items:
+            self._items[prio].append (new_item)
+        else:
+            self._items[prio] = [new_item]
+        self._rules_dirty = 1
+        self._cache.clear ()
+
+
+    def _prepare_rules (self):
+        """Rebuild the host buckets, in order of decreasing priority"""
+        prios = list(self._items.keys ())
+        prios.sort ()
+        prios.reverse ()
+        host_rules = {}
+        other_rules = []
+        rank = 0
+        for prio in prios:
+            for rule in self._items[prio]:
+                rule.rank = rank
+                rank = rank + 1
+                key = _host_key (rule.prefix)
+                if key is None:
+                    other_rules.append (rule)
+                elif key in host_rules:
+                    host_rules[key].append (rule)
+                else:
+                    host_rules[key] = [rule]
+        self._host_rules = host_rules
+        self._other_rules = other_rules
+        self._rules_dirty = 0
 
 
     def load_file (self, filename):
@@ -63,42 +182,71 @@ class ExclusionList:
                 prio = int (m.group (1))
                 action = m.group (2) == '+'
                 regexp = m.group (3)
-                new_item = (action, regexp)
-                if prio in self._items:
-                    self._items[prio].append (new_item)
-                else:
-                    self._items[prio] = [new_item]
+                self._add_item (prio, action, regexp)
+        f.close ()
 
 
     def add_entry (self, entry):
         """Add an explict entry"""
         m = re.match (r"([-+]?\d+):([-+]):(.*)", entry)
         if not m:
-            error ("ExclusionList: Cannot parse line: %s\n" % orig_line)
+            error ("ExclusionList: Cannot parse line: %s\n" % entry)
         else:
             prio = int (m.group (1))
             action = m.group (2) == '+'
             regexp = m.group (3)
-            new_item = (action, regexp)
-            if prio in self._items:
-                self._items[prio].append (new_item)
-            else:
-                self._items[prio] = [new_item]
+            self._add_item (prio, action, regexp)
 
 
     def check (self, url):
         """Check if 'url' is to be included (result=1) or excluded
         (result=0)."""
 
-        prios = list(self._items.keys ())
-        prios.sort ()
-        prios.reverse ()
+        cached = self._cache.get (url)
+        if cached is not None:
+            self._cache.move_to_end (url)
+            self._cache_hits = self._cache_hits + 1
+            (action, rule) = cached
+            if rule is None:
+                self._default_hits = self._default_hits + 1
+            else:
+                rule.hits = rule.hits + 1
+            return action
+        self._cache_misses = self._cache_misses + 1
+
+        if self._rules_dirty:
+            self._prepare_rules ()
+        host_rules = self._host_rules.get (_host_key (url))
+        if host_rules:
+            candidates = heapq.merge (host_rules, self._other_rules, key=lambda rule: rule.rank)
+        else:
+            candidates = self._other_rules
 
-        for prio in prios:
-            for action, regexp in self._items[prio]:
-                try:
-                    if re.match (regexp, url):
-                        return action
-                except:
-                    message(2, "Invalid exclusion regexp: %s" % str(regexp))
-        return self._default_action
+        result = (self._default_action, None)
+        for rule in candidates:
+            if url.startswith (rule.prefix) and rule.pattern.match (url):
+                result = (rule.action, rule)
+                break
+
+        (action, rule) = result
+        if rule is None:
+            self._default_hits = self._default_hits + 1
+        else:
+            rule.hits = rule.hits + 1
+        if self._cache_size:
+            self._cache[url] = result
+            if len (self._cache) > self._cache_size:
+                self._cache.popitem (last=False)
+        return action
+
+
+    def get_statistics (self):
+        """Return a tuple (rule_hits, default_hits, cache_hits,
+        cache_misses).  'rule_hits' is a list of (hits, prio, action,
+        regexp) tuples, one per rule, with the busiest rule first."""
+        rule_hits = []
+        for prio in list(self._items.keys ()):
+            for rule in self._items[prio]:
+                rule_hits.append ((rule.hits, prio, rule.action, rule.regexp))
+        rule_hits.sort (key=lambda item: -item[0])
+        return (rule_hits, self._default_hits, self._cache_hits, self._cache_misses)
@@ -17,7 +17,7 @@ Distributable under the GNU General Public License Version 2 or newer.
 """
 
 import os, sys, string, tempfile, re, io, operator, subprocess
-from PyPlucker import PluckerDocs, DEFAULT_IMAGE_PARSER_SETTING
+from PyPlucker import PluckerDocs, Profiling, DEFAULT_IMAGE_PARSER_SETTING
 from PyPlucker.UtilFns import message, error
 
 
@@ -205,6 +205,12 @@ class ImageParser:
         the original image along the way, if necessary.  It should normally never be necessary
         to override this method."""
 
+        with Profiling.stage (Profiling.STAGE_IMAGE_CONVERT, self._type, self._url):
+            return self._get_plucker_doc ()
+
+
+    def _get_plucker_doc(self):
+
         (width, height, depth, section), limits, scaling_factor = self.calculate_desired_size()
         message(2, "Converting image %s with %s" % (self._url, str(self.__class__)))
         newbits = self.convert(width, height, depth, section)
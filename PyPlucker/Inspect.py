@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+Inspect.py
+
+Summarize and check Plucker databases.
+
+For every PDB file named on the command line this prints how many
+records of each type there are, their size, and how well they
+compressed.  The sizes come from the record headers (the header of a
+compressed record holds its uncompressed size), and the file is read
+through prc.MappedFile, so nothing is uncompressed and records are
+not even read unless asked for:
+
+    -c, --check       uncompress every compressed record and compare
+                      its size with the header
+    -l, --links       list the URL of every record from the link table
+    --owner-id=<name> the owner-id the database was built with, needed
+                      to --check zlib records of a protected database
+    --json=<file>     also write the results to <file>
+
+The exit status is 1 if any file could not be read or failed a check,
+so that it can validate the output of nightly builds.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, os, getopt, json, struct, zlib
+
+from PyPlucker import PluckerDocs
+from PyPlucker.helper import prc
+
+
+# record type (the high byte of the DOCTYPE_* constants) -> (name, compressed)
+RECORD_TYPES = {
+    PluckerDocs.DOCTYPE_HTML >> 8: ('text', 0),
+    PluckerDocs.DOCTYPE_HTML_COMPRESSED >> 8: ('text', 1),
+    PluckerDocs.DOCTYPE_IMAGE >> 8: ('image', 0),
+    PluckerDocs.DOCTYPE_IMAGE_COMPRESSED >> 8: ('image', 1),
+    PluckerDocs.DOCTYPE_MAILTO >> 8: ('mailto', 0),
+    PluckerDocs.DOCTYPE_LINK_INDEX >> 8: ('link index', 0),
+    PluckerDocs.DOCTYPE_LINKS >> 8: ('links', 0),
+    PluckerDocs.DOCTYPE_LINKS_COMPRESSED >> 8: ('links', 1),
+    PluckerDocs.DOCTYPE_BOOKMARKS >> 8: ('bookmarks', 0),
+    PluckerDocs.DOCTYPE_CATEGORY >> 8: ('category', 0),
+    PluckerDocs.DOCTYPE_METADATA >> 8: ('metadata', 0),
+    PluckerDocs.DOCTYPE_STYLE_SHEET >> 8: ('style sheet', 0),
+    PluckerDocs.DOCTYPE_FONT_PAGE >> 8: ('font page', 0),
+    PluckerDocs.DOCTYPE_TABLE >> 8: ('table', 0),
+    PluckerDocs.DOCTYPE_TABLE_COMPRESSED >> 8: ('table', 1),
+    PluckerDocs.DOCTYPE_MULTIIMAGE >> 8: ('multiimage', 0),
+    }
+
+COMPRESSION_NAMES = {PluckerDocs.DBTYPE_DOC: 'DOC', PluckerDocs.DBTYPE_ZLIB: 'zlib'}
+
+
+class Inspector:
+
+    """The summary of one database, see inspect()"""
+
+    def __init__ (self, pdb, owner_id=None):
+        self._pdb = pdb
+        self._owner_id = owner_id
+        self.compression = None
+        self.reserved = {}
+        self.owner_id_crc = None
+        self.types = {}
+        self.problems = []
+
+
+    def _record (self, id):
+        """The record with 'id' as a memoryview, or None"""
+        record = self._pdb.getRecordByID (id)
+        return record and record[0]
+
+
+    def _body (self, record):
+        """(type name, compressed, uncompressed size, body) of a record,
+        or None"""
+        if len (record) < 8:
+            return None
+        (uid, paragraphs, size, type, flags) = struct.unpack_from (">HHHBB", record)
+        (name, compressed) = RECORD_TYPES.get (type, ("type %d" % type, 0))
+        header_size = 8 + 4 * paragraphs
+        return (name, compressed, size, record[header_size:])
+
+
+    def read_index (self):
+        """Read the index record (id 1): the compression method and the
+        reserved records"""
+        record = self._record (1)
+        if record is None or len (record) < 6:
+            self.problems.append ("no index record")
+            return
+        (uid, compression, count) = struct.unpack_from (">HHH", record)
+        self.compression = COMPRESSION_NAMES.get (compression, "unknown (%d)" % compression)
+        if len (record) < 6 + 4 * count:
+            self.problems.append ("index record too short")
+            return
+        for (name, id) in struct.iter_unpack (">HH", record[6:6 + 4 * count]):
+            self.reserved[name] = id
+
+
+    def read_metadata (self):
+        """Find the owner-id CRC in the metadata record, if any"""
+        id = self.reserved.get (PluckerDocs.PluckerIndexDocument.RSVD_REC_NAME_METADATA)
+        record = id and self._record (id)
+        if not record or len (record) < 10:
+            return
+        (count,) = struct.unpack_from (">H", record, 8)
+        pos = 10
+        for i in range (count):
+            if pos + 4 > len (record):
+                self.problems.append ("metadata record too short")
+                return
+            (typecode, nwords) = struct.unpack_from (">HH", record, pos)
+            if typecode == PluckerDocs.PluckerMetadataDocument.TYPECODE_OWNER_ID and nwords == 2:
+                (self.owner_id_crc,) = struct.unpack_from (">L", record, pos + 4)
+            pos = pos + 4 + 2 * nwords
+
+
+    def summarize (self):
+        """Count the records and bytes of every type from the headers"""
+        for i in range (self._pdb.getRecords ()):
+            (record, index, id, attr, category) = self._pdb.getRecord (i)
+            if id == 1:
+                (name, compressed, size, body) = ('index', 0, len (record), record)
+            else:
+                parsed = self._body (record)
+                if parsed is None:
+                    self.problems.append ("record %d is too short (%d bytes)" % (id, len (record)))
+                    continue
+                (name, compressed, size, body) = parsed
+                if struct.unpack_from (">H", record)[0] != id:
+                    self.problems.append ("record %d has uid %d" % (id, struct.unpack_from (">H", record)[0]))
+            stats = self.types.setdefault (name, {'records': 0, 'compressed': 0, 'bytes': 0,
+                                                  'body_bytes': 0, 'uncompressed_bytes': 0})
+            stats['records'] = stats['records'] + 1
+            stats['bytes'] = stats['bytes'] + len (record)
+            stats['body_bytes'] = stats['body_bytes'] + len (body)
+            if compressed:
+                stats['compressed'] = stats['compressed'] + 1
+                stats['uncompressed_bytes'] = stats['uncompressed_bytes'] + size
+            else:
+                stats['uncompressed_bytes'] = stats['uncompressed_bytes'] + len (body)
+
+
+    def _uncompress (self, body):
+        if self.compression == 'DOC':
+            return PluckerDocs.DocUncompressData (bytes (body))
+        key = None
+        if self.owner_id_crc is not None:
+            if self._owner_id is None:
+                raise ValueError ("protected by an owner-id")
+            key = PluckerDocs.OwnerIdKey (self._owner_id)
+        return PluckerDocs.ZLibUncompressData (bytes (body), key)
+
+
+    def check (self):
+        """Uncompress every compressed record and compare its size
+        with the header"""
+        if self.compression not in ('DOC', 'zlib'):
+            return
+        if self.compression == 'zlib' and self.owner_id_crc is not None:
+            if self._owner_id is None:
+                self.problems.append ("protected by an owner-id, use --owner-id to check it")
+                return
+            if zlib.crc32 (PluckerDocs._owner_id_bytes (self._owner_id)) != self.owner_id_crc:
+                self.problems.append ("built for another owner-id")
+                return
+        for i in range (self._pdb.getRecords ()):
+            (record, index, id, attr, category) = self._pdb.getRecord (i)
+            parsed = id != 1 and self._body (record)
+            if not parsed or not parsed[1]:
+                continue
+            (name, compressed, size, body) = parsed
+            try:
+                data = self._uncompress (body)
+            except Exception as text:
+                self.problems.append ("record %d (%s) does not uncompress: %s" % (id, name, text))
+                continue
+            if len (data) != size:
+                self.problems.append ("record %d (%s) uncompresses to %d bytes instead of %d"
+                                      % (id, name, len (data), size))
+
+
+    def links (self):
+        """The link table as a list of (record id, URL)"""
+        result = []
+        id = self.reserved.get (PluckerDocs.PluckerIndexDocument.RSVD_REC_NAME_URLS)
+        record = id and self._record (id)
+        if not record:
+            return result
+        first = 1
+        for (last, links_id) in struct.iter_unpack (">HH", record[8:8 + (len (record) - 8) // 4 * 4]):
+            parsed = self._record (links_id)
+            parsed = parsed and self._body (parsed)
+            if not parsed:
+                self.problems.append ("links record %d is missing" % links_id)
+                continue
+            (name, compressed, size, body) = parsed
+            try:
+                if compressed:
+                    body = self._uncompress (body)
+            except Exception as text:
+                self.problems.append ("links record %d does not uncompress: %s" % (links_id, text))
+                continue
+            urls = bytes (body).split (b'\0')
+            for n in range (first, last + 1):
+                if n - first < len (urls) and urls[n - first]:
+                    result.append ((n, urls[n - first].decode ('latin-1')))
+            first = last + 1
+        return result
+
+
+def inspect (filename, check=0, links=0, owner_id=None):
+    """Inspect the PDB file 'filename'.  Returns a dictionary of the
+    results, with a list of 'problems'."""
+    result = {'file': filename, 'problems': []}
+    try:
+        pdb = prc.MappedFile (filename)
+    except (IOError, ValueError, struct.error) as text:
+        result['problems'].append ("cannot read database: %s" % text)
+        return result
+    try:
+        info = pdb.getDBInfo ()
+        result['name'] = info['name']
+        result['creator'] = info['creator']
+        result['type'] = info['type']
+        result['version'] = info['version']
+        result['records'] = pdb.getRecords ()
+        result['bytes'] = pdb.size
+        inspector = Inspector (pdb, owner_id)
+        inspector.read_index ()
+        inspector.read_metadata ()
+        inspector.summarize ()
+        if check:
+            inspector.check ()
+        if links:
+            result['links'] = inspector.links ()
+        result['compression'] = inspector.compression
+        result['owner_id'] = inspector.owner_id_crc is not None
+        result['types'] = inspector.types
+        result['problems'] = inspector.problems
+    finally:
+        pdb.close ()
+    return result
+
+
+def print_result (result):
+    if 'types' not in result:
+        print ("%s: %s" % (result['file'], "; ".join (result['problems'])))
+        return
+    print ("%s: \"%s\" %s/%s version %d, %d records, %d bytes, %s compression%s"
+           % (result['file'], result['name'], result['creator'], result['type'], result['version'],
+              result['records'], result['bytes'], result['compression'],
+              (result['owner_id'] and ", owner-id") or ""))
+    print ("  %-12s %7s %10s %10s %10s %12s %6s"
+           % ("type", "records", "compressed", "bytes", "body", "uncompressed", "ratio"))
+    for name in sorted (result['types'].keys ()):
+        stats = result['types'][name]
+        if stats['compressed'] and stats['uncompressed_bytes']:
+            ratio = "%5.1f%%" % (100.0 * stats['body_bytes'] / stats['uncompressed_bytes'])
+        else:
+            ratio = ""
+        print ("  %-12s %7d %10d %10d %10d %12d %6s"
+               % (name, stats['records'], stats['compressed'], stats['bytes'],
+                  stats['body_bytes'], stats['uncompressed_bytes'], ratio))
+    for (id, url) in result.get ('links', []):
+        print ("  link %5d %s" % (id, url))
+    for problem in result['problems']:
+        print ("  problem: %s" % problem)
+
+
+def usage (reason=None):
+    if reason is not None:
+        sys.stderr.write ("%s\n" % reason)
+    sys.stderr.write ("Usage: %s [-h] [-c] [-l] [--owner-id=<name>] [--json=<file>] <pdbfile>...\n"
+                      % os.path.basename (sys.argv[0]))
+    sys.exit ((reason is not None and 1) or 0)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "hcl", ["help", "check", "links", "owner-id=", "json="])
+    except getopt.error as text:
+        usage (text)
+    check = 0
+    links = 0
+    owner_id = None
+    json_file = None
+    for (opt, arg) in opts:
+        if opt in ("-h", "--help"):
+            usage ()
+        elif opt in ("-c", "--check"):
+            check = 1
+        elif opt in ("-l", "--links"):
+            links = 1
+        elif opt == "--owner-id":
+            owner_id = arg
+        elif opt == "--json":
+            json_file = arg
+    if not args:
+        usage ("No database given")
+
+    results = []
+    failed = 0
+    for filename in args:
+        result = inspect (filename, check, links, owner_id)
+        print_result (result)
+        results.append (result)
+        if result['problems']:
+            failed = 1
+    if json_file:
+        f = open (json_file, 'w')
+        json.dump (results, f, indent=1, sort_keys=True)
+        f.close ()
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Metrics.py
+
+Machine-readable numbers about a build.
+
+While a build runs, the spider, retriever and writers count what they
+do here (pages and images fetched, bytes, cache hits, compression per
+record type, records written).  At the end write_metrics() saves these
+together with the stage times from Profiling as a JSON document and,
+if asked for, in the text format of the Prometheus node exporter's
+textfile collector.
+
+Nothing is counted unless enable_metrics() has been called.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import os, time, json
+
+from PyPlucker import Profiling
+from PyPlucker.UtilFns import message
+
+
+_enabled = 0
+
+# counter name -> number
+_counters = {}
+
+# record type -> [records, bytes before, bytes after compression]
+_compression = {}
+
+# gauge name -> number, for values known only at the end
+_values = {}
+
+_start_time = 0
+
+
+def enable_metrics (on=1):
+    """Start counting (or stop).  Stage times are needed for the
+    metrics, so they are switched on as well."""
+    global _enabled, _start_time
+    _enabled = on
+    if on:
+        _start_time = time.time ()
+        Profiling.enable_stages ()
+
+
+def metrics_enabled ():
+    return _enabled
+
+
+def count (name, n=1):
+    """Add 'n' to counter 'name'"""
+    if _enabled:
+        _counters[name] = _counters.get (name, 0) + n
+
+
+def set_value (name, value):
+    """Set the gauge 'name' to 'value'"""
+    if _enabled:
+        _values[name] = value
+
+
+def count_fetch (content_type, size):
+    """Count a successfully retrieved document of 'size' bytes"""
+    if not _enabled:
+        return
+    if content_type and str (content_type)[:6] == 'image/':
+        count ('images_fetched')
+    else:
+        count ('pages_fetched')
+    count ('bytes_in', size)
+
+
+def count_compression (record_type, size_in, size_out):
+    """Count a record of 'record_type' compressed from 'size_in' to
+    'size_out' bytes"""
+    if not _enabled:
+        return
+    entry = _compression.get (record_type)
+    if entry is None:
+        entry = _compression[record_type] = [0, 0, 0]
+    entry[0] = entry[0] + 1
+    entry[1] = entry[1] + size_in
+    entry[2] = entry[2] + size_out
+
+
+def take_counts ():
+    """Return the counters and compression numbers counted so far and
+    reset them.  Worker processes use this to hand them to the parent
+    process, which adds them with merge_counts()."""
+    result = (dict (_counters), dict (_compression))
+    _counters.clear ()
+    _compression.clear ()
+    return result
+
+
+def merge_counts (taken):
+    """Add counters and compression numbers returned by take_counts()"""
+    if not _enabled:
+        return
+    (counters, compression) = taken
+    for (name, n) in counters.items ():
+        count (name, n)
+    for (record_type, (records, size_in, size_out)) in compression.items ():
+        entry = _compression.get (record_type)
+        if entry is None:
+            entry = _compression[record_type] = [0, 0, 0]
+        entry[0] = entry[0] + records
+        entry[1] = entry[1] + size_in
+        entry[2] = entry[2] + size_out
+
+
+def _ratio (part, total):
+    if not total:
+        return None
+    return round (float (part) / total, 4)
+
+
+def get_metrics ():
+    """Return all metrics as a dictionary, as written to the JSON file"""
+    result = {'timestamp': int (time.time ()),
+              'wall_seconds': round (time.time () - _start_time, 3),
+              'counters': dict (_counters),
+              'values': dict (_values)}
+
+    caches = {}
+    for (name, hits, misses) in (('retriever', 'retriever_cache_hits', 'retriever_cache_misses'),
+                                 ('exclusion_list', 'exclusion_cache_hits', 'exclusion_cache_misses'),
+                                 ('compression', 'compression_cache_hits', 'compression_cache_misses')):
+        hits = _counters.get (hits, 0)
+        misses = _counters.get (misses, 0)
+        caches[name] = {'hits': hits, 'misses': misses, 'hit_ratio': _ratio (hits, hits + misses)}
+    from PyPlucker import Url
+    info = Url._parse_url.cache_info ()
+    caches['url_parse'] = {'hits': info.hits, 'misses': info.misses,
+                           'hit_ratio': _ratio (info.hits, info.hits + info.misses)}
+    result['caches'] = caches
+
+    hits = _counters.get ('predictor_hits', 0)
+    misses = _counters.get ('predictor_misses', 0)
+    result['predictor'] = {'predicted_futile': _counters.get ('predicted_futile', 0),
+                           'predicted_useful': _counters.get ('predicted_useful', 0),
+                           'hits': hits, 'misses': misses, 'hit_ratio': _ratio (hits, hits + misses)}
+
+    stages = {}
+    for ((name, content_type), (calls, total, own)) in Profiling.get_stage_times ().items ():
+        entry = stages.setdefault (name, {'calls': 0, 'seconds': 0.0, 'own_seconds': 0.0})
+        entry['calls'] = entry['calls'] + calls
+        entry['seconds'] = round (entry['seconds'] + total, 6)
+        entry['own_seconds'] = round (entry['own_seconds'] + own, 6)
+    result['stages'] = stages
+
+    compression = {}
+    for (record_type, (records, size_in, size_out)) in _compression.items ():
+        compression[record_type] = {'records': records,
+                                    'bytes_in': size_in,
+                                    'bytes_out': size_out,
+                                    'ratio': _ratio (size_out, size_in)}
+    result['compression'] = compression
+    return result
+
+
+def _write_atomically (filename, text):
+    # readers (e.g. the textfile collector) must never see a half
+    # written file
+    tmpname = "%s.%d.tmp" % (filename, os.getpid ())
+    f = open (tmpname, 'w')
+    try:
+        f.write (text)
+    finally:
+        f.close ()
+    os.replace (tmpname, filename)
+
+
+def _prometheus_text (metrics, labels):
+    label_text = ",".join (['%s="%s"' % (name, str (value).replace ('\\', '\\\\').replace ('"', '\\"'))
+                            for (name, value) in sorted (labels.items ())])
+
+    lines = []
+    def emit (name, kind, help, samples):
+        lines.append ("# HELP plucker_%s %s" % (name, help))
+        lines.append ("# TYPE plucker_%s %s" % (name, kind))
+        for (extra, value) in samples:
+            all_labels = ",".join ([x for x in (label_text, extra) if x])
+            lines.append ("plucker_%s{%s} %s" % (name, all_labels, repr (value)))
+
+    counters = metrics['counters']
+    for (name, help) in (('pages_fetched', "Pages retrieved"),
+                         ('images_fetched', "Images retrieved"),
+                         ('fetch_failures', "Documents that could not be retrieved or parsed"),
+                         ('bytes_in', "Bytes retrieved"),
+                         ('bytes_out', "Bytes of record data written"),
+                         ('records_written', "Records written to the document")):
+        emit (name + "_total", "counter", help, [("", counters.get (name, 0))])
+    for (name, help) in (('pdb_bytes', "Size of the written document in bytes"),):
+        if name in metrics['values']:
+            emit (name, "gauge", help, [("", metrics['values'][name])])
+    emit ("build_seconds", "gauge", "Wall clock time of the build", [("", metrics['wall_seconds'])])
+    emit ("stage_seconds", "gauge", "Time spent per build stage",
+          [('stage="%s"' % name, entry['seconds']) for (name, entry) in sorted (metrics['stages'].items ())])
+    emit ("cache_hit_ratio", "gauge", "Hit ratio of the internal caches",
+          [('cache="%s"' % name, entry['hit_ratio']) for (name, entry) in sorted (metrics['caches'].items ())
+           if entry['hit_ratio'] is not None])
+    emit ("compression_ratio", "gauge", "Compressed size relative to original size per record type",
+          [('record_type="%s"' % name, entry['ratio']) for (name, entry) in sorted (metrics['compression'].items ())
+           if entry['ratio'] is not None])
+    lines.append ("")
+    return "\n".join (lines)
+
+
+def write_metrics (filename=None, prom_filename=None, labels={}):
+    """Write the metrics as JSON to 'filename' and/or in Prometheus
+    text format to 'prom_filename'.  'labels' are added to the JSON
+    document and to every Prometheus sample."""
+    if not _enabled:
+        return
+    metrics = get_metrics ()
+    metrics['labels'] = dict (labels)
+    if filename:
+        _write_atomically (filename, json.dumps (metrics, indent=1, sort_keys=True) + "\n")
+        message(2, "Metrics written to %s" % filename)
+    if prom_filename:
+        _write_atomically (prom_filename, _prometheus_text (metrics, labels))
+        message(2, "Prometheus metrics written to %s" % prom_filename)
@@ -54,6 +54,7 @@ if __name__ == '__main__':
 
 
 import string
+import sys
 import struct
 import types
 import urllib.parse
@@ -71,6 +72,7 @@ import io
 from .rfc822py3 import Message
 
 from .UtilFns import message, error
+from . import Profiling, Metrics
 
 import time
 PILOT_TIME_DELTA = 2082844800
@@ -92,11 +94,22 @@ except ImportError:
     except ImportError:
         doc_compress_function = None
         doc_uncompress_function = None
+# doc_block_compress_into_function, if not None, appends the
+# compressed block to a bytearray instead of returning it
 try:
     from Pyrite import _Doc
     doc_block_compress_function = _Doc.compress
+    doc_block_compress_into_function = None
 except ImportError:
-    doc_block_compress_function = doc_compress_function
+    try:
+        # same results as Pyrite's doc_compress, but faster
+        from PyPlucker.helper import doc_compress as _doc_compress
+        doc_block_compress_function = _doc_compress.compress
+        doc_block_compress_into_function = _doc_compress.compress_into
+        doc_uncompress_function = _doc_compress.uncompress
+    except ImportError:
+        doc_block_compress_function = doc_compress_function
+        doc_block_compress_into_function = None
 
 
 ## These constants are only valid for the new format!!!
@@ -143,85 +156,360 @@ _DOC_HEADER_SIZE = 8
 _PARA_HEADER_SIZE = 4
 
 
-def DocCompressData (data):
-    """Do Doc compression of data.
-    If 'in_blocks' is true, do so in in 4KB blocks"""
+def DocCompressData (data, lazy=0):
+    """Do Doc compression of data in 4KB blocks.  With 'lazy' true,
+    the blocks are compressed with lazy matching (see
+    helper/doc_compress.py)"""
 
     if not doc_compress_function:
         raise RuntimeError("No doc compression function available!")
 
-    res = b""
-    while data:
-        block = data[:4096]
-        data = data[4096:]
-        res = res + doc_block_compress_function (block)
-    return res
+    # the blocks are views into data, not copies
+    view = memoryview (data)
+    if lazy:
+        from PyPlucker.helper import doc_compress
+        out = bytearray ()
+        for start in range (0, len (view), 4096):
+            doc_compress.compress_into (out, view[start:start + 4096], lazy)
+        return bytes (out)
+    if doc_block_compress_into_function is not None:
+        out = bytearray ()
+        for start in range (0, len (view), 4096):
+            doc_block_compress_into_function (out, view[start:start + 4096])
+        return bytes (out)
+    return b"".join ([doc_block_compress_function (bytes (view[start:start + 4096]))
+                      for start in range (0, len (view), 4096)])
+
+def DocLazyCompressData (data):
+    """DocCompressData with lazy matching"""
+    return DocCompressData (data, lazy=1)
 
 def DocUncompressData (data):
-    """Do Doc uncompression of data compressed in 4KB blocks"""
+    """Do Doc uncompression of data compressed in 4KB blocks.
+    Returns bytes."""
     if not doc_uncompress_function:
         raise RuntimeError("No doc uncompression function available!")
 
     return doc_uncompress_function (data)
 
-#count = 1
+# zlib strategies by the names used for the 'zlib_strategy' option
+ZLIB_STRATEGIES = {'default': 'Z_DEFAULT_STRATEGY',
+                   'filtered': 'Z_FILTERED',
+                   'huffman': 'Z_HUFFMAN_ONLY',
+                   'rle': 'Z_RLE',
+                   'fixed': 'Z_FIXED'}
+
+def _owner_id_bytes (owner_id):
+    if isinstance (owner_id, bytes):
+        return owner_id
+    return owner_id.encode ('latin-1', 'replace')
+
+def OwnerIdKey (owner_id):
+    """The key the viewer derives from the owner-id (the Palm user
+    name): the CRC-32s of the name repeated 2 to 11 times, 40 bytes"""
+    owner_id = _owner_id_bytes (owner_id)
+    return struct.pack (">10L", *[zlib.crc32 (owner_id * n) for n in range (2, 12)])
+
+def _zlib_compress (data, level, strategy):
+    if strategy == zlib.Z_DEFAULT_STRATEGY:
+        return zlib.compress (data, level)
+    compressor = zlib.compressobj (level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+    return compressor.compress (data) + compressor.flush ()
+
+
+def _xor_key (data, key, key_size):
+    """XOR the start of 'data' with 'key', a number of 'key_size'
+    bytes (see ZLibCompressor).  XORing again gives 'data' back."""
+    size = min (key_size, len (data))
+    # records shorter than the key are XORed with its start
+    key = key >> (8 * (key_size - size))
+    return (int.from_bytes (data[:size], 'big') ^ key).to_bytes (size, 'big') + data[size:]
+
+
+class ZLibLevelChooser:
+    """Picks the zlib level of each record for 'auto' compression.
+
+    The first few records, and after that every SAMPLE_EVERY'th, are
+    compressed at all of LEVELS (and the smallest result is kept).
+    This measures what each level costs and gains on the same data.
+    The other records get the highest level which stays within the
+    time budget (seconds per MB of input) and still saves MIN_GAIN of
+    the output of the level below it.
+
+    As the choice depends on timing, the output of two builds may
+    differ in size, but either decompresses the same."""
+
+    LEVELS = (1, 6, 9)
+    MIN_GAIN = 0.01
+    SAMPLE_FIRST = 3
+    SAMPLE_EVERY = 32
+    MIN_SAMPLE_SIZE = 512
+
+    def __init__ (self, seconds_per_mb=0.1):
+        self._budget = seconds_per_mb
+        # level -> [bytes in, bytes out, seconds] over the sampled records
+        self._samples = {}
+        for level in self.LEVELS:
+            self._samples[level] = [0, 0, 0.0]
+        self._sampled = 0
+        self._records = 0
+        self._level = zlib.Z_DEFAULT_COMPRESSION
+
+    def compress (self, data, strategy):
+        """Returns (compressed data, level used)"""
+        self._records = self._records + 1
+        if len (data) >= self.MIN_SAMPLE_SIZE and \
+               (self._sampled < self.SAMPLE_FIRST or self._records % self.SAMPLE_EVERY == 0):
+            return self._sample (data, strategy)
+        return (_zlib_compress (data, self._level, strategy), self._level)
+
+    def _sample (self, data, strategy):
+        best = None
+        for level in self.LEVELS:
+            start = time.perf_counter ()
+            result = _zlib_compress (data, level, strategy)
+            elapsed = time.perf_counter () - start
+            entry = self._samples[level]
+            entry[0] = entry[0] + len (data)
+            entry[1] = entry[1] + len (result)
+            entry[2] = entry[2] + elapsed
+            if best is None or len (result) < len (best[0]):
+                best = (result, level)
+        self._sampled = self._sampled + 1
+        self._level = self._choose ()
+        return best
+
+    def _choose (self):
+        chosen = self.LEVELS[0]
+        for level in self.LEVELS[1:]:
+            (size_in, size_out, seconds) = self._samples[level]
+            if seconds * 1048576.0 / size_in > self._budget:
+                break
+            if size_out > self._samples[chosen][1] * (1.0 - self.MIN_GAIN):
+                break
+            chosen = level
+        return chosen
+
+
+class ZLibCompressor:
+    """The CompressFunction used for zlib compression.
+
+    'level' is a zlib level (-1 for zlib's default) or 'auto' (see
+    ZLibLevelChooser), 'strategy' one of ZLIB_STRATEGIES.  With a 'key'
+    (see OwnerIdKey) the start of every compressed record is XORed
+    with it, so that only the owner's viewer can read it."""
+
+    def __init__ (self, key=None, level=-1, strategy='default', seconds_per_mb=0.1):
+        if zlib is None:
+            raise RuntimeError("No ZLib support in your Python installation!")
+        if strategy not in ZLIB_STRATEGIES:
+            raise ValueError ("Unknown zlib strategy '%s'" % strategy)
+        self._strategy = getattr (zlib, ZLIB_STRATEGIES[strategy])
+        if level == 'auto':
+            self._chooser = ZLibLevelChooser (seconds_per_mb)
+            self._level = None
+        else:
+            if not -1 <= level <= 9:
+                raise ValueError ("zlib level %s is not between -1 and 9" % level)
+            self._chooser = None
+            self._level = level
+        if key:
+            # the key as one number, XORed with the record in one go
+            self._key = int.from_bytes (key, 'big')
+            self._key_size = len (key)
+        else:
+            self._key = None
 
-def ZLibCompressData (data, username):
-    #global count
-    if zlib is None:
-        raise RuntimeError("No ZLib support in your Python installation!")
-    retval = zlib.compress (data)
-    if username:
-        l = min(len(username), len(retval))
-        retval = b''.join(list(map(lambda x, y: chr(ord(x) ^ ord(y)), retval[:l], username[:l]))) + retval[l:]
-    return retval
+    def __call__ (self, data):
+        if self._chooser is not None:
+            (result, level) = self._chooser.compress (data, self._strategy)
+            Metrics.count ('zlib_level_%d' % level)
+        else:
+            result = _zlib_compress (data, self._level, self._strategy)
+        if self._key is not None:
+            result = _xor_key (result, self._key, self._key_size)
+        return result
 
-def ZLibUncompressData (data):
+
+def ZLibCompressData (data, key=None, level=-1, strategy='default'):
+    """Compress data with zlib, XORed with 'key' if given (see
+    ZLibCompressor)"""
+    return ZLibCompressor (key, level, strategy) (data)
+
+def ZLibUncompressData (data, key=None):
+    """Uncompress data compressed with zlib, XORed with 'key' if
+    given (see ZLibCompressor)"""
     if zlib is None:
         raise RuntimeError("No ZLib support in your Python installation!")
+    if key:
+        data = _xor_key (data, int.from_bytes (key, 'big'), len (key))
     return zlib.decompress (data)
 
 CompressFunction = DocCompressData
 UncompressFunction = DocUncompressData
 
-def UseDocCompression ():
+# A string naming the settings of CompressFunction, part of the keys of
+# the compression cache
+_compression_mode = 'doc'
+
+# The CompressionCache in front of CompressFunction, if any
+_compression_cache = None
+
+# The CompressibilityPredictor deciding whether to compress at all, if
+# any.  It compresses samples with _sample_compress_function, and
+# takes compression to be futile if they come out at least
+# _sample_futile_ratio times their size.
+_compressibility_predictor = None
+_sample_compress_function = DocCompressData
+_sample_futile_ratio = 1.05
+
+def _zlib_sample_compress (sample):
+    return zlib.compress (sample, 1)
+
+def UseDocCompression (lazy=0):
+    """Use DOC compression.  With 'lazy' true, blocks are compressed
+    with lazy matching (see helper/doc_compress.py)"""
     global CompressFunction
     global UncompressFunction
-    CompressFunction = DocCompressData
+    global _compression_mode
+    global _sample_compress_function, _sample_futile_ratio
+    if lazy:
+        CompressFunction = DocLazyCompressData
+        _compression_mode = 'doc lazy'
+    else:
+        CompressFunction = DocCompressData
+        _compression_mode = 'doc'
     UncompressFunction = DocUncompressData
-
-def UseZLibCompression (user_id=None):
+    # samples have less to refer back to than the whole record, so
+    # they come out bigger
+    _sample_compress_function = CompressFunction
+    _sample_futile_ratio = 1.05
+
+def UseZLibCompression (user_id=None, level=-1, strategy='default', seconds_per_mb=0.1):
+    """Use zlib compression, see ZLibCompressor.  Records are
+    scrambled with the key of 'user_id' if given."""
     global CompressFunction
     global UncompressFunction
+    global _compression_mode
+    global _sample_compress_function, _sample_futile_ratio
     if zlib is None:
         raise RuntimeError("No ZLib support in your Python installation!")
     if user_id:
-        val = struct.pack(">LLLLLLLLLL",
-                          zlib.crc32(user_id * 2),
-                          zlib.crc32(user_id * 3),
-                          zlib.crc32(user_id * 4),
-                          zlib.crc32(user_id * 5),
-                          zlib.crc32(user_id * 6),
-                          zlib.crc32(user_id * 7),
-                          zlib.crc32(user_id * 8),
-                          zlib.crc32(user_id * 9),
-                          zlib.crc32(user_id * 10),
-                          zlib.crc32(user_id * 11))
-        sys.stderr.write("key is %d bytes:  %08x%08x%08x%08x%08x%08x%08x%08x%08x%08x\n" %
-                         (len(val), zlib.crc32(user_id * 2),
-                          zlib.crc32(user_id * 3),
-                          zlib.crc32(user_id * 4),
-                          zlib.crc32(user_id * 5),
-                          zlib.crc32(user_id * 6),
-                          zlib.crc32(user_id * 7),
-                          zlib.crc32(user_id * 8),
-                          zlib.crc32(user_id * 9),
-                          zlib.crc32(user_id * 10),
-                          zlib.crc32(user_id * 11)))
+        key = OwnerIdKey (user_id)
+        sys.stderr.write("key is %d bytes:  %s\n" % (len(key), key.hex()))
     else:
-        val = None
-    CompressFunction = lambda x, uname=val: ZLibCompressData(x, uname)
+        key = None
+    CompressFunction = ZLibCompressor (key, level, strategy, seconds_per_mb)
     UncompressFunction = ZLibUncompressData
+    _compression_mode = 'zlib %s %s %s' % (level, strategy, (key and key.hex ()) or '-')
+    # zlib hardly ever expands, so the samples just have to shrink
+    _sample_compress_function = _zlib_sample_compress
+    _sample_futile_ratio = 1.0
+
+def UseCompressionCache (cache):
+    """Look up compressed records in 'cache' (a CompressionCache, or
+    None to turn caching off) before compressing them"""
+    global _compression_cache
+    _compression_cache = cache
+
+def UseCompressibilityPredictor (predictor):
+    """Let 'predictor' (a CompressibilityPredictor, or None to always
+    compress) skip compressing records which will not get smaller"""
+    global _compressibility_predictor
+    _compressibility_predictor = predictor
+
+
+class CompressibilityPredictor:
+    """Guesses from samples of a record whether compression can make
+    it smaller at all, so that e.g. photographic 8 and 16 bpp images
+    are not compressed only to be shipped uncompressed.
+
+    Only records of RECORD_TYPES are predicted: text, tables and links
+    nearly always shrink, and sampling them (with the pure Python DOC
+    compressor in particular) would only add to their compression time.
+
+    SAMPLES pieces of SAMPLE_SIZE bytes, spread over the record, are
+    compressed together (see _sample_compress_function); if they come
+    out at least 'threshold' times their size (by default
+    _sample_futile_ratio), the record is not compressed.  Records
+    smaller than twice the samples are always compressed.
+
+    Every AUDIT_EVERY'th record predicted futile is compressed anyway.
+    Whether the prediction was right is counted for these and for the
+    records predicted to shrink (predictor_hits and predictor_misses
+    in the metrics), so that the threshold can be tuned."""
+
+    RECORD_TYPES = ('image',)
+    SAMPLES = 4
+    SAMPLE_SIZE = 1024
+    AUDIT_EVERY = 16
+
+    def __init__ (self, threshold=None):
+        self._threshold = threshold
+        self._futile = 0
+
+    def futile (self, data):
+        """Return true if compressing 'data' looks futile, None if
+        'data' is too small to tell"""
+        if len (data) < 2 * self.SAMPLES * self.SAMPLE_SIZE:
+            return None
+        step = (len (data) - self.SAMPLE_SIZE) // (self.SAMPLES - 1)
+        sample = b"".join ([bytes (data[start:start + self.SAMPLE_SIZE])
+                            for start in range (0, step * self.SAMPLES, step)])
+        threshold = self._threshold or _sample_futile_ratio
+        return len (_sample_compress_function (sample)) >= threshold * len (sample)
+
+    def compress (self, data):
+        """Compress 'data' with CompressFunction, unless that looks
+        futile.  Returns None then."""
+        futile = self.futile (data)
+        if futile is None:
+            return CompressFunction (data)
+        if futile:
+            Metrics.count ('predicted_futile')
+            self._futile = self._futile + 1
+            if self._futile % self.AUDIT_EVERY:
+                return None
+        else:
+            Metrics.count ('predicted_useful')
+        result = CompressFunction (data)
+        if (len (result) >= len (data)) == futile:
+            Metrics.count ('predictor_hits')
+        else:
+            Metrics.count ('predictor_misses')
+        return result
+
+
+def _compress_record (data, record_type):
+    """Compress the body of a record of 'record_type' (e.g. 'text' or
+    'image') with the current CompressFunction, or take the result
+    from the compression cache.  Returns None if the compressibility
+    predictor says that compression cannot make it smaller."""
+    cache = _compression_cache
+    if cache is not None and len (data) < cache.MIN_SIZE:
+        cache = None
+    with Profiling.stage (Profiling.STAGE_COMPRESS, record_type):
+        result = None
+        if cache is not None:
+            key = cache.key (data, _compression_mode)
+            result = cache.get (key)
+            if result is not None:
+                Metrics.count ('compression_cache_hits')
+            else:
+                Metrics.count ('compression_cache_misses')
+        if result is None:
+            predictor = _compressibility_predictor
+            if predictor is not None and record_type in predictor.RECORD_TYPES:
+                result = predictor.compress (data)
+            else:
+                result = CompressFunction (data)
+            if result is not None and cache is not None:
+                cache.put (key, result)
+    if result is None:
+        Metrics.count_compression (record_type, len (data), len (data))
+    else:
+        Metrics.count_compression (record_type, len (data), len (result))
+    return result
 
 
 ##########################################################################
@@ -1055,12 +1343,14 @@ class PluckerTextParagraph:
     def undump_record (self, text, verbose=0):
         """Dissassemble just one paragraph"""
         self._data = text
+        doc_encoding = (self._doc and self._doc.get_charset ()) or 'latin-1'
         while 1:
-            res = text.split("\0", 1)
+            res = text.split(b"\0", 1)
             if res[0]:
                 # some text before a function or before the end
-                message("  Text %s" % repr(res[0]))
-                self.add_text (res[0])
+                if verbose:
+                    print("  Text %s" % repr(res[0]))
+                self.add_text (str (res[0], doc_encoding, 'replace'))
             if len(res) == 1:
                 # just text and no function was found, i.e. we are now done
                 break
@@ -1069,54 +1359,64 @@ class PluckerTextParagraph:
                 rest_text = res[1]
                 assert len (rest_text)>= 1, "No function data found after function marker"
                 function_code = rest_text[0]
-                if function_code == "\012":
+                if function_code == 0o12:
                     # anchor
                     (id,) = struct.unpack(">H", rest_text[1:3])
                     text = rest_text[3:]
-                    message("  Anchor start for document #%d" % id)
+                    if verbose:
+                        print("  Anchor start for document #%d" % id)
                     self.add_anchor_start ({'recordnumber': id})
-                elif function_code == "\014":
+                elif function_code == 0o14:
                     # anchor with fragment part
                     (id, fragmentid) = struct.unpack(">HH", rest_text[1:5])
                     text = rest_text[5:]
                     if verbose:
                         print("  Anchor start for document #(%d, %d)" % (id, fragmentid))
                     self.add_anchor_start ({'recordnumber': (id, fragmentid)})
-                elif function_code == "\010":
+                elif function_code == 0o10:
                     # anchor end
                     text = rest_text[1:]
                     if verbose:
                         print("  End anchor")
                     self.add_anchor_end ()
-                elif function_code == "\021":
+                elif function_code == 0o21:
                     # set style
                     (id,) = struct.unpack(">B", rest_text[1:2])
                     text = rest_text[2:]
-                    assert id>=0 and id<=7, "Illegal style code %d found" % id
+                    assert id>=0 and id<=11, "Illegal style code %d found" % id
                     if verbose:
                         if id==0:
                             idcode = "normal"
                         elif id==7:
                             idcode = "bold"
+                        elif id>7:
+                            idcode = ("fixed width", "small", "subscript", "superscript")[id-8]
                         else:
                             idcode = "header %d" % id
                         print("  Style code %d (%s)" % (id, idcode))
                     self.add_style_change (id)
-                elif function_code == "\032":
+                elif function_code == 0o32:
                     # image
                     (id,) = struct.unpack(">H", rest_text[1:3])
                     text = rest_text[3:]
                     if verbose:
                         print("  Reference to image #%d" % id)
                     self.add_image_reference ({'recordnumber': id})
-                elif function_code == "\042":
+                elif function_code == 0o134:
+                    # image with a link to a bigger version
+                    (big_id, id) = struct.unpack(">HH", rest_text[1:5])
+                    text = rest_text[5:]
+                    if verbose:
+                        print("  Reference to image #%d (big version #%d)" % (id, big_id))
+                    self.add_image_reference ({'recordnumber': id, 'big_id': big_id})
+                elif function_code == 0o42:
                     # set margin
                     (left, right) = struct.unpack(">BB", rest_text[1:3])
                     text = rest_text[3:]
                     self.add_set_margin (left, right)
                     if verbose:
                         print("  Set Margins  %d, %d" % (left, right))
-                elif function_code == "\051":
+                elif function_code == 0o51:
                     # alignment
                     (code,) = struct.unpack(">B", rest_text[1:2])
                     text = rest_text[2:]
@@ -1131,67 +1431,85 @@ class PluckerTextParagraph:
                         else:
                             al = "???"
                         print("  Alignment %s" % al)
-                elif function_code == "\063":
+                elif function_code == 0o63:
                     # alignment
                     (height, width, perc_width) = struct.unpack(">BBB", rest_text[1:4])
                     text = rest_text[4:]
                     self.add_hr (height, width, perc_width)
                     if verbose:
                         print("  Horizontal rule: height: %d, width: %d, %%-width: %d" % (height, width, perc_width))
-                elif function_code == "\070":
+                elif function_code == 0o70:
                     # newline
                     self.add_newline ()
                     text = rest_text[1:]
                     if verbose:
                         print("  NewLine")
-                elif function_code == "\100":
+                elif function_code == 0o100:
                     # italics start
                     self.add_italics_start ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Italics start")
-                elif function_code == "\110":
+                elif function_code == 0o110:
                     # italics end
                     self.add_italics_end ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Italics end")
-                elif function_code == "\140":
+                elif function_code == 0o140:
                     # underline start
                     self.add_underline_start ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Underline start")
-                elif function_code == "\150":
+                elif function_code == 0o150:
                     # underline end
                     self.add_underline_end ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Underline end")
-                elif function_code == "\160":
+                elif function_code == 0o160:
                     # strikethrough start
                     self.add_strike_start ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Strikethrough start")
-                elif function_code == "\170":
+                elif function_code == 0o170:
                     # strikethrough end
                     self.add_strike_end ()
                     text = rest_text[1:]
                     if verbose:
                         print("  Strikethrough end")
-                elif function_code == "\123":
+                elif function_code == 0o123:
                     # set forecolor
                     (r, g, b) = struct.unpack(">BBB", rest_text[1:4])
                     text = rest_text[4:]
                     # add_set_forecolor function expects a string of the 3 hex values
-                    # so convert them to strings with custom itoa function then concatenate
-                    rgb = itoa (r, 16) + itoa (g, 16) + itoa (b, 16)
+                    rgb = "%02x%02x%02x" % (r, g, b)
                     self.add_set_forecolor (rgb)
                     if verbose:
                         print("  ForeColor start: red: %d, green: %d, blue: %d" % (r, g, b))
+                elif function_code == 0o203 or function_code == 0o205:
+                    # unicode character, followed by its text equivalent
+                    if function_code == 0o203:
+                        (length, char) = struct.unpack(">BH", rest_text[1:4])
+                        rest_text = rest_text[4:]
+                    else:
+                        (length, char) = struct.unpack(">BL", rest_text[1:6])
+                        rest_text = rest_text[6:]
+                    text = rest_text[length:]
+                    if verbose:
+                        print("  Unicode character U+%04X" % char)
+                    self.add_unicode_char (char, str (rest_text[:length], doc_encoding, 'replace'))
+                elif function_code == 0o222:
+                    # table
+                    (id,) = struct.unpack(">H", rest_text[1:3])
+                    text = rest_text[3:]
+                    if verbose:
+                        print("  Reference to table #%d" % id)
+                    self.add_table ({'recordnumber': id})
                 else:
-                    raise AssertionError("Unknown function code %s (%d) found" % (repr(function_code), ord(function_code)))
+                    raise AssertionError("Unknown function code %d found" % function_code)
 
 
 
@@ -1299,9 +1617,9 @@ class PluckerTextDocument (PluckerDocument):
         headers = b"".join(headers)
         bodies = b"".join(bodies)
 
-        compressed_bodies = CompressFunction (bodies)
+        compressed_bodies = _compress_record (bodies, 'text')
 
-        if len (compressed_bodies) < len (bodies):
+        if compressed_bodies is not None and len (compressed_bodies) < len (bodies):
             shipped_bodies = compressed_bodies
             content_type = DOCTYPE_HTML_COMPRESSED
         else:
@@ -1609,8 +1927,8 @@ class PluckerImageDocument (PluckerDocument):
         assert _DOC_HEADER_SIZE==8
 
         if len (self._data) > self._config.get_int ('image_compression_limit', 0):
-            compressed_data = CompressFunction (self._data)
-            if len (compressed_data) < len (self._data):
+            compressed_data = _compress_record (self._data, 'image')
+            if compressed_data is not None and len (compressed_data) < len (self._data):
                 data = compressed_data
                 type = DOCTYPE_IMAGE_COMPRESSED
             else:
@@ -1853,19 +2171,20 @@ class PluckerMailtoDocument (PluckerDocument):
                (data_size, len (rest_data))
         off_data = rest_data[:8]
         (to_offset, cc_offset, subject_offset, body_offset) = struct.unpack (">HHHH", off_data)
-        print("Mailto offsets: \n" \
-            "\tto      %d\n" \
-            "\tcc      %d\n" \
-            "\tsubject %d\n" \
-            "\tbody    %d" % \
-            (to_offset, cc_offset, subject_offset, body_offset))
-        print("Data: \n" \
-            "\tto      %s\n" \
-            "\tcc      %s\n" \
-            "\tsubject %s\n" \
-            "\tbody    %s\n" % \
-            (rest_data[to_offset:cc_offset], rest_data[cc_offset:subject_offset], \
-             rest_data[subject_offset:body_offset], rest_data[body_offset:]))
+        if verbose:
+            print("Mailto offsets: \n" \
+                "\tto      %d\n" \
+                "\tcc      %d\n" \
+                "\tsubject %d\n" \
+                "\tbody    %d" % \
+                (to_offset, cc_offset, subject_offset, body_offset))
+            print("Data: \n" \
+                "\tto      %s\n" \
+                "\tcc      %s\n" \
+                "\tsubject %s\n" \
+                "\tbody    %s\n" % \
+                (rest_data[to_offset:cc_offset], rest_data[cc_offset:subject_offset], \
+                 rest_data[subject_offset:body_offset], rest_data[body_offset:]))
 
 
 
@@ -2010,26 +2329,26 @@ class PluckerTableDocument (PluckerDocument):
         ltext = text.split(b'\000\070')
         while len(ltext):
             while len(ltext[0]):
-                line = ""
+                line = b""
                 count = 0
                 offset = 0
                 while offset < len(ltext[0]) and count < (maxlen * cols):
-                    if ord(str(ltext[0][offset])):
+                    if ltext[0][offset]:
                         offset = offset + 1
                         count = count + 1
                     else:
-                        if ord(str(ltext[0][offset + 1])) == 0x11:
+                        if ltext[0][offset + 1] == 0x11:
                             """ BOLD maxlen is 20 """
-                            if ord(str(ltext[0][offset + 2])) == 7:
+                            if ltext[0][offset + 2] == 7:
                                 maxlen = 20
                             else:
                                 maxlen = 25
-                        offset = offset + 2 + (ord(str(ltext[0][offset + 1])) & 7)
-                while offset < len(ltext[0]) and ord(str(ltext[0][offset])) > 32:
+                        offset = offset + 2 + (ltext[0][offset + 1] & 7)
+                while offset < len(ltext[0]) and ltext[0][offset] > 32:
                     offset = offset + 1
-                if offset < len(ltext[0]) and not ord(str(ltext[0][offset])):
+                if offset < len(ltext[0]) and not ltext[0][offset]:
                     #trailing function
-                    offset = offset + 2 + (ord(str(ltext[0][offset + 1])) & 7)
+                    offset = offset + 2 + (ltext[0][offset + 1] & 7)
                 line = ltext[0][:offset]
                 ltext[0] = ltext[0][offset:]
                 clines.append(line)
@@ -2058,7 +2377,7 @@ class PluckerTableDocument (PluckerDocument):
                 if acell.image_ref is None:
                     acell.image_ref = 0
                 if acell.image_ref == 0 and not len(acell.text):
-                    acell.text = '\240'
+                    acell.text = b'\240'
 
     def dump_record (self, id):
 
@@ -2090,11 +2409,10 @@ class PluckerTableDocument (PluckerDocument):
                               self.border_color,
                               self.link_color)
 
-        table_header = b"".join(table_headers)
         data = table_header + data
 
-        compressed_data = CompressFunction (data)
-        if len (compressed_data) < len (data):
+        compressed_data = _compress_record (data, 'table')
+        if compressed_data is not None and len (compressed_data) < len (data):
             ship_data = compressed_data
             type = DOCTYPE_TABLE_COMPRESSED
         else:
@@ -2200,7 +2518,7 @@ class PluckerCategoryDocument (PluckerSpecialDocument):
 
         category_list = self._config.get_string('category')
 
-        categories = category_list.replace(";", "\0")
+        categories = category_list.replace(";", "\0").encode ('latin-1', 'replace')
 
         header = struct.pack (">HHHH",
                               record_id,            # uid
@@ -2208,7 +2526,7 @@ class PluckerCategoryDocument (PluckerSpecialDocument):
                               len(categories) + 1,  # size
                               DOCTYPE_CATEGORY)     # content type
 
-        return header + categories + '\0'
+        return header + categories + b'\0'
 
 
 
@@ -2246,7 +2564,7 @@ class PluckerMetadataDocument (PluckerSpecialDocument):
                 count = count + 1
 
             elif key == 'OwnerID':
-                val = zlib.crc32(self._info[key])
+                val = zlib.crc32(_owner_id_bytes(self._info[key]))
                 message(3, 'CRC-32 of owner-id "%s" is 0x%x\n', self._info[key], val)
                 subrecords.append(struct.pack('>HHL', self.TYPECODE_OWNER_ID, 2, val))
                 count = count + 1
@@ -2323,17 +2641,21 @@ class PluckerLinksDocument (PluckerSpecialDocument):
         return (self._min_id, self._max_id)
 
     def dump_record (self, id):
-        """(Re-)Assemble the binary representation of this document"""
+        """(Re-)Assemble the binary representation of this document.
 
-        compressed_data = CompressFunction (self._urls)
-        if len (compressed_data) > len (self._urls):
-            data = self._urls
-            type = DOCTYPE_LINKS
-        else:
+        The viewer finds the URL of record n as the n - min_id'th of
+        the NUL-terminated strings, so the strings must stay complete
+        and in record order: front coding them would break it.  They
+        compress well anyway, as URLs of one site share long prefixes
+        (even more so with sort_urls, see Writer.Mapper)."""
+
+        compressed_data = _compress_record (self._urls, 'links')
+        if compressed_data is not None and len (compressed_data) < len (self._urls):
             data = compressed_data
             type = DOCTYPE_LINKS_COMPRESSED
-        data = self._urls
-        type = DOCTYPE_LINKS
+        else:
+            data = self._urls
+            type = DOCTYPE_LINKS
         header = struct.pack (">HHHH",
                               id,               # uid
                               0,                # number of paragraphs
@@ -2384,7 +2706,8 @@ def Undump_PluckerDocument (url, data, verbose=0):
 
     if len (data) > _DOC_HEADER_SIZE:
         header_data = data[:_DOC_HEADER_SIZE]
-        (uid, paragraphs, size, content_type) = struct.unpack (">HHHH", header_data)
+        (uid, paragraphs, size, content_type, flags) = struct.unpack (">HHHBB", header_data)
+        content_type = content_type << 8
         # We assign some dummy values to pass the test below
         vert_offset=0
         first_visible=_DOC_HEADER_SIZE
@@ -1,5 +1,407 @@
-#
-# This module is currently unused.
-#
+#!/usr/bin/env python
 
-pass
+"""
+Profiling.py
+
+Find out where a build spends its time.
+
+Four tools are offered:
+
+ o run_profiled() runs a function (normally Spider.main) under
+   cProfile and dumps the statistics to a .prof file, which can be
+   inspected with pstats, snakeviz and friends.
+
+ o Stage timers.  The expensive steps of a build are wrapped in
+
+       with Profiling.stage ('parse', content_type):
+           ...
+
+   When enable_stages() has been called, time and number of calls are
+   summed up per stage and content type and report_stages() prints a
+   table of them at the end of the run.  Otherwise stage() returns a
+   shared do-nothing object, so the hooks cost next to nothing.
+
+   Stages may nest (e.g. 'image convert' happens within 'parse'); the
+   table shows the total time of a stage as well as its own time
+   without nested stages.
+
+ o Tracing.  After enable_trace(), every stage (and the spans added
+   with trace_span()) is also recorded as an event together with the
+   URL it worked on, and write_trace() saves them in the Chrome trace
+   event format, to be loaded into chrome://tracing or Perfetto.
+   The spider adds instant events (trace_instant()) for every
+   retrieved URL and the links found in it, so the link graph of a
+   build can be recovered from its trace (see benchmarks/crawlsim.py).
+
+ o Memory snapshots.  After enable_memprofile(), memory_snapshot()
+   takes a tracemalloc snapshot at the given point of the build and
+   counts the live instances of PyPlucker classes; report_memory()
+   prints the top allocation sites, their growth since the previous
+   snapshot, the class counts and the peak RSS.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import os, sys, time, threading, json, gc
+
+from PyPlucker.UtilFns import message
+
+
+# The names of the stages used in PyPlucker
+STAGE_RETRIEVE = 'retrieve'
+STAGE_PARSE = 'parse'
+STAGE_IMAGE_CONVERT = 'image convert'
+STAGE_COMPRESS = 'compress'
+STAGE_ID_MAPPING = 'id mapping'
+STAGE_WRITE = 'write'
+STAGE_QUEUED = 'queued'
+STAGE_ROBOTS = 'robots check'
+STAGE_FETCH_CONNECT = 'fetch connect'
+STAGE_FETCH_HEADERS = 'fetch headers'
+STAGE_FETCH_BODY = 'fetch body'
+STAGE_FILTER = 'filter'
+STAGE_IMAGE_RENDITION = 'image rendition'
+STAGE_DUMP = 'dump'
+
+# The names of the instant events in a trace
+EVENT_FETCHED = 'fetched'
+EVENT_LINKS = 'links'
+
+
+_stages_enabled = 0
+
+# (stage, content type) -> [calls, total seconds, own seconds]
+_stage_times = {}
+
+# the currently running stages
+_stage_stack = []
+
+# name of the trace file, list of trace events and time of the start
+_trace_file = None
+_trace_events = []
+_trace_start = 0
+
+# list of (label, tracemalloc snapshot, {class name: count}, peak RSS)
+_memory_snapshots = []
+_memprofile_enabled = 0
+
+
+def _short_type (content_type):
+    """Return content type without parameters, e.g. 'text/html' for
+    'text/html; charset=utf-8'"""
+    if not content_type:
+        return "-"
+    return str (content_type).split (';')[0].strip ().lower () or "-"
+
+
+class _Stage:
+    """A running stage timer"""
+
+    def __init__ (self, name, content_type, url):
+        self._name = name
+        self._content_type = content_type
+        self._url = url
+        self._start = 0
+        self._nested = 0.0
+
+    def set_content_type (self, content_type):
+        """Set the content type if it is only known after the stage
+        has been started (e.g. when retrieving)"""
+        self._content_type = content_type
+
+    def __enter__ (self):
+        _stage_stack.append (self)
+        self._start = time.perf_counter ()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        end = time.perf_counter ()
+        elapsed = end - self._start
+        _stage_stack.pop ()
+        if _stage_stack:
+            _stage_stack[-1]._nested = _stage_stack[-1]._nested + elapsed
+        if _trace_file is not None:
+            trace_span (self._name, self._start, end, self._url, self._content_type)
+        if not _stages_enabled:
+            return 0
+        key = (self._name, _short_type (self._content_type))
+        entry = _stage_times.get (key)
+        if entry is None:
+            entry = _stage_times[key] = [0, 0.0, 0.0]
+        entry[0] = entry[0] + 1
+        entry[1] = entry[1] + elapsed
+        entry[2] = entry[2] + elapsed - self._nested
+        return 0
+
+
+class _NullStage:
+    """What stage() returns while stage timing is off"""
+
+    def set_content_type (self, content_type):
+        pass
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        return 0
+
+
+_null_stage = _NullStage ()
+
+
+def enable_stages (on=1):
+    """Turn stage timing on (or off)"""
+    global _stages_enabled
+    _stages_enabled = on
+
+
+def stages_enabled ():
+    return _stages_enabled
+
+
+def stage (name, content_type=None, url=None):
+    """Return a context manager timing stage 'name' for 'content_type'.
+    'url' is only used for tracing."""
+    if not _stages_enabled and _trace_file is None:
+        return _null_stage
+    return _Stage (name, content_type, url)
+
+
+def enable_trace (filename):
+    """Record trace events, to be written to 'filename' by write_trace()"""
+    global _trace_file, _trace_start
+    _trace_file = filename
+    _trace_start = time.perf_counter ()
+    del _trace_events[:]
+
+
+def tracing ():
+    return _trace_file is not None
+
+
+def trace_timestamp ():
+    """Return the current time for a later trace_span(), or None if
+    not tracing"""
+    if _trace_file is None:
+        return None
+    return time.perf_counter ()
+
+
+def trace_span (name, start, end=None, url=None, content_type=None):
+    """Record a span 'name' from 'start' to 'end' (times as returned by
+    trace_timestamp(); 'end' defaults to now)"""
+    if _trace_file is None or start is None:
+        return
+    if end is None:
+        end = time.perf_counter ()
+    args = {}
+    if url is not None:
+        args['url'] = str (url)
+    if content_type:
+        args['content_type'] = _short_type (content_type)
+    _trace_events.append ({'name': name,
+                           'cat': 'plucker',
+                           'ph': 'X',
+                           'ts': round ((start - _trace_start) * 1000000.0, 1),
+                           'dur': round ((end - start) * 1000000.0, 1),
+                           'pid': os.getpid (),
+                           'tid': threading.get_ident (),
+                           'args': args})
+
+
+def trace_instant (name, url=None, **args):
+    """Record an instant event 'name' for 'url'.  The keyword
+    arguments are stored with it."""
+    if _trace_file is None:
+        return
+    if url is not None:
+        args['url'] = str (url)
+    _trace_events.append ({'name': name,
+                           'cat': 'plucker',
+                           'ph': 'i',
+                           's': 't',
+                           'ts': round ((time.perf_counter () - _trace_start) * 1000000.0, 1),
+                           'pid': os.getpid (),
+                           'tid': threading.get_ident (),
+                           'args': args})
+
+
+def write_trace ():
+    """Write the recorded trace events to the trace file"""
+    if _trace_file is None:
+        return
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid (),
+               'args': {'name': 'plucker-build'}}] + _trace_events
+    f = open (_trace_file, 'w')
+    json.dump ({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    f.close ()
+    message(0, "Trace with %d events written to %s" % (len (_trace_events), _trace_file))
+
+
+def get_stage_times ():
+    """Return a dictionary (stage, content type) -> (calls, total
+    seconds, own seconds)"""
+    result = {}
+    for (key, value) in _stage_times.items ():
+        result[key] = tuple (value)
+    return result
+
+
+def reset_stages ():
+    _stage_times.clear ()
+
+
+def take_stage_times ():
+    """Return the stage times and trace events recorded so far and
+    forget them.  Worker processes use this to hand them to the parent
+    process, which adds them with merge_stage_times()."""
+    result = (get_stage_times (), list (_trace_events))
+    _stage_times.clear ()
+    del _trace_events[:]
+    return result
+
+
+def merge_stage_times (taken):
+    """Add stage times and trace events returned by take_stage_times()"""
+    (times, events) = taken
+    for (key, (calls, total, own)) in times.items ():
+        entry = _stage_times.get (key)
+        if entry is None:
+            entry = _stage_times[key] = [0, 0.0, 0.0]
+        entry[0] = entry[0] + calls
+        entry[1] = entry[1] + total
+        entry[2] = entry[2] + own
+    _trace_events.extend (events)
+
+
+def report_stages ():
+    """Print the table of stage times"""
+    items = list (_stage_times.items ())
+    if not items:
+        message(0, "No stage times recorded.")
+        return
+    # sort by stage, biggest consumers first within a stage
+    totals = {}
+    for ((name, content_type), (calls, total, own)) in items:
+        totals[name] = totals.get (name, 0.0) + total
+    items.sort (key=lambda item: (-totals[item[0][0]], item[0][0], -item[1][1]))
+    message(0, "")
+    message(0, "%-14s %-26s %7s %10s %10s" % ("Stage", "Content type", "Calls", "Seconds", "Own"))
+    for ((name, content_type), (calls, total, own)) in items:
+        message(0, "%-14s %-26s %7d %10.3f %10.3f" % (name, content_type[:26], calls, total, own))
+
+
+def enable_memprofile (nframes=1):
+    """Start tracing memory allocations for memory_snapshot().
+    'nframes' is the depth of the tracebacks stored per allocation."""
+    global _memprofile_enabled
+    import tracemalloc
+    if not tracemalloc.is_tracing ():
+        tracemalloc.start (nframes)
+    _memprofile_enabled = 1
+    del _memory_snapshots[:]
+
+
+def memprofiling ():
+    return _memprofile_enabled
+
+
+def peak_rss ():
+    """Return the peak resident set size of the process in bytes,
+    or None where that is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def _count_instances ():
+    """Return a dictionary class name -> number of live instances,
+    for the classes defined in PyPlucker"""
+    counts = {}
+    for obj in gc.get_objects ():
+        cls = type (obj)
+        module = getattr (cls, '__module__', None)
+        if module and module[:9] == 'PyPlucker':
+            name = cls.__name__
+            counts[name] = counts.get (name, 0) + 1
+    return counts
+
+
+def memory_snapshot (label):
+    """Take a memory snapshot at the point of the build named 'label'
+    (e.g. 'after crawl')"""
+    if not _memprofile_enabled:
+        return
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot ()
+    # leave out tracemalloc itself and the code loaded by imports
+    snapshot = snapshot.filter_traces ((tracemalloc.Filter (0, tracemalloc.__file__),
+                                        tracemalloc.Filter (0, "<frozen importlib._bootstrap>"),
+                                        tracemalloc.Filter (0, "<frozen importlib._bootstrap_external>")))
+    _memory_snapshots.append ((label, snapshot, _count_instances (), peak_rss ()))
+    message(2, "Memory snapshot '%s' taken" % label)
+
+
+def _mb (size):
+    return size / (1024.0 * 1024.0)
+
+
+def report_memory (top=10):
+    """Print the memory snapshots: allocation sites, class counts
+    and peak RSS"""
+    if not _memory_snapshots:
+        message(0, "No memory snapshots taken.")
+        return
+    import tracemalloc
+    (current, peak) = tracemalloc.get_traced_memory ()
+    message(0, "")
+    message(0, "Traced memory: %.1f MB now, %.1f MB peak" % (_mb (current), _mb (peak)))
+    previous = None
+    previous_counts = {}
+    for (label, snapshot, counts, rss) in _memory_snapshots:
+        stats = snapshot.statistics ('lineno')
+        total = sum ([stat.size for stat in stats])
+        message(0, "")
+        if rss is None:
+            message(0, "==== %s: %.1f MB traced ====" % (label, _mb (total)))
+        else:
+            message(0, "==== %s: %.1f MB traced, %.1f MB peak RSS ====" % (label, _mb (total), _mb (rss)))
+        message(0, "Top allocation sites:")
+        for stat in stats[:top]:
+            frame = stat.traceback[0]
+            message(0, "  %9.1f KB %8d blocks  %s:%d" % (stat.size / 1024.0, stat.count, frame.filename, frame.lineno))
+        if previous is not None:
+            message(0, "Growth since previous snapshot:")
+            for stat in snapshot.compare_to (previous, 'lineno')[:top]:
+                frame = stat.traceback[0]
+                message(0, "  %+9.1f KB %+8d blocks  %s:%d" % (stat.size_diff / 1024.0, stat.count_diff, frame.filename, frame.lineno))
+        message(0, "Live instances:")
+        names = list (counts.keys ())
+        names.sort (key=lambda name: (-counts[name], name))
+        for name in names[:top * 2]:
+            message(0, "  %8d (%+d)  %s" % (counts[name], counts[name] - previous_counts.get (name, 0), name))
+        previous = snapshot
+        previous_counts = counts
+
+
+def run_profiled (function, args, filename):
+    """Call function(*args) under cProfile, dump the statistics to
+    'filename' and return the result of the function."""
+    import cProfile, pstats
+    profiler = cProfile.Profile ()
+    try:
+        result = profiler.runcall (function, *args)
+    finally:
+        profiler.dump_stats (filename)
+        message(0, "Profile written to %s" % filename)
+    from PyPlucker import UtilFns
+    if UtilFns.CurrentVerbosityLevel > 1:
+        stats = pstats.Stats (filename, stream=UtilFns.MessageStream)
+        stats.sort_stats ('cumulative').print_stats (25)
+    return result
@@ -15,6 +15,7 @@ import os, sys
 import string
 import re
 import urllib.request, urllib.parse, urllib.error
+import http.client
 import types
 
 ## The following section tries to get the PyPlucker directory onto the
@@ -43,7 +44,7 @@ try:
 except:
     _have_gzip = 0
 
-from PyPlucker import Url, __version__
+from PyPlucker import Url, Profiling, Metrics, __version__
 from .UtilFns import error, message
 
 def GuessType (name):
@@ -70,6 +71,35 @@ def GuessType (name):
     return 'unknown/unknown'
 
 
+class TimedHTTPConnection (http.client.HTTPConnection):
+    """An HTTPConnection timing the connect (including the name lookup)
+    and the wait for the response headers as separate stages"""
+
+    url = None
+
+    def connect (self):
+        with Profiling.stage (Profiling.STAGE_FETCH_CONNECT, url=self.url):
+            http.client.HTTPConnection.connect (self)
+
+    def getresponse (self):
+        with Profiling.stage (Profiling.STAGE_FETCH_HEADERS, url=self.url):
+            return http.client.HTTPConnection.getresponse (self)
+
+
+class TimedHTTPSConnection (http.client.HTTPSConnection):
+    """The same for HTTPS; the connect stage includes the TLS handshake"""
+
+    url = None
+
+    def connect (self):
+        with Profiling.stage (Profiling.STAGE_FETCH_CONNECT, url=self.url):
+            http.client.HTTPSConnection.connect (self)
+
+    def getresponse (self):
+        with Profiling.stage (Profiling.STAGE_FETCH_HEADERS, url=self.url):
+            return http.client.HTTPSConnection.getresponse (self)
+
+
 class PluckerFancyOpener (urllib.request.FancyURLopener):
     """A subclass of urllib.FancyURLopener, so we can remember an
     error code and the error text."""
@@ -93,6 +123,37 @@ class PluckerFancyOpener (urllib.request.FancyURLopener):
         #for header in self.addheaders: message(0, "%s", header)
 
 
+    def open (self, fullurl, data=None):
+        # remembered for the stages of the connections, see open_http()
+        self._url = fullurl
+        return urllib.request.FancyURLopener.open (self, fullurl, data)
+
+
+    def _timed_connection (self, connection_class, host, **args):
+        connection = connection_class (host, **args)
+        connection.url = self._url
+        return connection
+
+
+    def open_http (self, url, data=None):
+        """Like FancyURLopener.open_http, but times the connect and
+        the response headers when stage timing or tracing is on"""
+        if not (Profiling.stages_enabled () or Profiling.tracing ()):
+            return urllib.request.FancyURLopener.open_http (self, url, data)
+        return self._open_generic_http (lambda host: self._timed_connection (TimedHTTPConnection, host),
+                                        url, data)
+
+
+    def open_https (self, url, data=None):
+        if not (Profiling.stages_enabled () or Profiling.tracing ()):
+            return urllib.request.FancyURLopener.open_https (self, url, data)
+        # with the same arguments as FancyURLopener._https_connection
+        return self._open_generic_http (lambda host: self._timed_connection (TimedHTTPSConnection, host,
+                                                                             key_file=self.key_file,
+                                                                             cert_file=self.cert_file),
+                                        url, data)
+
+
     def remove_header (self, header):
         """Remove the header information 'header' if on the header list.
            Return if found on list.
@@ -157,7 +218,7 @@ class SimpleRetriever:
         return ({'URL': url,
                  'error code': 0,
                  'error text': "OK",
-                 'content-type': GuessType (filename),
+                 'Content-Type': GuessType (filename),
                  'content-length': len (contents)},
                 contents)
 
@@ -213,7 +274,8 @@ class SimpleRetriever:
                 message(3, "headers_dict is %s", headers_dict);
 
                 # Now get the contents
-                contents = webdoc.read ()
+                with Profiling.stage (Profiling.STAGE_FETCH_BODY, headers_dict['Content-Type'], real_url):
+                    contents = webdoc.read ()
 
                 # Check if encoded contents...
                 if 'content-encoding' in headers_dict:
@@ -257,8 +319,10 @@ class SimpleRetriever:
         data_key = (str (url), post_data)
         if data_key in self._cache:
             # has been retrieved before, we just return the cached data
+            Metrics.count ('retriever_cache_hits')
             return self._cache[data_key]
         else:
+            Metrics.count ('retriever_cache_misses')
             result = self._retrieve (url, alias_list, post_data)
             self._cache[data_key] = result
             newurl = getattr(result, 'URL', url).as_string(with_fragment=None)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+SeenSet.py
+
+A compact set of 'already seen' keys for the spider.
+
+Keys (normally URL strings) are reduced to 64-bit hashes.  A Bloom
+filter sits in front of an exact index of those hashes, so the common
+'never seen this one' answer is given without touching the index at
+all.  The exact index lives in memory or, for very large crawls, in a
+dbm file on disk.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import hashlib, math, struct
+
+from PyPlucker.UtilFns import message
+
+
+def key_hash (key):
+    """Return a 64-bit integer hash for the string (or bytes) 'key'.
+    Unlike the builtin hash() this is stable across runs."""
+    if type (key) == str:
+        key = key.encode ('utf-8', 'surrogateescape')
+    return int.from_bytes (hashlib.blake2b (key, digest_size=8).digest (), 'big')
+
+
+class SeenSet:
+
+    """A set of strings which only remembers 64-bit hashes of them.
+
+    Use 'add (key)' and 'key in seenset'.  Two different keys sharing
+    the same 64-bit hash are taken to be the same; with 64 bits that is
+    not going to happen in any crawl of sensible size.
+
+    'capacity' is the number of keys the Bloom filter is sized for at
+    the given 'error_rate'.  More keys can be added, the filter just
+    lets more lookups through to the exact index.  If 'filename' is
+    given, the exact index is kept in a dbm database of that name
+    instead of in memory."""
+
+    def __init__ (self, capacity=100000, error_rate=0.01, filename=None):
+        capacity = max (int (capacity), 1)
+        nbits = int (-capacity * math.log (error_rate) / (math.log (2) ** 2))
+        self._nbits = max (nbits, 64)
+        self._nhashes = max (int (round (self._nbits / capacity * math.log (2))), 1)
+        self._bits = bytearray ((self._nbits + 7) // 8)
+        self._count = 0
+        self._filename = filename
+        if filename is None:
+            self._index = set ()
+        else:
+            import dbm
+            self._index = dbm.open (filename, 'n')
+            message (2, "Keeping seen-set index in %s\n", filename)
+
+
+    def _bit_positions (self, h):
+        # Kirsch/Mitzenmacher double hashing on the two halves of the
+        # 64-bit key hash
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        nbits = self._nbits
+        return [(h1 + i * h2) % nbits for i in range (self._nhashes)]
+
+
+    def add (self, key):
+        """Add 'key'.  Returns 1 if it was new, 0 if it was seen before."""
+        h = key_hash (key)
+        bits = self._bits
+        maybe_seen = 1
+        for pos in self._bit_positions (h):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                maybe_seen = 0
+                bits[pos >> 3] = bits[pos >> 3] | mask
+        if maybe_seen and self._index_contains (h):
+            return 0
+        if self._filename is None:
+            self._index.add (h)
+        else:
+            self._index[struct.pack ('>Q', h)] = b''
+        self._count = self._count + 1
+        return 1
+
+
+    def _index_contains (self, h):
+        if self._filename is None:
+            return h in self._index
+        else:
+            return struct.pack ('>Q', h) in self._index
+
+
+    def __contains__ (self, key):
+        h = key_hash (key)
+        bits = self._bits
+        for pos in self._bit_positions (h):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return 0
+        return self._index_contains (h)
+
+
+    def __len__ (self):
+        return self._count
+
+
+    def close (self):
+        """Release the on-disk index, if any."""
+        if self._filename is not None and self._index is not None:
+            self._index.close ()
+            self._index = None
+
+
+    def __repr__ (self):
+        return "<SeenSet: %d keys, %d bits, %d hashes>" % (self._count, self._nbits, self._nhashes)
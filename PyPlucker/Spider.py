@@ -36,9 +36,10 @@ if __name__ == '__main__':
 
 
 import PyPlucker
-from PyPlucker import Parser, ConfigFiles, __version__
+from PyPlucker import Parser, ConfigFiles, Profiling, Metrics, __version__
 from PyPlucker.Url import URL
 from PyPlucker.AliasList import AliasList
+from PyPlucker.SeenSet import SeenSet, key_hash
 from PyPlucker.UtilFns import message, error, show_exception
 import os, string, sys, types, re
 
@@ -174,6 +175,33 @@ LINK_ATTRIBUTES_TO_IGNORE = (
     "accesskey",
     )
 
+# set versions for fast membership tests
+_VALID_LINK_ATTRIBUTES = frozenset (VALID_LINK_ATTRIBUTES)
+_LINK_ATTRIBUTES_TO_IGNORE = frozenset (LINK_ATTRIBUTES_TO_IGNORE)
+
+
+def create_id_string (attributes):
+    """Return the string identifying a set of link attributes (a
+    dictionary) when forming the mapping keys of the spider.  Internal
+    _plucker_* attributes and attributes in LINK_ATTRIBUTES_TO_IGNORE do
+    not count."""
+    valueslist = []
+    for (key, value) in attributes.items ():
+        if (key[:9] == '_plucker_' or
+            key in _LINK_ATTRIBUTES_TO_IGNORE):
+            continue
+        valueslist.append((key.lower(), value,))
+    valueslist.sort()
+    # Only a 64-bit hash of the attributes goes into the key, which
+    # itself is only kept as a hash (see Spider._collect)
+    return "%016x" % key_hash (str(valueslist))
+
+
+def _intern (value):
+    if type (value) == str:
+        return sys.intern (value)
+    return value
+
 
 _DOTTED_QUAD = re.compile('^\d+\.\d+\.\d+\.\d+$')
 
@@ -210,7 +238,16 @@ class SpiderLink:
     STAYONDOMAIN, STAYONHOST, STAYBELOW, NOIMAGES, etc.)
 
     In some cases we make a distinction, if the link has already been
-    taken or not."""
+    taken or not.
+
+    The string identifying the attributes (see create_id_string) is
+    computed once and cached until the link is changed again, so key
+    building and comparing links is cheap on the spider's hot path."""
+
+    __slots__ = ('_url', '_dict', '_current_depth', '_max_depth',
+                 '_new_max_depth', '_stay_on_domain', '_stay_on_host',
+                 '_stay_below', '_maxwidth', '_maxheight', '_bpp',
+                 '_url_pattern', '_from_image', '_post_data', '_signature')
 
     def __init__ (self, url, dict={}):
         self._url = url
@@ -225,15 +262,16 @@ class SpiderLink:
         self._maxheight = None
         self._bpp = 1
         self._url_pattern = None
-        old = dict.copy()
-        for key in list(old.keys()):
-            if not key in VALID_LINK_ATTRIBUTES:
+        self._signature = None
+        old = {}
+        for (key, value) in dict.items ():
+            if not key in _VALID_LINK_ATTRIBUTES:
                 message(2, "Ignoring invalid link attribute '%s'", key)
-                del old[key]
                 continue
             if (key[:9] == '_plucker_' or
-                key in LINK_ATTRIBUTES_TO_IGNORE):
-                del old[key]
+                key in _LINK_ATTRIBUTES_TO_IGNORE):
+                continue
+            old[sys.intern (key)] = _intern (value)
         self._update_from_dict (old, after_taken=1)
         self._from_image = 0
         self.set_post (None)
@@ -256,12 +294,28 @@ class SpiderLink:
         res = res + ">"
         return res
 
+    def __eq__ (self, other):
+        if not isinstance (other, SpiderLink):
+            return NotImplemented
+        return self.get_signature () == other.get_signature ()
+
+    def __hash__ (self):
+        return hash (self.get_signature ())
+
+    def get_signature (self):
+        """Return the (cached) id string of these attributes, see
+        create_id_string."""
+        if self._signature is None:
+            self._signature = create_id_string (self.as_dict ())
+        return self._signature
+
     def _update_from_dict (self, dict, after_taken):
         """Update private values from link attributes in dict.
         If 'after_taken' is true, means that _max_depth can be altered
         immediately.  Otherwise the new value is stored in the helper
         variable _new_max_depth"""
 
+        self._signature = None
 
         # POST processing
         if 'post' in dict:
@@ -318,7 +372,8 @@ class SpiderLink:
 
 
         # Finally update it compleytely...
-        self._dict.update (dict)
+        for (key, value) in dict.items ():
+            self._dict[sys.intern (key)] = _intern (value)
 
 
     def as_dict (self):
@@ -390,6 +445,7 @@ class SpiderLink:
     def set_post (self, post_data):
         """Set the data for a post operation"""
         self._post_data = post_data
+        self._signature = None
 
 
     def get_maxwidth (self):
@@ -398,6 +454,7 @@ class SpiderLink:
 
     def set_maxwidth (self, value):
         self._maxwidth = value
+        self._signature = None
 
 
     def get_maxheight (self):
@@ -406,6 +463,7 @@ class SpiderLink:
 
     def set_maxheight (self, value):
         self._maxheight = value
+        self._signature = None
 
 
     def get_bpp (self):
@@ -414,25 +472,31 @@ class SpiderLink:
 
     def set_bpp (self, value):
         self._bpp = value
+        self._signature = None
 
 
     def set_current_depth (self, n):
         self._current_depth = n
+        self._signature = None
 
 
     def set_max_depth (self, n):
         self._max_depth = n
+        self._signature = None
 
     def set_stay_on_domain (self, host):
         self._stay_on_domain = get_domain_from_host(host)
+        self._signature = None
 
 
     def set_stay_on_host (self, host):
         self._stay_on_host = host
+        self._signature = None
 
 
     def set_stay_below (self, urlpart):
         self._stay_below = urlpart
+        self._signature = None
 
 
     def check_fetch (self, as_image):
@@ -482,6 +546,7 @@ class SpiderLink:
     def set_from_image(self, n):
         self._from_image = n
         self._dict['_plucker_from_image'] = n
+        self._signature = None
 
 
 class Spider:
@@ -516,17 +581,23 @@ class Spider:
         # for 'user_agent' has been added to self._exclusion_list
         self._robot_list = []
 
-        # _queue contains a list of (URL, attributes, key) pairs to fetch
+        # _queue contains a list of (URL, attributes) pairs to fetch
         self._queue = []
+        # when tracing, _queued_at maps key hashes to the time they were queued
+        self._queued_at = {}
 
-        # _collected contains a mapping of retrieved URLs to PluckerDocs
+        # _collected maps the 64-bit hashes (see SeenSet.key_hash) of
+        # the keys of the retrieved documents (URL, NUL and attribute
+        # signature, see _collect) to (URL, PluckerDoc) pairs
         if collection is None:
             self._collected = {}
         else:
             self._collected = collection
 
-        # _failed contains a mapping of failed retrieval URLs to failure headers
-        self._failed = {}
+        # _failed contains the set of URLs whose retrieval has failed.
+        # Only 64-bit hashes of the URLs are kept, see SeenSet.py
+        self._failed = SeenSet (config.get_int ('seen_capacity', 100000),
+                                filename=config.get_string ('seen_index_file'))
 
         self._exclusion_list = exclusion_list
         if alias_list is None:
@@ -672,21 +743,25 @@ class Spider:
                         self._exclusion_list.add_entry(entry)
 
     def _create_id_string (self, attributes):
-        values = (type(attributes) == dict and list(attributes.items())) or list(attributes.as_dict().items())
-        valueslist = []
-        for value in values:
-            if (value[0][:9] == '_plucker_' or
-                value[0] in LINK_ATTRIBUTES_TO_IGNORE):
-                continue
-            valueslist.append((value[0].lower(), value[1],))
-        valueslist.sort()
-        return str(valueslist)
+        if type(attributes) == dict:
+            return create_id_string (attributes)
+        return attributes.get_signature ()
+
+    def _collect (self, key, url, doc):
+        """Remember 'doc', retrieved from 'url', under 'key'"""
+        self._collected[key_hash (key)] = (url, doc)
+
+    def _collected_doc (self, key):
+        """The document remembered under 'key', or None"""
+        entry = self._collected.get (key_hash (key))
+        return entry and entry[1]
 
     def _needs_processing (self, key, url, attr):
-        if key in self._collected:
+        doc = self._collected_doc (key)
+        if doc is not None:
             # we need to register the already-collected document with the internal plucker keys that
             # are being held by the link under consideration, so that those keys are resolved
-            self._register_document(attr, self._collected[key])
+            self._register_document(attr, doc)
             return 0
         if url in self._failed:
             return 0
@@ -706,18 +781,23 @@ class Spider:
         key = str(url) + '\0' + self._create_id_string(attr)
         # mailto: gets always included
         if (url[:7] == 'mailto:'):
-            self._queue.append ((url, attr, key))
+            self._queue.append ((url, attr))
             return 1
 
         if url[:7] == 'http://' and not self._config.get_bool('ignore_robots'):
-            self._check_robot(url)
+            with Profiling.stage (Profiling.STAGE_ROBOTS, url=url):
+                self._check_robot(url)
 
         if not force and self._exclusion_list:
             if not self._exclusion_list.check (url):
                 message(2, "Excluding '%s'\n" % url)
                 return 0
         if force or self._needs_processing (key, url, attr):
-            self._queue.append ((url, attr, key))
+            self._queue.append ((url, attr))
+            if Profiling.tracing ():
+                h = key_hash (key)
+                if h not in self._queued_at:
+                    self._queued_at[h] = Profiling.trace_timestamp ()
             return 1
         return 0
 
@@ -751,6 +831,8 @@ class Spider:
             self.process (verbose, estimate, statusfile)
 
         message("---- all %d pages retrieved and parsed ----", len(self._collected))
+        message(2, "Failed URLs: %s\n", repr (self._failed))
+        self._failed.close ()
 
         if statusfile:
             statusfile.seek(0)
@@ -816,12 +898,15 @@ class Spider:
                 statusfile.flush()
             # de-queue end of queue
             if self._depth_first:
-                (urltext, attributes, key) = self._queue[-1]
+                (urltext, attributes) = self._queue[-1]
                 del self._queue[-1]
             else:
-                (urltext, attributes, key) = self._queue[0]
+                (urltext, attributes) = self._queue[0]
                 del self._queue[0]
             attribute_dict_string = self._create_id_string(attributes)
+            if self._queued_at:
+                queued = self._queued_at.pop (key_hash (str (urltext) + '\0' + attribute_dict_string), None)
+                Profiling.trace_span (Profiling.STAGE_QUEUED, queued, url=urltext)
             url = URL (urltext)
             if verbose:
                 line_length = self._config.get_int('status_line_length', 60)
@@ -843,10 +928,11 @@ class Spider:
             key = urltext_key + '\0' + attribute_dict_string
             message(3, "checking " + str(key))
             #sys.stderr.write('key is ' + key + '\n')
-            if key in self._collected:
+            doc = self._collected_doc (key)
+            if doc is not None:
                 # already collected
                 message("  Already retrieved and parsed.")
-                self._register_document(attributes, self._collected[key])
+                self._register_document(attributes, doc)
                 return
 
             # not collected, how about failed?
@@ -856,16 +942,25 @@ class Spider:
                 return
 
             # OK, not collected or failed -- so retrieve the contents
-            (header, document) = self._retriever (url, alias_list=self._alias_list, \
-                                                  post_data=post_data)
+            with Profiling.stage (Profiling.STAGE_RETRIEVE, url=url) as stage:
+                (header, document) = self._retriever (url, alias_list=self._alias_list, \
+                                                      post_data=post_data)
+                stage.set_content_type (header.get ('Content-Type'))
             assert 'error code' in header, "Headers from retriever have no error code"
             assert 'URL' in header, "Headers from retriever have no URL"
+            if Profiling.tracing ():
+                Profiling.trace_instant (Profiling.EVENT_FETCHED, url=urltext,
+                                         location=URL (header['URL']).as_string (with_fragment=0),
+                                         error_code=header['error code'],
+                                         content_type=header.get ('Content-Type'),
+                                         bytes=(document and len (document)) or 0)
 
             # Check for successful fetch
             if header['error code'] != 0:
                 # retrieving has failed.
                 # self._failed[urltext_key] = header
-                self._failed[urltext_key] = None
+                self._failed.add (urltext_key)
+                Metrics.count ('fetch_failures')
                 if verbose:
                     if 'error code' in header:
                         code = header['error code']
@@ -887,6 +982,7 @@ class Spider:
                        "Headers from retriever have no Content-Type (%s)" % repr (header)
                 # Fetched OK
                 message("  Retrieved ok.")
+                Metrics.count_fetch (header['Content-Type'], len (document))
                 # "new_url" is the URL the HTTP server sent back to us.
                 new_url = URL (header['URL']).as_string (with_fragment=0)
                 # again, we form the mapping key to see if it's already been processed
@@ -908,9 +1004,10 @@ class Spider:
                 # this URL...
                 if urltext != new_url:
                     key = new_url_key + '\0' + attribute_dict_string
-                    if key in self._collected:
+                    doc = self._collected_doc (key)
+                    if doc is not None:
                         message("  Already retrieved and parsed.")
-                        self._register_document(attributes, self._collected[key])
+                        self._register_document(attributes, doc)
                         return
                     if not self._exclusion_list.check (new_url):
                         message("  Is excluded.")
@@ -921,15 +1018,16 @@ class Spider:
                     filter = self._config.get_string ('filter')
                     if filter is not None:
                         try:
-                            tmpfile = tempfile.mktemp()
-                            f = open(tmpfile, "wb")
-                            f.write(document)
-                            f.close()
+                            with Profiling.stage (Profiling.STAGE_FILTER, header['Content-Type'], new_url):
+                                tmpfile = tempfile.mktemp()
+                                f = open(tmpfile, "wb")
+                                f.write(document)
+                                f.close()
 
-                            command = filter + " " + tmpfile
-                            pipe = os.popen(command)
-                            document = pipe.read()
-                            pipe.close()
+                                command = filter + " " + tmpfile
+                                pipe = os.popen(command)
+                                document = pipe.read()
+                                pipe.close()
 
                         finally:
                             try: os.unlink(tmpfile)
@@ -937,11 +1035,12 @@ class Spider:
 
                 # OK, it's fair game, so we parse it
                 try:
-                    pluckerdoc = self._parser (new_url,
-                                               header,
-                                               document,
-                                               self._config,
-                                               attributes.as_dict())
+                    with Profiling.stage (Profiling.STAGE_PARSE, header['Content-Type'], new_url):
+                        pluckerdoc = self._parser (new_url,
+                                                   header,
+                                                   document,
+                                                   self._config,
+                                                   attributes.as_dict())
                 except:
                     show_exception(2)
                     pluckerdoc = None
@@ -952,26 +1051,26 @@ class Spider:
                     headers = {'error code': -1,
                                'error text': "parsing failed"}
                     # self._failed[new_url_key] = headers
-                    self._failed[new_url_key] = None
+                    self._failed.add (new_url_key)
+                    Metrics.count ('fetch_failures')
                     message("  Parsing failed.")
                     return
 
                 # OK, at this point we have a valid pluckerdoc
-                self._collected[key]=pluckerdoc
+                self._collect (key, new_url_key, pluckerdoc)
                 #sys.stderr.write('logging ' + key + '\n')
                 self._register_document(attributes, pluckerdoc)
                 tables = pluckerdoc.get_tables()
                 for i in range(0, len(tables)):
                     attrs = tables[i].get_attrs()
                     self._register_document(attrs, tables[i])
-                    self._collected[attrs['href']] = tables[i]
+                    self._collect (attrs['href'], attrs['href'], tables[i])
 
                 if pluckerdoc.is_multiimage_document():
                     pieces = pluckerdoc.get_pieces()
                     for (piece_doc, piece_id) in pieces:
                         piece_doc.register_doc(piece_id)
-                        tkey = piece_doc.get_url() + '\0'
-                        self._collected[tkey] = piece_doc
+                        self._collect (piece_doc.get_url() + '\0', piece_doc.get_url(), piece_doc)
 
                 # Now check for some extra processing, depending on the
                 # type of page the URL pointed to
@@ -981,27 +1080,31 @@ class Spider:
                 if pluckerdoc.is_text_document ():
                     (hrefs, imagerefs) = pluckerdoc.get_external_references ()
 
+                    # the links taken, for the link graph in the trace
+                    taken_links = []
+                    taken_images = []
+
                     doc_ref_count = 0
                     for (suburltext, dict) in hrefs:
-                        suburl = URL (suburltext)
-                        suburl.remove_fragment ()
+                        suburl = URL (suburltext).without_fragment ()
                         if suburl.as_string(with_fragment=0)[:17] != "plucker:/~parts~/":
                             # Subparts are not needed for fetching
                             message(3, "  Looking at suburl %s...", str(suburltext))
                             new_attr = attributes.make_child_attributes (suburl, dict, inline=0)
                             if new_attr.check_fetch (as_image = 0):
                                 new_attr.link_taken (dict)
+                                taken_links.append (str (suburl))
                                 if self.add_queue (suburl, new_attr):
                                     doc_ref_count = doc_ref_count + 1
 
                     img_ref_count = 0
                     for (suburltext, dict) in imagerefs:
-                        suburl = URL (suburltext)
-                        suburl.remove_fragment ()
+                        suburl = URL (suburltext).without_fragment ()
                         new_attr = attributes.make_child_attributes (suburl, dict, inline=1)
                         new_attr.set_from_image(1)
                         if new_attr.check_fetch (as_image = 1):
                             new_attr.link_taken (dict)
+                            taken_images.append (str (suburl))
                             if self.add_queue (suburl, new_attr):
                                 img_ref_count = img_ref_count + 1
                             else:
@@ -1009,6 +1112,10 @@ class Spider:
                         else:
                             message(2, "  Not fetching image %s", str (suburl))
 
+                    if Profiling.tracing ():
+                        Profiling.trace_instant (Profiling.EVENT_LINKS, url=new_url,
+                                                 links=taken_links, images=taken_images)
+
                     message ("  Parsed ok%s%s." %
                              (((doc_ref_count > 0 or img_ref_count > 0) and "; ") or "",
                               ("%s%s%s" %
@@ -1029,19 +1136,21 @@ class Spider:
                     for (other_url, other_attributes) in others:
                         message(2, "  Rendering other versions of image %s...\n" % other_url)
                         testkey = other_url + '\0' + self._create_id_string(other_attributes)
-                        if testkey in self._collected:
-                            message(3, "    Reusing already-rendered image version %s.\n" % self._collected[testkey].get_url())
+                        doc = self._collected_doc (testkey)
+                        if doc is not None:
+                            message(3, "    Reusing already-rendered image version %s.\n" % doc.get_url())
                             continue
 
                         message(3, "    Key is " + str(key) + ".\n")
 
                         try:
-                            newdoc = self._parser(other_url,
-                                                  header,
-                                                  document,
-                                                  self._config,
-                                                  other_attributes)
-                            self._collected[testkey] = newdoc
+                            with Profiling.stage (Profiling.STAGE_IMAGE_RENDITION, header['Content-Type'], other_url):
+                                newdoc = self._parser(other_url,
+                                                      header,
+                                                      document,
+                                                      self._config,
+                                                      other_attributes)
+                            self._collect (testkey, other_url, newdoc)
                             self._register_document(other_attributes, newdoc)
                             alternate_count = alternate_count + 1
 
@@ -1049,8 +1158,7 @@ class Spider:
                                 pieces = newdoc.get_pieces()
                                 for (piece_doc, piece_id) in pieces:
                                     piece_doc.register_doc(piece_id)
-                                    tkey = piece_doc.get_url() + '\0'
-                                    self._collected[tkey] = piece_doc
+                                    self._collect (piece_doc.get_url() + '\0', piece_doc.get_url(), piece_doc)
 
                         except:
                             show_exception(2)
@@ -1065,6 +1173,8 @@ class Spider:
                     message ("  Parsed ok.")
 
     def get_collected (self):
+        """The retrieved documents, as a dictionary mapping hashes of
+        their keys to (URL, PluckerDoc) pairs"""
         return self._collected
 
 
@@ -1095,6 +1205,9 @@ def main (config, excl_lists=[]):
     from PyPlucker.ExclusionList import ExclusionList
     import PyPlucker.PluckerDocs
 
+    # no-op if realmain() has already done it
+    config.freeze ()
+
     PyPlucker.PluckerDocs.PluckerTextDocument.seamless_fragments = config.get_bool ('seamless_fragments',1)
     PyPlucker.PluckerDocs.PluckerTextDocument.link_fragments = config.get_bool ('link_fragments',0)
 
@@ -1174,11 +1287,32 @@ def main (config, excl_lists=[]):
             config.set ('zlib_compression', 'false')
     if config.get_bool ('zlib_compression', 0):
         owner_id = config.get_string('owner_id_build')
-        if owner_id:
-            PyPlucker.PluckerDocs.UseZLibCompression (owner_id)
-        else:
-            PyPlucker.PluckerDocs.UseZLibCompression ()
+        level = (config.get_string ('zlib_level') or '-1').lower ()
+        strategy = (config.get_string ('zlib_strategy') or 'default').lower ()
+        try:
+            if level != 'auto':
+                level = int (level)
+            budget = float (config.get_string ('zlib_time_budget') or 100) / 1000.0
+            PyPlucker.PluckerDocs.UseZLibCompression (owner_id, level, strategy, budget)
+        except ValueError as text:
+            error ("Bad zlib settings: %s\n" % text)
+            sys.exit (1)
         message(2, "ZLib compression turned on")
+    elif config.get_bool ('doc_lazy_matching', 0):
+        PyPlucker.PluckerDocs.UseDocCompression (lazy=1)
+        message(2, "DOC compression with lazy matching turned on")
+    compression_cache = None
+    if config.get_string ('compression_cache'):
+        from PyPlucker.CompressionCache import CompressionCache
+        cache_dir = os.path.join (pluckerhome, os.path.expanduser (config.get_string ('compression_cache')))
+        compression_cache = CompressionCache (cache_dir, config.get_int ('compression_cache_size', 64) * 1024 * 1024)
+        PyPlucker.PluckerDocs.UseCompressionCache (compression_cache)
+        message(2, "Using compression cache %s" % cache_dir)
+    if config.get_bool ('compression_predictor', 0):
+        threshold = config.get_int ('compression_predictor_threshold', 0)
+        PyPlucker.PluckerDocs.UseCompressibilityPredictor (
+            PyPlucker.PluckerDocs.CompressibilityPredictor ((threshold and threshold / 100.0) or None))
+        message(2, "Compressibility predictor turned on")
     #
     #  Load the exclusion lists..
     #
@@ -1267,6 +1401,17 @@ def main (config, excl_lists=[]):
                      config=config,
                      alias_list=alias_list)
     spider.process_all(verbose=verbosity)
+    Profiling.memory_snapshot ('after crawl')
+
+    (rule_hits, default_hits, cache_hits, cache_misses) = exclusion_list.get_statistics ()
+    Metrics.count ('exclusion_cache_hits', cache_hits)
+    Metrics.count ('exclusion_cache_misses', cache_misses)
+    if verbosity > 1:
+        message(2, "Exclusion list: %d checks (%d answered from cache), %d by default",
+                cache_hits + cache_misses, cache_hits, default_hits)
+        for (hits, prio, action, regexp) in rule_hits[:10]:
+            if hits:
+                message(2, "  %6d  %d:%s:%s", hits, prio, (action and '+') or '-', regexp)
 
     if spider.encountered_fatal_error ():
         error("Fatal error while processing.  Nothing written.")
@@ -1290,6 +1435,10 @@ def main (config, excl_lists=[]):
         message("Writing document '%s' to file %s" % (doc_name, filename))
 
     mapping = writer.write (verbose=verbosity, alias_list=alias_list)
+    Profiling.memory_snapshot ('after write')
+
+    if compression_cache is not None:
+        compression_cache.evict ()
 
     if verbosity > 2:
         mapping.print_mapping()
@@ -1385,6 +1534,29 @@ def realmain (outputstream, argv=None):
         message(0, "                   for the database.  Allowable options are 'doc', for")
         message(0, "                   Palm DOC compression, or 'zlib', for zlib compression.")
         message(0, "                   Zlib compression is typically better than DOC compression.")
+        message(0, "    --doc-lazy-matching:")
+        message(0, "                   With DOC compression, look one byte ahead for a longer")
+        message(0, "                   match.  Slightly smaller, slightly slower.")
+        message(0, "    --zlib-level=<level>:")
+        message(0, "                   With zlib compression, use <level> from 1 (fastest) to 9")
+        message(0, "                   (smallest), or 'auto' to pick the level for each record from")
+        message(0, "                   the measured gain and the zlib_time_budget (ms per MB).")
+        message(0, "    --zlib-strategy=<name>:")
+        message(0, "                   Use the zlib strategy 'default', 'filtered', 'huffman',")
+        message(0, "                   'rle' or 'fixed'.")
+        message(0, "    --writer-jobs=<n>:")
+        message(0, "                   Dump and compress the records in <n> processes, or in")
+        message(0, "                   one per CPU for 0.  Defaults to 1.")
+        message(0, "    --compression-cache=<dir>:")
+        message(0, "                   Keep compressed records in <dir> and reuse them for records")
+        message(0, "                   which are the same in later builds.  The cache is trimmed to")
+        message(0, "                   compression_cache_size MB (default 64) after each build.")
+        message(0, "    --compression-predictor:")
+        message(0, "                   Compress samples of big image records first and skip compressing")
+        message(0, "                   the records for which these do not shrink.")
+        message(0, "    --sort-urls:")
+        message(0, "                   Number the records in the order of their URLs, so that the")
+        message(0, "                   URL records compress better.")
         message(0, "    --no-urlinfo:  Do not include info about the URLs")
         message(0, "    --category=<category-name1>[;<category-name2>;..;<category-name16>]:")
         message(0, "                   Put <category-name> in the database as the default")
@@ -1472,6 +1644,24 @@ def realmain (outputstream, argv=None):
         message(0, "                   Defaults to None.")
         message(0, "    --no-image-alt:")
         message(0, "                   Don't show alternate text for images.")
+        message(0, "    --trace=<filename>:")
+        message(0, "                   Write a trace of every URL's way through the build to")
+        message(0, "                   <filename> (Chrome trace event format, for chrome://tracing")
+        message(0, "                   or Perfetto)")
+        message(0, "    --memprofile:  Trace memory allocations and report the top allocation")
+        message(0, "                   sites, live PyPlucker objects and peak RSS after crawling,")
+        message(0, "                   mapping, dumping and writing")
+        message(0, "    --metrics=<filename>:")
+        message(0, "                   Write build metrics (pages, bytes, cache hit ratios, stage")
+        message(0, "                   times, compression ratios, document size) as JSON")
+        message(0, "    --metrics-prom=<filename>:")
+        message(0, "                   Write the build metrics for the Prometheus textfile collector")
+        message(0, "    --profile=<mode>[,<mode>]:")
+        message(0, "                   Profile the build.  <mode> is one of:")
+        message(0, "                     cprofile: run under cProfile and dump the statistics")
+        message(0, "                               to plucker-build.prof in the plucker dir")
+        message(0, "                               (or to the file named by 'profile_file')")
+        message(0, "                     stages:   print time spent per stage and content type")
         message(0, "")
         message(0, "Note that you must specify either -f or specify HOMEURL as an argument,")
         message(0, " or specify -c to update a cache.")
@@ -1490,6 +1680,13 @@ def realmain (outputstream, argv=None):
         exclusion_lists = []
         extra_sections = []
         zlib_compression = None
+        doc_lazy_matching = None
+        zlib_level = None
+        zlib_strategy = None
+        writer_jobs = None
+        compression_cache = None
+        compression_predictor = None
+        sort_urls = None
         no_url_info = None
         stayondomain = None
         stayonhost = None
@@ -1521,6 +1718,11 @@ def realmain (outputstream, argv=None):
         http_proxy_pass = None
         creator_id = None
         no_image_alt = None
+        profile = None
+        trace_file = None
+        metrics_file = None
+        metrics_prom_file = None
+        memprofile = None
 
         (opts, args) = getopt.getopt(argv[1:], "f:chqvV:p:P:H:E:M:N:s:", \
                                      [  "db-file=", "doc-file=", "help",
@@ -1529,6 +1731,10 @@ def realmain (outputstream, argv=None):
                                         "maxdepth=", "db-name=", "doc-name=",
                                         "extra-section=", "verbosity=",
                                         "zlib-compression", "doc-compression",
+                                        "doc-lazy-matching", "zlib-level=",
+                                        "zlib-strategy=", "writer-jobs=",
+                                        "compression-cache=", "compression-predictor",
+                                        "sort-urls",
                                         "no-urlinfo", "stayondomain",
                                         "stayonhost", "staybelow=", "category=",
                                         "maxheight=", "maxwidth=",
@@ -1544,7 +1750,8 @@ def realmain (outputstream, argv=None):
                                         "tables", "depth-first", "http-proxy=",
                                         "http-proxy-user=", "http-proxy-pass=",
                                         "fragments=", "creator-id=", "filter=",
-                                        "bookmarks=", "no-image-alt"])
+                                        "bookmarks=", "no-image-alt", "profile=", "trace=",
+                                        "metrics=", "metrics-prom=", "memprofile"])
         if args:
             # usage ("Only options are allowed as arguments.")
             if len(args) > 1:
@@ -1621,6 +1828,20 @@ def realmain (outputstream, argv=None):
                 zlib_compression = 'true'
             elif opt == "--doc-compression":
                 zlib_compression = 'false'
+            elif opt == "--doc-lazy-matching":
+                doc_lazy_matching = 'true'
+            elif opt == "--zlib-level":
+                zlib_level = arg
+            elif opt == "--zlib-strategy":
+                zlib_strategy = arg
+            elif opt == "--writer-jobs":
+                writer_jobs = arg
+            elif opt == "--compression-cache":
+                compression_cache = arg
+            elif opt == "--compression-predictor":
+                compression_predictor = 'true'
+            elif opt == "--sort-urls":
+                sort_urls = 'true'
             elif opt == "--compression" and arg == "doc":
                 zlib_compression = 'false'
             elif opt == "--compression" and arg == "zlib":
@@ -1705,6 +1926,16 @@ def realmain (outputstream, argv=None):
                     bookmark_pages   = 'false'
             elif opt == "--no-image-alt":
                 no_image_alt = 1
+            elif opt == "--profile":
+                profile = arg
+            elif opt == "--trace":
+                trace_file = arg
+            elif opt == "--memprofile":
+                memprofile = 1
+            elif opt == "--metrics":
+                metrics_file = arg
+            elif opt == "--metrics-prom":
+                metrics_prom_file = arg
             else:
                 usage ("Error:  Unknown option '%s'" % opt)
     except getopt.error as text:
@@ -1823,6 +2054,20 @@ def realmain (outputstream, argv=None):
         config.set ('home_url', home_url)
     if zlib_compression:
         config.set ('zlib_compression', zlib_compression)
+    if doc_lazy_matching:
+        config.set ('doc_lazy_matching', doc_lazy_matching)
+    if zlib_level is not None:
+        config.set ('zlib_level', zlib_level)
+    if zlib_strategy is not None:
+        config.set ('zlib_strategy', zlib_strategy)
+    if writer_jobs is not None:
+        config.set ('writer_jobs', writer_jobs)
+    if compression_cache is not None:
+        config.set ('compression_cache', compression_cache)
+    if compression_predictor:
+        config.set ('compression_predictor', compression_predictor)
+    if sort_urls:
+        config.set ('sort_urls', sort_urls)
     if no_url_info:
         config.set ('no_urlinfo', no_url_info)
     if seamless_fragments:
@@ -1892,13 +2137,64 @@ def realmain (outputstream, argv=None):
         config.set ('bookmark_pages', bookmark_pages)
     if no_image_alt is not None:
         config.set ('no_image_alt', 1)
+    if profile is not None:
+        config.set ('profile', profile)
+    if trace_file is not None:
+        config.set ('trace_file', trace_file)
+    if memprofile is not None:
+        config.set ('memprofile', memprofile)
+    if metrics_file is not None:
+        config.set ('metrics_file', metrics_file)
+    if metrics_prom_file is not None:
+        config.set ('metrics_prom_file', metrics_prom_file)
+
+    profile_modes = []
+    if config.get_string ('profile'):
+        profile_modes = config.get_string ('profile').split (',')
+    for mode in profile_modes:
+        if mode not in ('cprofile', 'stages'):
+            usage ("Unknown profile mode '%s'" % mode)
+
+    # all options are known now
+    try:
+        config.freeze ()
+    except ValueError as text:
+        usage (text)
 
     for i in range (len (exclusion_lists)):
         exclusion_lists[i] = os.path.join (pluckerdir, exclusion_lists[i])
 
     execute_commands ("before_command", config)
 
-    retval = main (config, exclusion_lists)
+    if 'stages' in profile_modes:
+        Profiling.enable_stages ()
+    if config.get_string ('trace_file'):
+        Profiling.enable_trace (config.get_string ('trace_file'))
+    metrics_file = config.get_string ('metrics_file')
+    metrics_prom_file = config.get_string ('metrics_prom_file')
+    if metrics_file or metrics_prom_file:
+        Metrics.enable_metrics ()
+    if config.get_bool ('memprofile'):
+        Profiling.enable_memprofile (config.get_int ('memprofile_frames', 1))
+    try:
+        if 'cprofile' in profile_modes:
+            profile_file = config.get_string ('profile_file',
+                                              os.path.join (pluckerdir, 'plucker-build.prof'))
+            retval = Profiling.run_profiled (main, (config, exclusion_lists), profile_file)
+        else:
+            retval = main (config, exclusion_lists)
+    finally:
+        Profiling.write_trace ()
+    if 'stages' in profile_modes:
+        Profiling.report_stages ()
+    if config.get_bool ('memprofile'):
+        Profiling.report_memory (config.get_int ('memprofile_top', 10))
+        Metrics.set_value ('peak_rss_bytes', Profiling.peak_rss ())
+    if metrics_file or metrics_prom_file:
+        Metrics.set_value ('exit_code', retval)
+        channel = config.get_string ('doc_name') or config.get_string ('doc_file') \
+                  or config.get_string ('home_url', 'plucker:/home.html')
+        Metrics.write_metrics (metrics_file, metrics_prom_file, {'channel': channel})
 
     execute_commands ("after_command", config)
 
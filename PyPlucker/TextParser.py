@@ -1997,7 +1997,7 @@ class StructuredHTMLParser (sgmllib.SGMLParser):
         if 'size' in attributes:
             # DRS - we convert to float, round up/down as we convert to int
             try:
-                height = int(attributes['size'].atof() + 0.5)
+                height = int(float(attributes['size']) + 0.5)
             except ValueError:
                 pass # use default
         if 'color' in attributes:
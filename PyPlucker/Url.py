@@ -14,6 +14,7 @@ Distributable under the GNU General Public License Version 2 or newer.
 """
 
 import urllib.parse, urllib.request, urllib.parse, urllib.error, string, sys, os
+import functools
 
 urllib.parse.uses_relative.append ('plucker')
 #urlparse.uses_netloc.append ('plucker')
@@ -117,45 +118,91 @@ def plucker_file_urlunparse(protocol, host, path, params, query, fragment):
 
 
 
+# Number of (url, base) pairs whose parsed form is remembered
+_PARSE_CACHE_SIZE = 8192
+
+@functools.lru_cache (maxsize=_PARSE_CACHE_SIZE)
+def _parse_url (url, base):
+    """Join 'url' (a string) with 'base' (a string or None) and split
+    the result into its (interned) components.  The results are cached
+    for the whole process."""
+    # Sometimes an URL is interrupted by a line break.
+    # Fetching works better if the linebreak is removed.
+    url = url.replace("\r", "")
+    url = url.replace("\n", "")
+    if base is not None:
+        if sys.platform == 'win32' and base[0:5].lower() == 'file:':
+            url = windows_file_urljoin (base, url)
+        else:
+            url = urllib.parse.urljoin (base, url)
+    # according to RFC 2396, this 'unquote' is inappropriate
+    # according to the HTML 4.01 spec, this 'unquote' is unnecessary
+    # url = urllib.unquote (url)
+    if sys.platform == 'win32' and url[0:5].lower() == 'file:':
+        (prot, host, path, params, query, fragment) = windows_file_url_parse (url)
+    else:
+        (prot, host, path, params, query, fragment) = urllib.parse.urlparse (url)
+    host = host.lower()
+    return (sys.intern (prot), sys.intern (host), path, params, query, fragment)
+
+
+
 class URL:
-    """Encapsulate some useful things from urllib and urlparse"""
+    """Encapsulate some useful things from urllib and urlparse
+
+    URL objects are immutable and can be compared and used as
+    dictionary keys.  Parsing goes through a process wide cache, so
+    creating the same URL again is cheap."""
+
+    __slots__ = ('_protocol', '_host', '_path', '_params', '_query',
+                 '_fragment', '_strings')
 
     def __init__ (self, url, base = None):
         if isinstance (url, URL) and base is None:
             # Simple copy constructor: make it more efficient
-            self._protocol = url._protocol
-            self._host = url._host
-            self._path = url._path
-            self._params = url._params
-            self._query = url._query
-            self._fragment = url._fragment
+            parts = (url._protocol, url._host, url._path,
+                     url._params, url._query, url._fragment)
         else:
-            url = str (url)
-            # Sometimes an URL is interrupted by a line break.
-            # Fetching works better if the linebreak is removed.
-            url = url.replace("\r", "")
-            url = url.replace("\n", "")
             if base is not None:
-                if sys.platform == 'win32' and str(base)[0:5].lower() == 'file:':
-                    url = windows_file_urljoin (str (base), url)
-                else:
-                    url = urllib.parse.urljoin (str (base), url)
-            # according to RFC 2396, this 'unquote' is inappropriate
-            # according to the HTML 4.01 spec, this 'unquote' is unnecessary
-            # url = urllib.unquote (url)
-            if sys.platform == 'win32' and url[0:5].lower() == 'file:':
-                (prot, host, path, params, query, fragment) = windows_file_url_parse (url)
-            else:
-                (prot, host, path, params, query, fragment) = urllib.parse.urlparse (url)
-            host = host.lower()
-            self._protocol = prot
-            self._host = host
-            self._path = path
-            self._params = params
-            self._query = query
-            self._fragment = fragment
+                base = str (base)
+            parts = _parse_url (str (url), base)
+        self._set_parts (parts)
+
+    def _set_parts (self, parts):
+        setter = object.__setattr__
+        (prot, host, path, params, query, fragment) = parts
+        setter (self, '_protocol', prot)
+        setter (self, '_host', host)
+        setter (self, '_path', path)
+        setter (self, '_params', params)
+        setter (self, '_query', query)
+        setter (self, '_fragment', fragment)
+        # as_string() results, filled in when needed
+        setter (self, '_strings', [None, None])
+
+    def __setattr__ (self, name, value):
+        raise AttributeError ("URL objects are immutable")
+
+    def __reduce__ (self):
+        return (_url_from_parts, (self._parts (),))
+
+    def _parts (self):
+        return (self._protocol, self._host, self._path,
+                self._params, self._query, self._fragment)
+
+    def __eq__ (self, other):
+        if not isinstance (other, URL):
+            return NotImplemented
+        return self._parts () == other._parts ()
+
+    def __hash__ (self):
+        return hash (self._parts ())
 
     def as_string (self, with_fragment):
+        with_fragment = with_fragment and 1 or 0
+        text = self._strings[with_fragment]
+        if text is not None:
+            return text
         if with_fragment:
             fragment = self._fragment
         else:
@@ -174,6 +221,7 @@ class URL:
                                          self._params,
                                          self._query,
                                          fragment))
+        self._strings[with_fragment] = text
         return text
 
 
@@ -216,8 +264,19 @@ class URL:
                                          fragment))
         return text
 
-    def remove_fragment (self):
-        self._fragment = ""
+    def without_fragment (self):
+        """Return this URL without its fragment part"""
+        if not self._fragment:
+            return self
+        return _url_from_parts ((self._protocol, self._host, self._path,
+                                 self._params, self._query, ""))
+
+
+
+def _url_from_parts (parts):
+    url = URL.__new__ (URL)
+    url._set_parts (parts)
+    return url
 
 
 
@@ -308,7 +367,7 @@ def CompareURL (rawurl1, rawurl2):
              return string_compare(rawurl1,rawurl2)
          else:
              # Compare the strings using /'s instead of \'s.
-             return string_compare(splitup1.join(),splitup2.join())
+             return string_compare('\0'.join(splitup1),'\0'.join(splitup2))
      name1 = splitup1[0]
      name2 = splitup2[0]
      i=0
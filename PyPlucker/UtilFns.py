@@ -46,15 +46,18 @@ def message(*args):
         verbosity_level = 1
     if not type(args[0]) == type(''):
         raise ValueError("call to 'message' with no format argument -- " + str(args[0]) + " found instead")
+    if verbosity_level > CurrentVerbosityLevel:
+        # don't format what nobody will see; the debug messages of
+        # the parser print whole element stacks
+        return
     if len(args) > 1:
         actual_message = args[0] % args[1:]
     else:
         actual_message = args[0]
     if len(actual_message) < 1 or actual_message[-1] != '\n':
         actual_message = actual_message + '\n'
-    if verbosity_level <= CurrentVerbosityLevel:
-        MessageStream.write(actual_message)
-        MessageStream.flush()
+    MessageStream.write(actual_message)
+    MessageStream.flush()
 
 
 def error(*args):
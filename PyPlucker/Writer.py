@@ -16,8 +16,9 @@ Distributable under the GNU General Public License Version 2 or newer.
 
 
 import os, struct, string, time, PyPlucker.helper.PQAAppInfo, sys, urllib.request, urllib.parse, urllib.error, functools
+import multiprocessing, heapq
 import PyPlucker
-from PyPlucker import Url, PluckerDocs
+from PyPlucker import Url, PluckerDocs, Profiling, Metrics
 #from PyPlucker.helper import dict
 from PyPlucker.helper import prc
 from PyPlucker.helper.CharsetMapping import charset_mibenum_to_name, charset_name_to_mibenum
@@ -33,9 +34,16 @@ class Mapper:
      all the URLs in record-ID order, with zero-length URLs for unused record-IDs.  It
      contains a method "print_mapping" which sends a display of the mapping to stderr.
      Finally, it contains a method "get_or_add", which takes either a URL or a PluckerDocument
-     instance, and returns its record-ID."""
+     instance, and returns its record-ID.
 
-     def __init__ (self, collection, alias_list):
+     'collection' is the document map of the spider (see Spider.get_collected): a dictionary
+     whose values are (URL, PluckerDocument) pairs.
+
+     With 'sort_urls' true, the documents get their record-IDs in the order of their URLs
+     (see Url.CompareURL), so that neighbouring entries of the URL records share prefixes
+     and compress better."""
+
+     def __init__ (self, collection, alias_list, sort_urls=0):
 
         # maintains a mapping of URLs to PluckerDocs.PluckerDocument instances.
         # Keys are either a string URL, in which case the value is just a single instance,
@@ -43,8 +51,7 @@ class Mapper:
 
         self._url_to_doc_mapping = {}
         temp_list = []
-        for (key, doc) in list(collection.items()):
-            url = key.split('\0')[0]
+        for (url, doc) in list(collection.values()):
             self._url_to_doc_mapping[url] = doc
             # record internal URL name, as well
             if isinstance(doc, PluckerDocs.PluckerDocument):
@@ -60,11 +67,11 @@ class Mapper:
             if name_mapping:
                 for (name, (internalurl, paragraph_number)) in list(name_mapping.items()):
                     internalurl = alias_list.get(internalurl, internalurl)
-                    temp_list.append((key, url, name, internalurl, paragraph_number,))
-        for (key, url, name, internalurl, paragraph_number) in temp_list:
+                    temp_list.append((url, name, internalurl, paragraph_number,))
+        for (url, name, internalurl, paragraph_number) in temp_list:
             doc = self._url_to_doc_mapping.get(internalurl)
             if not doc:
-                sys.stderr.write("***** Can't find doc for URL " + str((key, url, internalurl, paragraph_number,)) + '\n')
+                sys.stderr.write("***** Can't find doc for URL " + str((url, internalurl, paragraph_number,)) + '\n')
             else:
                 self._url_to_doc_mapping[(url, name)] = (doc, paragraph_number)
 
@@ -105,8 +112,9 @@ class Mapper:
                 self._get_id_for_doc(doc)
 
         # finally, make sure each doc has an ID assigned
-        sorted_list=list(collection.items())
-        # TODO: fix sorted_list.sort(key=lambda x, y: CompareURL(x[0],y[0]))
+        sorted_list=list(collection.values())
+        if sort_urls:
+            sorted_list.sort(key=functools.cmp_to_key(lambda x, y: CompareURL(x[0],y[0])))
 
         for (url, doc) in sorted_list:
             parts = doc.get_documents()
@@ -262,10 +270,35 @@ class Mapper:
 
 
 
+# The writer and the (document, url, id) list dumped by worker
+# processes.  They are set before the workers are forked, so they
+# inherit them instead of getting them pickled.
+_dump_writer = None
+_dump_jobs = []
+
+def _dump_job (index):
+    """Dump _dump_jobs[index] in a worker process.  Returns the dumps
+    together with the stage times and metrics they caused."""
+    (pluckerdoc, url, id) = _dump_jobs[index]
+    dumps = _dump_writer._dump_doc (pluckerdoc, url, id)
+    return (dumps, Profiling.take_stage_times (), Metrics.take_counts ())
+
+def _start_dump_worker ():
+    # forget what the parent had counted before the fork
+    Profiling.take_stage_times ()
+    Metrics.take_counts ()
+
+
 class Writer:
     """Abstract base class from which to derive the various writers
     for documents"""
 
+    # A Writer whose save_data() does not need all the records at once
+    # sets this: every record is then saved as soon as it and all the
+    # records with lower ids are dumped, instead of all of them being
+    # kept in memory until the end.  begin_records() is called first.
+    streaming = 0
+
     def __init__ (self, collection, config, urlmapper=None):
         self._collection = collection
         self._config = config
@@ -279,34 +312,109 @@ class Writer:
         raise NotImplementedError("PyPlucker.Writer.Writer.save_doc()")
 
 
-    def _write_doc (self, out_dict, pluckerdoc, url, id, verbose):
+    def begin_records (self, ids):
+        """Called by write() of a streaming Writer with the ids of all
+        the records, in the order they will be saved."""
+        pass
 
-        def _print_convert_msg (url, id, verbose, config):
-            if verbose > 1:
-                line_length = config.get_int('status_line_length', 60)
-                urltext = str (url)
-                if len (urltext) > line_length:
-                    urltext = urltext[:line_length - 20] + "....." + urltext[-15:]
-                message("Converted %4d:  %s" % (id, urltext))
 
+    def _dump_doc (self, pluckerdoc, url, id):
+        """Dump (and compress) the records of 'pluckerdoc'.  Returns a
+        list of (url, id, data), more than one for split documents."""
         if id != self._mapper.get_or_add(pluckerdoc):
             raise ValueError("bad id %d instead of %d" % (id, self._mapper.get_or_add(pluckerdoc)))
         if pluckerdoc.is_text_document ():
-            dumps = pluckerdoc.dump_record_with_splits (self._mapper)
+            with Profiling.stage (Profiling.STAGE_DUMP, url=url):
+                dumps = pluckerdoc.dump_record_with_splits (self._mapper)
             # sys.stderr.write("dumps is %s\n" % str(map(lambda p: (p[0], p[1]), dumps)))
             if dumps[0][1] != id:
                 message("****** bad id %d instead of %d" % (dumps[0][1], id,))
-            for dump in dumps:
-                (the_url, the_id, dump) = dump
+            result = []
+            for (the_url, the_id, dump) in dumps:
                 if the_id == 0:
                     the_id = id # original
+                result.append ((the_url, the_id, dump))
+            return result
+        else:
+            with Profiling.stage (Profiling.STAGE_DUMP, url=url):
+                dump = pluckerdoc.dump_record (id)
+            return [(url, id, dump)]
+
+
+    def _job_record_ids (self, pluckerdoc, id):
+        """The ids of the records _dump_doc() makes of 'pluckerdoc'"""
+        if pluckerdoc.is_text_document ():
+            return [self._mapper.get_or_add (doc) for doc in pluckerdoc.get_documents ()]
+        return [id]
+
+
+    def _save_pending (self, verbose):
+        """Save the pending records which are next in order of ids.
+        The parts of a split document mostly have the ids following
+        that of the document, but not always (those of the home
+        document, id 2, start at 11); they wait here until the records
+        before them are saved."""
+        while self._pending and self._next_record < len (self._record_ids) and \
+                  self._pending[0][0] == self._record_ids[self._next_record]:
+            (the_id, the_url, dump) = heapq.heappop (self._pending)
+            with Profiling.stage (Profiling.STAGE_WRITE, url=the_url):
+                self.save_data (dump, the_url, the_id, verbose)
+            self._next_record = self._next_record + 1
+
+
+    def _store_dumps (self, out_dict, dumps, verbose):
+        for (the_url, the_id, dump) in dumps:
+            if self.streaming:
+                heapq.heappush (self._pending, (the_id, the_url, dump))
+                # only the size is needed later
+                out_dict [the_id] = (len (dump), the_url, the_id, verbose)
+            else:
                 out_dict [the_id] = (dump, the_url, the_id, verbose)
-                _print_convert_msg(the_url, the_id, verbose, self._config)
-            return
+            if verbose > 1:
+                line_length = self._config.get_int('status_line_length', 60)
+                urltext = str (the_url)
+                if len (urltext) > line_length:
+                    urltext = urltext[:line_length - 20] + "....." + urltext[-15:]
+                message("Converted %4d:  %s" % (the_id, urltext))
+        if self.streaming:
+            self._save_pending (verbose)
+
+
+    def _dump_docs (self, jobs, processes):
+        """Dump the (document, url, id) in 'jobs', in 'processes'
+        worker processes if more than one.  Yields the dumps of each
+        (see _dump_doc), in the order of 'jobs'."""
+        if processes > 1 and len (jobs) > 1:
+            for dumps in self._dump_docs_in_workers (jobs, min (processes, len (jobs))):
+                yield dumps
         else:
-            dump = pluckerdoc.dump_record (id)
-            out_dict [id] = (dump, url, id, verbose)
-            _print_convert_msg(url, id, verbose, self._config)
+            for (pluckerdoc, url, id) in jobs:
+                yield self._dump_doc (pluckerdoc, url, id)
+
+
+    def _dump_docs_in_workers (self, jobs, processes):
+        """Dump the (document, url, id) in 'jobs' in 'processes' worker
+        processes, yielding the dumps of each in order.  All ids must
+        have been resolved already, as ids the workers would add to the
+        mapper are lost."""
+        global _dump_writer, _dump_jobs
+        _dump_writer = self
+        _dump_jobs = jobs
+        try:
+            # fork, so that the workers share the documents and the
+            # mapper with us, and use the same compression settings
+            pool = multiprocessing.get_context ('fork').Pool (processes, _start_dump_worker)
+            try:
+                chunksize = max (1, len (jobs) // (processes * 8))
+                for (dumps, stage_times, counts) in pool.imap (_dump_job, range (len (jobs)), chunksize):
+                    Profiling.merge_stage_times (stage_times)
+                    Metrics.merge_counts (counts)
+                    yield dumps
+            finally:
+                pool.terminate ()
+        finally:
+            _dump_writer = None
+            _dump_jobs = []
 
 
     def write (self, verbose, alias_list=None):
@@ -321,7 +429,10 @@ class Writer:
                     urltext = urltext[:line_length - 20] + "....." + urltext[-15:]
                 message("Converting %s..." % urltext)
 
-        self._mapper = Mapper(self._collection, alias_list.as_dict())
+        with Profiling.stage (Profiling.STAGE_ID_MAPPING):
+            self._mapper = Mapper(self._collection, alias_list.as_dict(),
+                                  self._config.get_bool ('sort_urls', 0))
+        Profiling.memory_snapshot ('after mapper')
 
         # figure default charset
         mibenum = None
@@ -330,17 +441,28 @@ class Writer:
         if verbose > 2:
             self._mapper.print_mapping()
 
+        # the documents are only dumped once the loop below has
+        # resolved the ids of all of them, so that they can be dumped in
+        # worker processes and in order of their ids
+        processes = self._config.get_int ('writer_jobs', 1)
+        if processes == 0:
+            processes = os.cpu_count () or 1
+        if processes > 1 and 'fork' not in multiprocessing.get_all_start_methods ():
+            message(2, "No fork() on this platform, writing with one job")
+            processes = 1
+        jobs = []
+
         out_dict = {}
         bookmarks = {}
         for pluckerdoc in self._mapper.get_docs():
             id = self._mapper.get_or_add(pluckerdoc)
             _print_convert_msg(pluckerdoc.get_url(), verbose, self._config)
-            if pluckerdoc.is_multiimage_document ():
-                pluckerdoc.resolve_ids (self._mapper)
-            if pluckerdoc.is_table_document ():
-                pluckerdoc.resolve_ids (self._mapper)
+            if (pluckerdoc.is_multiimage_document () or
+                pluckerdoc.is_table_document () or
+                pluckerdoc.is_text_document ()):
+                with Profiling.stage (Profiling.STAGE_ID_MAPPING):
+                    pluckerdoc.resolve_ids (self._mapper)
             if pluckerdoc.is_text_document ():
-                pluckerdoc.resolve_ids (self._mapper)
 
                 charset_name = pluckerdoc.get_charset()
                 doc_mibenum = charset_name_to_mibenum(charset_name)
@@ -372,10 +494,10 @@ class Writer:
                         if key not in bookmarks:
                             bookmarks[key] = tmp_book[key]
 
-            self._write_doc (out_dict, pluckerdoc, pluckerdoc.get_url(), id, verbose)
+            jobs.append ((pluckerdoc, pluckerdoc.get_url(), id))
 
         ## Do some error checking
-        if 2 not in out_dict:
+        if 2 not in [id for (pluckerdoc, url, id) in jobs]:
             raise RuntimeError("The collection process failed to generate a 'home' document")
 
         ## set up the metadata mapping, if any
@@ -420,13 +542,13 @@ class Writer:
         ## write the index record
         tmp_url = "plucker:/~special~/index"
         type = PluckerDocs.PluckerIndexDocument (tmp_url, self._config, metadata, bookmarks)
-        self._write_doc (out_dict, type, tmp_url, 1, verbose)
+        jobs.append ((type, tmp_url, 1))
 
         ## write the bookmark record (if any)
         if len(bookmarks):
             tmp_url = "plucker:/~special~/bookmarks"
             bookdoc = PluckerDocs.PluckerBookmarkDocument(tmp_url, bookmarks)
-            self._write_doc (out_dict, bookdoc, tmp_url, 6, verbose)
+            jobs.append ((bookdoc, tmp_url, 6))
 
         ## write the URL information, if desired
         if not self._config.get_bool ('no_urlinfo', 0):
@@ -444,29 +566,61 @@ class Writer:
             indexdoc = PluckerDocs.PluckerLinkIndexDocument(tmp_url, linksdocs, self._mapper)
             self._mapper.get_or_add(indexdoc)
             # OK, write the links index document
-            self._write_doc (out_dict, indexdoc, tmp_url, 3, verbose)
+            jobs.append ((indexdoc, tmp_url, 3))
             # and write the various links documents
             for doc in linksdocs:
-                self._write_doc (out_dict, doc, doc.get_url(), self._mapper.get_or_add(doc), verbose)
+                jobs.append ((doc, doc.get_url(), self._mapper.get_or_add(doc)))
 
         ## write the category information, if present
         if self._config.get_string ('category') is not None:
             tmp_url = "plucker:/~special~/category"
             type = PluckerDocs.PluckerCategoryDocument (tmp_url, self._config)
-            self._write_doc (out_dict, type, tmp_url, 4, verbose)
+            jobs.append ((type, tmp_url, 4))
 
         ## write the metadata record, if any
         if metadata:
             tmp_url = "plucker:/~special~/metadata"
             type = PluckerDocs.PluckerMetadataDocument (tmp_url, metadata)
-            self._write_doc (out_dict, type, tmp_url, 5, verbose)
+            jobs.append ((type, tmp_url, 5))
+
+        ## the parts of split documents are in the collection as well,
+        ## but they are dumped with the document they were split from
+        parts = {}
+        for (pluckerdoc, url, id) in jobs:
+            for part_id in self._job_record_ids (pluckerdoc, id)[1:]:
+                parts[part_id] = 1
+        jobs = [job for job in jobs if job[2] not in parts]
+
+        ## dump everything, in order of the ids
+        jobs.sort (key=lambda job: job[2])
+        if self.streaming:
+            self._record_ids = []
+            for (pluckerdoc, url, id) in jobs:
+                self._record_ids.extend (self._job_record_ids (pluckerdoc, id))
+            self._record_ids.sort ()
+            self._next_record = 0
+            self._pending = []
+            self.begin_records (self._record_ids)
+        for dumps in self._dump_docs (jobs, processes):
+            self._store_dumps (out_dict, dumps, verbose)
+        if self.streaming and self._next_record < len (self._record_ids):
+            raise RuntimeError("Record %d was never dumped" % self._record_ids[self._next_record])
+
+        Profiling.memory_snapshot ('after dumping')
 
         ## now write everything else
         the_ids = list(out_dict.keys ())
         the_ids.sort ()  # they are numeric, so sort does the right thing
         for id in the_ids:
             dump, the_url, the_id, verbose = out_dict[id]
-            self.save_data (dump, the_url, the_id, verbose)
+            if self.streaming:
+                size = dump
+            else:
+                with Profiling.stage (Profiling.STAGE_WRITE, url=the_url):
+                    self.save_data (dump, the_url, the_id, verbose)
+                size = len (dump)
+            Metrics.count ('records_written')
+            Metrics.count ('bytes_out', size)
             if verbose:
                 line_length = self._config.get_int('status_line_length', 60)
                 urltext = str (the_url)
@@ -482,6 +636,8 @@ class CacheWriter (Writer):
     """A Writer that writes the traditional format of a separate files
     in a cache directory"""
 
+    streaming = 1
+
     def __init__ (self, collection, config, cachedir):
         Writer.__init__ (self, collection, config)
         self._cachedir = cachedir
@@ -516,7 +672,10 @@ class CacheWriter (Writer):
 
 class PDBWriter (Writer):
     """A Writer that writes the items into a ready-to-synch PDB
-    file."""
+    file.  The records go to the file as they are dumped, or through a
+    spool file when writing to stdout (see prc.StreamFile)."""
+
+    streaming = 1
 
     def __init__ (self, collection, config, name, version, filename):
         Writer.__init__ (self, collection, config)
@@ -541,9 +700,9 @@ class PDBWriter (Writer):
             if sys.platform == "win32":
                 import msvcrt
                 msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-            self._pdb_file = prc.File (sys.stdout, read=0, write=1)
+            self._pdb_file = prc.StreamFile (sys.stdout.buffer)
         else:
-            self._pdb_file = prc.File (self._filename, read=0, write=1)
+            self._pdb_file = prc.StreamFile (self._filename)
         info = self._pdb_file.getDBInfo ()
         info['name'] = self._dbname
         info['version'] = self._dbversion
@@ -566,12 +725,24 @@ class PDBWriter (Writer):
         self._pdb_file.setDBInfo (info)
 
         # Now call the super class to do the actual work
-        result = Writer.write (self, verbose, alias_list=alias_list)
-
-        self._pdb_file.close ()
+        try:
+            result = Writer.write (self, verbose, alias_list=alias_list)
+        except:
+            # do not leave a half written file behind
+            self._pdb_file.discard ()
+            raise
+
+        with Profiling.stage (Profiling.STAGE_WRITE):
+            self._pdb_file.close ()
+        if self._filename != '<stdout>':
+            Metrics.set_value ('pdb_bytes', os.path.getsize (self._filename))
         return result
 
 
+    def begin_records (self, ids):
+        self._pdb_file.reserve (ids)
+
+
     def save_data (self, data, url, id, verbose):
         assert self._pdb_file is not None, "write_doc called with unintialized pdb file"
 
@@ -33,10 +33,128 @@ __version__ = '$Id: doc_compress.py,v 1.9 2007/08/28 13:59:14 desrod Exp $'
 __copyright__ = 'Copyright 1999 Rob Tillotson <robt@debian.org>'
 
 
+from bisect import bisect_left
+from itertools import islice
+
 COUNT_BITS = 3
 DISP_BITS = 11
 
-def compress(s):
+def _index(s):
+    # positions of every 3-byte string in s, in ascending order
+    keys = list(zip(s, s[1:], s[2:]))
+    table = {}
+    get = table.get
+    p = 0
+    for k in keys:
+        lst = get(k)
+        if lst is None: table[k] = [p]
+        else: lst.append(p)
+        p = p + 1
+    return keys, table
+
+def _longest_match(s, i, imax, keys, table):
+    # Returns (length, position) of the longest string at i that also
+    # occurs, in full, in the 2047 bytes before i; the leftmost one if
+    # there are several.  This is exactly what the s.find() loop in
+    # compress_reference() finds: the first candidate in the window is
+    # the leftmost 3-byte match, and further on only candidates
+    # which are longer than the best so far are of interest.
+    lst = table[keys[i]]
+    if lst[0] > i - 3:
+        return (0, 0)
+    if i > 2047: j = bisect_left(lst, i - 2047)
+    else: j = 0
+    pos = lst[j]
+    if pos > i - 3:
+        return (0, 0)
+    e = 3
+    maxlen = imax - i
+    if maxlen > 10: maxlen = 10
+    if maxlen > 3:
+        ts = s[i:i+maxlen]
+        # in runs and repeated rows the leftmost candidate usually
+        # matches in full already
+        if pos + maxlen <= i and s[pos:pos+maxlen] == ts:
+            return (maxlen, pos)
+        for p in islice(lst, j, None):
+            lim = i - p
+            if lim <= e: break          # the match may not overlap i
+            if s[p+e] != ts[e] or (e > 3 and s[p+3:p+e] != ts[3:e]): continue
+            if lim > maxlen: lim = maxlen
+            l = e + 1
+            while l < lim and s[p+l] == ts[l]: l = l + 1
+            e = l
+            pos = p
+            if e == maxlen: break
+    return (e, pos)
+
+def compress(s, lazy=0):
+    """Compress s (normally a block of at most 4096 bytes) and return
+    the result as bytes.  See compress_into()."""
+    out = bytearray()
+    compress_into(out, s, lazy)
+    return bytes(out)
+
+def compress_into(out, s, lazy=0):
+    """Compress s (bytes or a memoryview, normally a block of at most
+    4096 bytes) and append the result to the bytearray out.
+
+    Matches are found with an index of the positions of all 3-byte
+    strings in s rather than by searching the window over and over,
+    but the output is byte for byte that of compress_reference().
+
+    With lazy true, a match is not taken if the match starting at the
+    next byte is at least two bytes longer; that byte goes out as a
+    literal instead.  This gives slightly smaller output, which no
+    longer matches compress_reference()."""
+    append = out.append
+    space = 0
+    imax = len(s)
+    keys, table = _index(s)
+    last = imax - 2
+    i = 0
+    while i < imax:
+        e = 0
+        if i < last:
+            e, pos = _longest_match(s, i, imax, keys, table)
+            if lazy and e and e < 9 and i + 1 < last:
+                if _longest_match(s, i + 1, imax, keys, table)[0] > e + 1:
+                    e = 0
+        if e:
+            byte = ((i - pos) << 3) | (e - 3)
+            if space:
+                append(32)
+                space = 0
+            append(0x80 | (byte >> 8))
+            append(byte & 0xff)
+            i = i + e
+        else:
+            c = s[i]
+            i = i + 1
+            if space:
+                if c >= 0x40 and c <= 0x7f: append(c | 0x80)
+                else:
+                    append(32)
+                    if c < 0x80 and (c == 0 or c > 8):
+                        append(c)
+                    else:
+                        append(1)
+                        append(c)
+                space = 0
+            else:
+                if c == 32: space = 1
+                else:
+                    if c < 0x80 and (c == 0 or c > 8):
+                        append(c)
+                    else:
+                        append(1)
+                        append(c)
+    if space: append(32)
+
+def compress_reference(s):
+    """The original compressor, searching the window with s.find().
+    Kept as the reference for compress()."""
+
     # optimizations
     # this cut off about 0.1 sec/call
 
@@ -134,6 +252,56 @@ def compress(s):
     return b''.join(retval)
 
 def uncompress(s):
+    """Uncompress s (bytes or a memoryview) and return bytes.
+
+    The output goes into a bytearray allocated once: a compressed
+    byte never expands to more than 5 bytes (a 2-byte back reference
+    to 10 bytes).  Literal runs and back references are copied as
+    slices; only references that overlap the bytes they produce (as
+    in runs of one character) are expanded from their pattern.
+    Truncated input ends the output, as in uncompress_reference();
+    so does a back reference to before the start of the output."""
+    imax = len(s)
+    o = bytearray(imax * 5)
+    x = 0
+    n = 0
+    while x < imax:
+        c = s[x]
+        x = x + 1
+        if c > 0 and c < 9:  # just copy that many bytes
+            if c == 1 and x < imax:
+                # the only count compress() writes
+                o[n] = s[x]
+                n = n + 1
+            else:
+                chunk = s[x:x+c]
+                o[n:n+len(chunk)] = chunk
+                n = n + len(chunk)
+            x = x + c
+        elif c < 128: # a regular ascii character
+            o[n] = c
+            n = n + 1
+        elif c >= 0xc0: # a regular ascii character with a space before it
+            o[n] = 32
+            o[n+1] = c & 0x7f
+            n = n + 2
+        else: # a compressed sequence
+            if x >= imax: break
+            c = (c << 8) | s[x]
+            x = x + 1
+            m = (c & 0x3fff) >> COUNT_BITS
+            l = (c & ((1 << COUNT_BITS)-1)) + 3
+            if m == 0 or m > n: break
+            if m >= l:
+                o[n:n+l] = o[n-m:n-m+l]
+            else:
+                o[n:n+l] = (o[n-m:n] * (l // m + 1))[:l]
+            n = n + l
+    del o[n:]
+    return bytes(o)
+
+def uncompress_reference(s):
+    """The original uncompressor, kept as the reference for uncompress()."""
     x = 0
     o = []
     try:
@@ -160,6 +328,6 @@ def uncompress(s):
                     o.append(o[len(o)-m])
     except IndexError:
         pass
-    return ''.join(list(map(chr, o)))
+    return bytes(o)
 
 
@@ -82,7 +82,7 @@ __copyright__ = 'Copyright 1998-1999 Rob Tillotson <robt@debian.org>'
 # then appinfo then sortinfo
 #
 
-import sys, os, stat, struct
+import sys, os, stat, struct, tempfile, mmap
 
 from itertools import zip_longest
 
@@ -151,6 +151,50 @@ def pad_null(s, l):
     if len(s) < l: s = s + '\0' * (l - len(s))
     return s
 
+def pack_header(info, appinfo_offset, sortinfo_offset, numrec):
+    """The database header for 'info' and 'numrec' records.
+    """
+    flg = 0
+    if info.get('flagResource',0): flg = flg | flagResource
+    if info.get('flagReadOnly',0): flg = flg | flagReadOnly
+    if info.get('flagAppInfoDirty',0): flg = flg | flagAppInfoDirty
+    if info.get('flagBackup',0): flg = flg | flagBackup
+    if info.get('flagOpen',0): flg = flg | flagOpen
+    if info.get('flagNewer',0): flg = flg | flagNewer
+    if info.get('flagReset',0): flg = flg | flagReset
+    if info.get('flagCopyPrevention',0): flg = flg | flagCopyPrevention
+    if info.get('flagLaunchableData',0): flg = flg | flagLaunchableData
+    # excludefromsync doesn't actually get stored?
+    name = info.get('name', '')
+
+    nameval = (len(name) > 31 and (name[:31] + '0')) or name
+
+    s = struct.Struct(b'32s')
+    packed_name = s.pack(name.encode('latin-1'))
+
+    s = struct.Struct(b'>hhLLLlll4s4sllh')
+
+    return packed_name + s.pack(flg,
+                                info.get('version',0),
+                                info.get('createDate',0)+PILOT_TIME_DELTA,
+                                info.get('modifyDate',0)+PILOT_TIME_DELTA,
+                                info.get('backupDate',0)+PILOT_TIME_DELTA,
+                                info.get('modnum',0),
+                                appinfo_offset, # appinfo
+                                sortinfo_offset, # sortinfo
+                                info.get('type','    ').encode('latin-1'),
+                                info.get('creator','    ').encode('latin-1'),
+                                0, # uid???
+                                0, # nextrec???
+                                numrec)
+
+def as_bytes(block):
+    """An appinfo or sortinfo block as bytes (they are built as latin-1
+    strings, but read back from a file as bytes).
+    """
+    if isinstance(block, str): return block.encode('latin-1')
+    return block
+
 class OFile:
     def __init__(self, name=None, read=1, write=0, info={}):
         self.filename = name
@@ -344,7 +388,7 @@ class OFile:
         entries = []
         record_data = []
         rsrc = self.info.get('flagResource')
-        for x, off in map(None, self.records, rec_offsets):
+        for x, off in zip_longest(self.records, rec_offsets):
             if rsrc:
                 id, type, data = tuple(x)
                 record_data.append(data)
@@ -953,40 +997,7 @@ class File(PCache):
             rec_offsets.append(off)
             off = off + len(x.raw)
 
-        info = self.info
-        flg = 0
-        if info.get('flagResource',0): flg = flg | flagResource
-        if info.get('flagReadOnly',0): flg = flg | flagReadOnly
-        if info.get('flagAppInfoDirty',0): flg = flg | flagAppInfoDirty
-        if info.get('flagBackup',0): flg = flg | flagBackup
-        if info.get('flagOpen',0): flg = flg | flagOpen
-        if info.get('flagNewer',0): flg = flg | flagNewer
-        if info.get('flagReset',0): flg = flg | flagReset
-        if info.get('flagCopyPrevention',0): flg = flg | flagCopyPrevention
-        if info.get('flagLaunchableData',0): flg = flg | flagLaunchableData
-        # excludefromsync doesn't actually get stored?
-        name = info.get('name', '')
-
-        nameval = (len(name) > 31 and (name[:31] + '0')) or name
-
-        s = struct.Struct(b'32s')
-        packed_name = s.pack(name.encode('latin-1'))
-
-        s = struct.Struct(b'>hhLLLlll4s4sllh')
-
-        hdr = packed_name + s.pack(flg,
-                                   info.get('version',0),
-                                   info.get('createDate',0)+PILOT_TIME_DELTA,
-                                   info.get('modifyDate',0)+PILOT_TIME_DELTA,
-                                   info.get('backupDate',0)+PILOT_TIME_DELTA,
-                                   info.get('modnum',0),
-                                   appinfo_offset, # appinfo
-                                   sortinfo_offset, # sortinfo
-                                   info.get('type','    ').encode('latin-1'),
-                                   info.get('creator','    ').encode('latin-1'),
-                                   0, # uid???
-                                   0, # nextrec???
-                                   len(self.data))
+        hdr = pack_header(self.info, appinfo_offset, sortinfo_offset, len(self.data))
 
         f.write(hdr)
 
@@ -1006,8 +1017,340 @@ class File(PCache):
         for x in entries: f.write(x)
         # Two bytes padding (if the PDB come from the Pilot the padding are also there)
         f.write((chr(0)+chr(0)).encode('latin-1'))
-        f.write(self.appblock.encode('latin-1'))
-        f.write(self.sortblock.encode('latin-1'))
+        f.write(as_bytes(self.appblock))
+        f.write(as_bytes(self.sortblock))
         for x in record_data:
             f.write(x)
         f.flush()
+
+
+class StreamFile:
+    """Write a record database without keeping the records in memory.
+
+    If the ids of all records are declared with reserve() before the
+    first one is set, and the database goes to a file (given by name),
+    the header, the record list and the appinfo and sortinfo blocks
+    are reserved at the start of the file and every record is written
+    straight after them as it is set; close() fills in the header and
+    the record offsets.  The records must then be set in the order of
+    the ids passed to reserve().
+
+    Otherwise (records in any order, or a pipe like sys.stdout.buffer
+    that cannot be written out of order) setRecord() appends them to
+    a spool file, and close() writes the header and the record list and
+    copies the records out of the spool in order of their ids.
+
+    Either way only one record is in memory at a time, and the output
+    is the same as that of File.save() with the records set in order
+    of their ids.  Only the writing half of the PCache API is here, and
+    only for record (not resource) databases.
+    """
+    def __init__(self, name, info={}, spooldir=None):
+        self.filename = name
+        self.info = {}
+        self.info.update(default_info)
+        self.info.update(info)
+        self.appblock = ''
+        self.sortblock = ''
+        self.spooldir = spooldir
+        self.spool = None
+        self.spool_size = 0
+        # id -> (attr, cat, offset, size), offsets into the spool or the file
+        self.index = {}
+        # with reserve(): the output file, the ids in order, and the
+        # offset of the next record
+        self.f = None
+        self.ids = None
+        self.next_offset = 0
+        self.isopen = 1
+
+    def getRecords(self): return len(self.index)
+    def getAppBlock(self): return self.appblock and self.appblock or None
+    def setAppBlock(self, raw):
+        if self.f is not None: raise IOError('appinfo block set after reserve()')
+        self.appblock = raw
+    def getSortBlock(self): return self.sortblock and self.sortblock or None
+    def setSortBlock(self, raw):
+        if self.f is not None: raise IOError('sortinfo block set after reserve()')
+        self.sortblock = raw
+    def checkID(self, id): return id in self.index
+    def getDBInfo(self): return self.info
+    def setDBInfo(self, info):
+        self.info = {}
+        self.info.update(info)
+
+    def _offsets(self, count):
+        """The offsets of the appinfo block, the sortinfo block and the
+        first record in a database of 'count' records.
+        """
+        off = PI_HDR_SIZE + PI_RECORD_ENT_SIZE * count + 2
+        if self.appblock:
+            appinfo_offset = off
+            off = off + len(self.appblock)
+        else:
+            appinfo_offset = 0
+        if self.sortblock:
+            sortinfo_offset = off
+            off = off + len(self.sortblock)
+        else:
+            sortinfo_offset = 0
+        return appinfo_offset, sortinfo_offset, off
+
+    def _preamble(self, ids, offsets):
+        """The header, the record list, the padding and the appinfo and
+        sortinfo blocks, for records 'ids' at 'offsets'.
+        """
+        appinfo_offset, sortinfo_offset, off = self._offsets(len(ids))
+        entries = [pack_header(self.info, appinfo_offset, sortinfo_offset, len(ids))]
+        for id, offset in zip(ids, offsets):
+            attr, cat = self.index.get(id, (0, 0))[:2]
+            entries.append(struct.pack('>ll', offset, ((attr | cat) << 24) | id))
+        # Two bytes padding, as in File.save()
+        entries.append(b'\0\0')
+        entries.append(as_bytes(self.appblock))
+        entries.append(as_bytes(self.sortblock))
+        return b''.join(entries)
+
+    def reserve(self, ids):
+        """Declare the ids of all records, which are then set in this
+        order.  Writing to a file, this reserves the start of it and
+        the records go straight to the file.
+        """
+        if self.index: raise IOError('reserve() called after setRecord()')
+        if type(self.filename) != type(''): return
+        self.appblock = as_bytes(self.appblock)
+        self.sortblock = as_bytes(self.sortblock)
+        self.ids = list(ids)
+        self.f = open(self.filename, 'wb')
+        preamble = self._preamble(self.ids, [0] * len(self.ids))
+        self.f.write(preamble)
+        self.next_offset = len(preamble)
+
+    def setRecord(self, attr, id, cat, data):
+        if self.f is not None:
+            if len(self.index) >= len(self.ids) or id != self.ids[len(self.index)]:
+                raise IOError('record %d set out of the order given to reserve()' % id)
+            self.f.write(data)
+            self.index[id] = (attr, cat, self.next_offset, len(data))
+            self.next_offset = self.next_offset + len(data)
+            return id
+        if not id:
+            id = max([0] + list(self.index.keys())) + 1
+        if self.spool is None:
+            # the spool goes next to the database if there is one, so
+            # that it is on a file system with room for the database
+            spooldir = self.spooldir
+            if spooldir is None and type(self.filename) == type(''):
+                spooldir = os.path.dirname(os.path.abspath(self.filename))
+            self.spool = tempfile.TemporaryFile(prefix='prc', dir=spooldir)
+        # a record set twice leaves its old data unused in the spool
+        self.spool.write(data)
+        self.index[id] = (attr, cat, self.spool_size, len(data))
+        self.spool_size = self.spool_size + len(data)
+        return id
+
+    def close(self):
+        if not self.isopen: return
+        self.isopen = 0
+        if self.f is not None:
+            try:
+                if len(self.index) != len(self.ids):
+                    raise IOError('only %d of the %d reserved records were set' % (len(self.index), len(self.ids)))
+                # fill in the record offsets
+                self.f.seek(0)
+                self.f.write(self._preamble(self.ids, [self.index[id][2] for id in self.ids]))
+            finally:
+                self.f.close()
+            return
+        f = self.filename
+        try:
+            if type(f) == type(''): f = open(f, 'wb')
+            try:
+                self.save(f)
+            finally:
+                if f is not self.filename: f.close()
+        finally:
+            if self.spool is not None: self.spool.close()
+
+    def discard(self):
+        """Give up writing the database, removing what was written.
+        """
+        if not self.isopen: return
+        self.isopen = 0
+        if self.spool is not None: self.spool.close()
+        if self.f is not None:
+            self.f.close()
+            os.unlink(self.filename)
+
+    def save(self, f):
+        """Write the spooled database to the open file 'f'.
+        """
+        ids = sorted(self.index.keys())
+        appinfo_offset, sortinfo_offset, off = self._offsets(len(ids))
+        offsets = []
+        for id in ids:
+            offsets.append(off)
+            off = off + self.index[id][3]
+        f.write(self._preamble(ids, offsets))
+
+        if self.spool is not None: self.spool.flush()
+        for id in ids:
+            attr, cat, start, size = self.index[id]
+            self.spool.seek(start)
+            data = self.spool.read(size)
+            if len(data) != size: raise IOError('failed to read record from spool')
+            f.write(data)
+        f.flush()
+
+
+class MappedFile:
+    """Read a record database lazily through mmap.
+
+    Opening the file reads only the header and the record list; the
+    records themselves are returned as memoryviews of the mapped file,
+    so nothing is copied until the caller asks for the bytes, and
+    records that are never looked at are never read from disk.  Use it
+    to inspect or validate many databases quickly (see Inspect.py).
+
+    Only the reading half of the PCache API is here.  Records returned
+    stay valid after close() until they are released; the file is
+    unmapped when the last of them goes away.
+    """
+    def __init__(self, name):
+        self.filename = name
+        f = open(name, 'rb')
+        try:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < PI_HDR_SIZE: raise IOError('file too short')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.view = memoryview(self.map)
+        self.isopen = 1
+        try:
+            self.readIndex()
+        except:
+            self.close()
+            raise
+
+    def readIndex(self):
+        (name, flags, ver, ctime, mtime, btime, mnum, appinfo, sortinfo,
+         typ, creator, uid, nextrec, numrec) \
+         = struct.unpack_from('>32shhLLLlll4s4sllh', self.map, 0)
+
+        if nextrec or appinfo < 0 or sortinfo < 0 or numrec < 0:
+            raise IOError('invalid database header')
+
+        self.info = {
+            'name': name.split(b'\0')[0].decode('latin-1'),
+            'type': typ.decode('latin-1'),
+            'creator': creator.decode('latin-1'),
+            'createDate': ctime - PILOT_TIME_DELTA,
+            'modifyDate': mtime - PILOT_TIME_DELTA,
+            'backupDate': btime - PILOT_TIME_DELTA,
+            'modnum': mnum,
+            'version': ver,
+            'flagReset': flags & flagReset,
+            'flagResource': flags & flagResource,
+            'flagNewer': flags & flagNewer,
+            'flagExcludeFromSync': flags & flagExcludeFromSync,
+            'flagAppInfoDirty': flags & flagAppInfoDirty,
+            'flagReadOnly': flags & flagReadOnly,
+            'flagBackup': flags & flagBackup,
+            'flagOpen': flags & flagOpen,
+            'flagCopyPrevention': flags & flagCopyPrevention,
+            'flagLaunchableData': flags & flagLaunchableData,
+            'more': 0,
+            'index': 0
+         }
+
+        self.rsrc = flags & flagResource
+        if self.rsrc: s = PI_RESOURCE_ENT_SIZE
+        else: s = PI_RECORD_ENT_SIZE
+        if PI_HDR_SIZE + numrec * s > self.size:
+            raise IOError('bad database header')
+
+        # (offset, size, attr or type, id) of every record
+        self.entries = []
+        if self.rsrc:
+            for (typ, id, offset) in struct.iter_unpack('>4shl', self.map[PI_HDR_SIZE:PI_HDR_SIZE + numrec * s]):
+                self.entries.append([offset, 0, typ, id])
+        else:
+            for (offset, auid) in struct.iter_unpack('>ll', self.map[PI_HDR_SIZE:PI_HDR_SIZE + numrec * s]):
+                self.entries.append([offset, 0, (auid & 0xff000000) >> 24, auid & 0x00ffffff])
+
+        offset = self.size
+        for x in range(numrec - 1, -1, -1):
+            entry = self.entries[x]
+            size = offset - entry[0]
+            if size < 0: raise IOError('bad pdb/prc record entry (size < 0)')
+            entry[1] = size
+            offset = entry[0]
+        self.by_id = None
+
+        if sortinfo:
+            self.sortinfo = (sortinfo, offset - sortinfo)
+            offset = sortinfo
+        else:
+            self.sortinfo = (0, 0)
+        if appinfo:
+            self.appinfo = (appinfo, offset - appinfo)
+        else:
+            self.appinfo = (0, 0)
+        if self.appinfo[1] < 0 or self.sortinfo[1] < 0:
+            raise IOError('bad database header (appinfo or sortinfo size < 0)')
+
+    def close(self):
+        if not self.isopen: return
+        self.isopen = 0
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # records are still in use, see above
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getRecords(self): return len(self.entries)
+    def getDBInfo(self): return self.info
+    def getAppBlock(self):
+        off, size = self.appinfo
+        return size and self.view[off:off+size] or None
+    def getSortBlock(self):
+        off, size = self.sortinfo
+        return size and self.view[off:off+size] or None
+    def checkID(self, id): return self.getIndex(id) is not None
+
+    def getIndex(self, id):
+        """The index of the record with 'id', or None.
+        """
+        if self.by_id is None:
+            self.by_id = {}
+            for x in range(len(self.entries)):
+                self.by_id.setdefault(self.entries[x][3], x)
+        return self.by_id.get(id)
+
+    def getRecordSize(self, i):
+        return self.entries[i][1]
+
+    def getRecord(self, i):
+        try: off, size, attr, id = self.entries[i]
+        except: return None
+        return self.view[off:off+size], i, id, attr & 0xf0, attr & 0x0f
+    def getRecordByID(self, id):
+        i = self.getIndex(id)
+        if i is None: return None
+        return self.getRecord(i)
+    def getResource(self, i):
+        try: off, size, typ, id = self.entries[i]
+        except: return None
+        return self.view[off:off+size], typ, id
+    def getRecordIDs(self, sort=0):
+        ids = [x[3] for x in self.entries]
+        if sort: ids.sort()
+        return ids
@@ -347,7 +347,12 @@ class SGMLParser(_markupbase.ParserBase):
                 self.unknown_endtag(tag)
                 return
         else:
-            if tag not in self.stack:
+            # the innermost open element of that name; search from the
+            # top, the stack can get very deep on broken pages
+            found = len(self.stack) - 1
+            while found >= 0 and self.stack[found] != tag:
+                found = found - 1
+            if found < 0:
                 try:
                     method = getattr(self, 'end_' + tag)
                 except AttributeError:
@@ -355,9 +360,6 @@ class SGMLParser(_markupbase.ParserBase):
                 else:
                     self.report_unbalanced(tag)
                 return
-            found = len(self.stack)
-            for i in range(found):
-                if self.stack[i] == tag: found = i
         while len(self.stack) > found:
             tag = self.stack[-1]
             try:
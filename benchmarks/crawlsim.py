@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+
+"""
+crawlsim.py
+
+Crawl scheduling simulator.
+
+Replays the crawl of a build against a virtual clock, without any
+network, to compare frontier strategies, concurrency and politeness
+settings in seconds.  The input is the link graph of a previous build
+together with the time each URL took to retrieve and parse and its
+size.  It is recovered from a build trace (plucker-build --trace=...),
+which records a 'fetched' event for every retrieved URL and a 'links'
+event with the links the spider took from every page:
+
+    plucker-build ... --trace=trace.json
+    python3 benchmarks/crawlsim.py trace.json                        # the spider as it is
+    python3 benchmarks/crawlsim.py -s bfs -s dfs -s priority -s roundrobin trace.json
+    python3 benchmarks/crawlsim.py -s roundrobin -j 8 --per-host=2 --delay=0.5 trace.json
+    python3 benchmarks/crawlsim.py --max-pages=100 --hosts trace.json
+    python3 benchmarks/crawlsim.py --save-graph=graph.json trace.json
+    python3 benchmarks/crawlsim.py --self-test
+
+The graph can also be saved as (and read from) a simpler JSON file:
+
+    {"home": url,
+     "nodes": {url: {"latency": seconds, "parse": seconds, "bytes": n,
+                     "content_type": type, "ok": 0 or 1, "location": url,
+                     "links": [url, ...], "images": [url, ...]}}}
+
+The model: a fetch keeps a worker and a connection to its host busy
+for the recorded retrieval time; parsing keeps just the worker busy
+for the recorded parse time, after which the links found are added to
+the frontier.  A host gets at most --per-host connections at a time,
+and a new request to it no earlier than --delay seconds after the
+previous one finished.  Links that were not retrieved in the recorded
+build (excluded, beyond its depth limits) cannot be simulated and are
+skipped.  As in Spider.process, a URL may sit in the frontier more
+than once; the duplicates are dropped when they are dequeued.
+
+Strategies:
+
+    bfs         the spider's default: first in, first out
+    dfs         the spider's --depth-first: last in, first out
+    priority    inline images first, then the shallowest pages, then
+                the pages with the most links to them
+    roundrobin  first in, first out per host, taking hosts in turn
+
+With -j 1, no delay and bfs or dfs, the simulated makespan should come
+close to the crawl time of the recorded build, which is also reported.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, json, heapq, getopt, urllib.parse
+
+
+##
+## Link graphs
+##
+
+def _node (url):
+    return {'latency': 0.0, 'parse': 0.0, 'bytes': 0, 'content_type': None, 'ok': 0,
+            'location': url, 'links': [], 'images': []}
+
+
+def graph_from_trace (events):
+    """Build a link graph from the events of a build trace"""
+    nodes = {}
+    home = None
+    retrieve = {}       # url -> seconds of its last 'retrieve' span
+    parse = {}          # url -> seconds spent parsing it
+    links = {}          # url -> (links, images)
+    first = last = None
+    for event in sorted (events, key=lambda e: e.get ('ts', 0)):
+        name = event.get ('name')
+        args = event.get ('args', {})
+        url = args.get ('url')
+        if url is None:
+            continue
+        if name == 'retrieve':
+            retrieve[url] = event['dur'] / 1000000.0
+        elif name in ('parse', 'image rendition'):
+            parse[url] = parse.get (url, 0.0) + event['dur'] / 1000000.0
+        elif name == 'fetched':
+            node = nodes[url] = _node (url)
+            node['latency'] = retrieve.get (url, 0.0)
+            node['bytes'] = args.get ('bytes', 0)
+            node['content_type'] = args.get ('content_type')
+            node['ok'] = (args.get ('error_code') == 0 and 1) or 0
+            node['location'] = args.get ('location') or url
+            if home is None:
+                home = url
+        elif name == 'links':
+            links[url] = (args.get ('links', []), args.get ('images', []))
+        if name in ('retrieve', 'parse', 'image rendition'):
+            end = event['ts'] + event['dur']
+            if first is None:
+                first = event['ts']
+            last = max (last or 0, end)
+    # links and parse times are recorded under the URL after redirects
+    for node in nodes.values ():
+        node['parse'] = parse.get (node['location'], 0.0)
+        (node['links'], node['images']) = links.get (node['location'], ([], []))
+    graph = {'home': home, 'nodes': nodes}
+    if first is not None:
+        graph['recorded_seconds'] = round ((last - first) / 1000000.0, 6)
+    return graph
+
+
+def load_graph (filename):
+    """Read a link graph from a build trace or a saved graph"""
+    f = open (filename)
+    data = json.load (f)
+    f.close ()
+    if isinstance (data, list):
+        return graph_from_trace (data)
+    if 'traceEvents' in data:
+        return graph_from_trace (data['traceEvents'])
+    return data
+
+
+def _host (url):
+    return urllib.parse.urlsplit (url).netloc or urllib.parse.urlsplit (url).scheme or '-'
+
+
+##
+## Frontiers
+##
+
+class Frontier:
+
+    """First in, first out (the spider's breadth-first order)"""
+
+    def __init__ (self):
+        self._entries = []
+        self._sequence = 0
+
+    def __len__ (self):
+        return len (self._entries)
+
+    def push (self, entry):
+        """'entry' is a dictionary with at least 'url', 'host',
+        'depth', 'inline' and 'inlinks'"""
+        self._sequence = self._sequence + 1
+        entry['sequence'] = self._sequence
+        self._entries.append (entry)
+
+    def _order (self):
+        return range (len (self._entries))
+
+    def pop (self, available):
+        """Remove and return the next entry whose host is
+        'available(host)', or None"""
+        for i in self._order ():
+            if available (self._entries[i]['host']):
+                return self._entries.pop (i)
+        return None
+
+    def hosts (self):
+        return set ([entry['host'] for entry in self._entries])
+
+
+class DepthFirstFrontier (Frontier):
+
+    """Last in, first out (the spider's --depth-first order)"""
+
+    def _order (self):
+        return range (len (self._entries) - 1, -1, -1)
+
+
+class PriorityFrontier (Frontier):
+
+    """Inline images first, then shallow pages, then popular ones"""
+
+    def push (self, entry):
+        self._sequence = self._sequence + 1
+        entry['sequence'] = self._sequence
+        heapq.heappush (self._entries, ((not entry['inline']), entry['depth'], -entry['inlinks'],
+                                        entry['sequence'], entry))
+
+    def pop (self, available):
+        skipped = []
+        result = None
+        while self._entries:
+            item = heapq.heappop (self._entries)
+            if available (item[-1]['host']):
+                result = item[-1]
+                break
+            skipped.append (item)
+        for item in skipped:
+            heapq.heappush (self._entries, item)
+        return result
+
+    def hosts (self):
+        return set ([item[-1]['host'] for item in self._entries])
+
+
+class RoundRobinFrontier (Frontier):
+
+    """First in, first out per host, hosts taken in turn"""
+
+    def __init__ (self):
+        Frontier.__init__ (self)
+        self._queues = {}
+        self._hosts = []
+        self._next = 0
+        self._count = 0
+
+    def __len__ (self):
+        return self._count
+
+    def push (self, entry):
+        self._sequence = self._sequence + 1
+        entry['sequence'] = self._sequence
+        if entry['host'] not in self._queues:
+            self._queues[entry['host']] = []
+            self._hosts.append (entry['host'])
+        self._queues[entry['host']].append (entry)
+        self._count = self._count + 1
+
+    def pop (self, available):
+        for i in range (len (self._hosts)):
+            host = self._hosts[(self._next + i) % len (self._hosts)]
+            if self._queues[host] and available (host):
+                self._next = (self._next + i + 1) % len (self._hosts)
+                self._count = self._count - 1
+                return self._queues[host].pop (0)
+        return None
+
+    def hosts (self):
+        return set ([host for host in self._hosts if self._queues[host]])
+
+
+STRATEGIES = {
+    'bfs': Frontier,
+    'dfs': DepthFirstFrontier,
+    'priority': PriorityFrontier,
+    'roundrobin': RoundRobinFrontier,
+}
+
+
+##
+## The simulation
+##
+
+class CrawlSimulator:
+
+    """Simulates one crawl of 'graph'.  run() returns a dictionary of
+    results."""
+
+    def __init__ (self, graph, strategy='bfs', concurrency=1, per_host=1, delay=0.0,
+                  max_pages=None, max_bytes=None, max_time=None, max_depth=None):
+        self.graph = graph
+        self.strategy = strategy
+        self.concurrency = max (concurrency, 1)
+        self.per_host = max (per_host, 1)
+        self.delay = delay
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.max_depth = max_depth
+
+        self._frontier = STRATEGIES[strategy] ()
+        self._clock = 0.0
+        self._events = []               # heap of (time, sequence, kind, job)
+        self._sequence = 0
+        self._seen = {}                 # url -> 1 once started (fetched or in flight)
+        self._inlinks = {}
+        self._host_busy = {}
+        self._host_free_at = {}
+        self._host_stats = {}
+        self._workers_busy = 0
+        self._worker_seconds = 0.0
+        self._budget_hit = None
+        self._counts = {'fetched': 0, 'failed': 0, 'bytes': 0, 'duplicates': 0, 'unrecorded': 0,
+                        'pages': 0, 'images': 0}
+        self._wait = 0.0
+        self._max_frontier = 0
+
+    def _schedule (self, time, kind, job):
+        self._sequence = self._sequence + 1
+        heapq.heappush (self._events, (time, self._sequence, kind, job))
+
+    def _add (self, url, depth, inline):
+        if url in self._seen:
+            return
+        if self.max_depth is not None and depth > self.max_depth:
+            return
+        self._inlinks[url] = self._inlinks.get (url, 0) + 1
+        self._frontier.push ({'url': url, 'host': _host (url), 'depth': depth, 'inline': inline,
+                              'inlinks': self._inlinks[url], 'queued_at': self._clock})
+        self._max_frontier = max (self._max_frontier, len (self._frontier))
+
+    def _available (self, host):
+        return (self._host_busy.get (host, 0) < self.per_host
+                and self._host_free_at.get (host, 0.0) <= self._clock)
+
+    def _out_of_budget (self):
+        if self.max_pages is not None and self._counts['fetched'] >= self.max_pages:
+            self._budget_hit = 'pages'
+        elif self.max_bytes is not None and self._counts['bytes'] >= self.max_bytes:
+            self._budget_hit = 'bytes'
+        elif self.max_time is not None and self._clock >= self.max_time:
+            self._budget_hit = 'time'
+        return self._budget_hit is not None
+
+    def _start_jobs (self):
+        while self._workers_busy < self.concurrency and not self._out_of_budget ():
+            entry = self._frontier.pop (self._available)
+            if entry is None:
+                return
+            url = entry['url']
+            if url in self._seen:
+                # the spider dequeues it and finds it already retrieved
+                self._counts['duplicates'] = self._counts['duplicates'] + 1
+                continue
+            node = self.graph['nodes'].get (url)
+            if node is None:
+                self._counts['unrecorded'] = self._counts['unrecorded'] + 1
+                continue
+            self._seen[url] = 1
+            self._seen[node['location']] = 1
+            self._wait = self._wait + self._clock - entry['queued_at']
+            host = entry['host']
+            self._host_busy[host] = self._host_busy.get (host, 0) + 1
+            stats = self._host_stats.setdefault (host, {'requests': 0, 'bytes': 0, 'busy_seconds': 0.0,
+                                                        'max_connections': 0})
+            stats['requests'] = stats['requests'] + 1
+            stats['bytes'] = stats['bytes'] + node['bytes']
+            stats['busy_seconds'] = stats['busy_seconds'] + node['latency']
+            stats['max_connections'] = max (stats['max_connections'], self._host_busy[host])
+            self._workers_busy = self._workers_busy + 1
+            self._counts['fetched'] = self._counts['fetched'] + 1
+            self._counts['bytes'] = self._counts['bytes'] + node['bytes']
+            job = {'entry': entry, 'node': node, 'start': self._clock}
+            self._schedule (self._clock + node['latency'], 'fetched', job)
+
+    def _blocked_until (self):
+        """The earliest time a host in the frontier becomes available
+        again, if all of them are waiting for their delay"""
+        times = [self._host_free_at.get (host, 0.0) for host in self._frontier.hosts ()
+                 if self._host_busy.get (host, 0) < self.per_host]
+        times = [t for t in times if t > self._clock]
+        return (times and min (times)) or None
+
+    def run (self):
+        home = self.graph['home']
+        self._add (home, 0, 0)
+        while 1:
+            self._start_jobs ()
+            until = None
+            if self._frontier and not self._budget_hit:
+                # a host may get through its delay before the next event
+                until = self._blocked_until ()
+            if self._events and (until is None or self._events[0][0] <= until):
+                if self._budget_hit == 'time' and self._events[0][0] > self.max_time:
+                    # what is still running at the deadline is lost
+                    break
+                (time, sequence, kind, job) = heapq.heappop (self._events)
+                self._clock = time
+                self._finish (kind, job)
+            elif until is not None:
+                self._clock = until
+            else:
+                break
+        return self._results ()
+
+    def _finish (self, kind, job):
+        node = job['node']
+        entry = job['entry']
+        if kind == 'fetched':
+            # the connection is free, parsing goes on in the worker
+            host = entry['host']
+            self._host_busy[host] = self._host_busy[host] - 1
+            self._host_free_at[host] = self._clock + self.delay
+            self._schedule (self._clock + node['parse'], 'parsed', job)
+            return
+        self._workers_busy = self._workers_busy - 1
+        self._worker_seconds = self._worker_seconds + self._clock - job['start']
+        if not node['ok']:
+            self._counts['failed'] = self._counts['failed'] + 1
+            return
+        if str (node['content_type'])[:6] == 'image/':
+            self._counts['images'] = self._counts['images'] + 1
+        else:
+            self._counts['pages'] = self._counts['pages'] + 1
+        for url in node['images']:
+            self._add (url, entry['depth'] + 1, 1)
+        for url in node['links']:
+            self._add (url, entry['depth'] + 1, 0)
+
+    def _results (self):
+        makespan = self._clock
+        fetched = self._counts['fetched']
+        hosts = {}
+        for (host, stats) in self._host_stats.items ():
+            entry = dict (stats)
+            entry['busy_seconds'] = round (entry['busy_seconds'], 6)
+            entry['load'] = (makespan and round (stats['busy_seconds'] / makespan, 4)) or 0.0
+            hosts[host] = entry
+        budget = {}
+        for (name, limit, used) in (('pages', self.max_pages, fetched),
+                                    ('bytes', self.max_bytes, self._counts['bytes']),
+                                    ('seconds', self.max_time, makespan)):
+            if limit is not None:
+                budget[name] = {'limit': limit, 'used': round (used, 6),
+                                'fraction': (limit and round (float (used) / limit, 4)) or None}
+        return {'strategy': self.strategy,
+                'concurrency': self.concurrency,
+                'per_host': self.per_host,
+                'delay': self.delay,
+                'makespan': round (makespan, 6),
+                'fetched': fetched,
+                'pages': self._counts['pages'],
+                'images': self._counts['images'],
+                'failed': self._counts['failed'],
+                'bytes': self._counts['bytes'],
+                'duplicates': self._counts['duplicates'],
+                'unrecorded': self._counts['unrecorded'],
+                'left_in_frontier': len (self._frontier),
+                'coverage': round (float (fetched) / max (len (self.graph['nodes']), 1), 4),
+                'mean_wait': round (self._wait / max (fetched, 1), 6),
+                'max_frontier': self._max_frontier,
+                'worker_utilisation': round (self._worker_seconds / max (makespan * self.concurrency, 1e-9), 4),
+                'budget_exhausted': self._budget_hit,
+                'budget': budget,
+                'hosts': hosts}
+
+
+##
+## Reporting
+##
+
+def print_results (results, graph, show_hosts=0):
+    if 'recorded_seconds' in graph:
+        print ("Recorded build: %d URLs, %.3f s crawling" % (len (graph['nodes']), graph['recorded_seconds']))
+    print ("%-10s %3s %4s %6s %10s %7s %6s %6s %10s %6s %9s %6s %s"
+           % ("Strategy", "-j", "Host", "Delay", "Makespan", "Fetched", "Failed", "Cover",
+              "Bytes", "Dups", "Mean wait", "Util", "Budget"))
+    for r in results:
+        print ("%-10s %3d %4d %6.2f %10.3f %7d %6d %5.1f%% %10d %6d %9.3f %5.1f%% %s"
+               % (r['strategy'], r['concurrency'], r['per_host'], r['delay'], r['makespan'], r['fetched'],
+                  r['failed'], r['coverage'] * 100, r['bytes'], r['duplicates'], r['mean_wait'],
+                  r['worker_utilisation'] * 100, r['budget_exhausted'] or "-"))
+    if show_hosts:
+        for r in results:
+            print ("")
+            print ("%s, -j %d: %-30s %8s %10s %8s %6s %4s" % (r['strategy'], r['concurrency'], "Host", "Requests",
+                                                             "Bytes", "Busy s", "Load", "Max"))
+            for (host, h) in sorted (r['hosts'].items (), key=lambda item: -item[1]['requests']):
+                print ("%s        %-30s %8d %10d %8.3f %5.1f%% %4d" % (" " * len (r['strategy']), host,
+                                                                    h['requests'], h['bytes'], h['busy_seconds'],
+                                                                    h['load'] * 100, h['max_connections']))
+
+
+##
+## Self test
+##
+
+def _test_graph (home, nodes):
+    graph = {'home': home, 'nodes': {}}
+    for (url, latency, links) in nodes:
+        node = _node (url)
+        node.update ({'latency': latency, 'ok': 1, 'content_type': 'text/html', 'links': links})
+        graph['nodes'][url] = node
+    return graph
+
+# (name, graph, simulator options, expected makespan)
+SELF_TESTS = [
+    ('sequential',
+     _test_graph ('http://a/', [('http://a/', 1.0, ['http://a/1', 'http://b/1']),
+                                ('http://a/1', 0.5, []),
+                                ('http://b/1', 2.0, [])]),
+     {}, 3.5),
+    # the two pages of a/ go out as soon as a/ has waited out its delay,
+    # not only when the slow page of b/ is done
+    ('delay',
+     _test_graph ('http://a/', [('http://a/', 1.0, ['http://a/1', 'http://a/2', 'http://b/1']),
+                                ('http://a/1', 0.1, []),
+                                ('http://a/2', 0.1, []),
+                                ('http://b/1', 10.0, [])]),
+     {'concurrency': 4, 'delay': 0.5}, 11.0),
+    ('delay bound',
+     _test_graph ('http://a/', [('http://a/', 1.0, ['http://a/1', 'http://a/2']),
+                                ('http://a/1', 0.1, []),
+                                ('http://a/2', 0.1, [])]),
+     {'concurrency': 4, 'delay': 0.5}, 2.2),
+    ]
+
+
+def self_test ():
+    """Simulate the SELF_TESTS and compare their makespans.  Returns
+    the number of failures."""
+    failures = 0
+    for (name, graph, options, expected) in SELF_TESTS:
+        makespan = CrawlSimulator (graph, **options).run ()['makespan']
+        if abs (makespan - expected) > 1e-6:
+            print ("%s: makespan %.3f instead of %.3f" % (name, makespan, expected))
+            failures = failures + 1
+        else:
+            print ("%s: ok" % name)
+    return failures
+
+
+def usage ():
+    sys.stderr.write ("Usage: %s [-s <strategy>]... [-j <workers>]... [--per-host=<n>] [--delay=<seconds>]\n"
+                      "       [--max-pages=<n>] [--max-bytes=<n>] [--max-time=<seconds>] [--max-depth=<n>]\n"
+                      "       [--hosts] [--json=<file>] [--save-graph=<file>] <trace or graph file>\n"
+                      "       %s --self-test\n"
+                      "Strategies: %s\n" % (sys.argv[0], sys.argv[0], " ".join (sorted (STRATEGIES.keys ()))))
+    sys.exit (1)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "s:j:h", ["strategy=", "jobs=", "per-host=", "delay=",
+                                                           "max-pages=", "max-bytes=", "max-time=",
+                                                           "max-depth=", "hosts", "json=", "save-graph=",
+                                                           "self-test", "help"])
+    except getopt.error as text:
+        sys.stderr.write ("%s\n" % text)
+        usage ()
+    if ("--self-test", "") in opts:
+        return (self_test () and 1) or 0
+    if len (args) != 1:
+        usage ()
+    strategies = []
+    jobs = []
+    options = {}
+    show_hosts = 0
+    json_file = None
+    graph_file = None
+    for (opt, arg) in opts:
+        if opt in ("-s", "--strategy"):
+            if arg not in STRATEGIES:
+                sys.stderr.write ("Unknown strategy '%s'\n" % arg)
+                usage ()
+            strategies.append (arg)
+        elif opt in ("-j", "--jobs"):
+            jobs.append (int (arg))
+        elif opt == "--per-host":
+            options['per_host'] = int (arg)
+        elif opt == "--delay":
+            options['delay'] = float (arg)
+        elif opt == "--max-pages":
+            options['max_pages'] = int (arg)
+        elif opt == "--max-bytes":
+            options['max_bytes'] = int (arg)
+        elif opt == "--max-time":
+            options['max_time'] = float (arg)
+        elif opt == "--max-depth":
+            options['max_depth'] = int (arg)
+        elif opt == "--hosts":
+            show_hosts = 1
+        elif opt == "--json":
+            json_file = arg
+        elif opt == "--save-graph":
+            graph_file = arg
+        else:
+            usage ()
+
+    graph = load_graph (args[0])
+    if not graph.get ('home') or not graph.get ('nodes'):
+        sys.stderr.write ("No link graph in %s (was the build run with --trace?)\n" % args[0])
+        return 1
+    if graph_file:
+        f = open (graph_file, 'w')
+        json.dump (graph, f, indent=1, sort_keys=True)
+        f.close ()
+
+    results = []
+    for strategy in strategies or ['bfs']:
+        for concurrency in jobs or [1]:
+            results.append (CrawlSimulator (graph, strategy, concurrency, **options).run ())
+    print_results (results, graph, show_hosts)
+    if json_file:
+        f = open (json_file, 'w')
+        json.dump ({'graph': args[0], 'results': results}, f, indent=1, sort_keys=True)
+        f.close ()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
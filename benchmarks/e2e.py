@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+e2e.py
+
+End-to-end build benchmarks.
+
+Every configuration describes a generated site (see synthsite.py) and
+the plucker-build options to use on it.  The site is served from a
+local HTTP server, and a complete build (Spider.realmain -> main) is
+run against it in a child process, so that the peak memory of each
+build can be measured on its own.  The numbers come from the build's
+--metrics file.
+
+    python3 benchmarks/e2e.py                     # all configurations
+    python3 benchmarks/e2e.py -c images -c slow   # only some
+    python3 benchmarks/e2e.py images slow         # the same
+    python3 benchmarks/e2e.py --repeat=3 --json=results.json
+    python3 benchmarks/e2e.py --list
+
+For each configuration the fastest of the repeated runs is reported:
+pages/sec, MB/sec (of retrieved data), peak RSS and output size.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, os, time, json, getopt, shutil, subprocess, tempfile
+
+from synthsite import SyntheticSite, SiteServer
+
+
+TOP_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+
+# name -> (site parameters, plucker-build options)
+CONFIGURATIONS = {
+    'small':    ({'pages': 50, 'fanout': 4, 'images': 0},
+                 ['-M', '6']),
+    'text':     ({'pages': 300, 'fanout': 6, 'paragraphs': 16, 'images': 0},
+                 ['-M', '8']),
+    'images':   ({'pages': 40, 'fanout': 3, 'images': 3,
+                  'image_sizes': [(160, 120), (640, 480)],
+                  'image_formats': ['png', 'gif', 'jpeg']},
+                 ['-M', '6', '--bpp=8']),
+    'tables':   ({'pages': 100, 'fanout': 4, 'images': 0, 'tables': 3},
+                 ['-M', '6', '--tables']),
+    'zlib':     ({'pages': 300, 'fanout': 6, 'paragraphs': 16, 'images': 0},
+                 ['-M', '8', '--zlib-compression']),
+    'jobs':     ({'pages': 300, 'fanout': 6, 'paragraphs': 16, 'images': 0},
+                 ['-M', '8', '--writer-jobs=0']),
+    'slow':     ({'pages': 50, 'fanout': 4, 'images': 0, 'slow_links': 1, 'slow_delay': 0.05},
+                 ['-M', '6']),
+    'failing':  ({'pages': 100, 'fanout': 4, 'images': 0, 'failing_links': 2},
+                 ['-M', '6']),
+}
+
+
+def run_build (home_url, options, workdir):
+    """Run plucker-build in a child process.  Returns (wall seconds,
+    peak RSS in bytes, metrics dictionary)"""
+    metrics_file = os.path.join (workdir, 'metrics.json')
+    env = dict (os.environ)
+    env['HOME'] = workdir
+    env['PLUCKERHOME'] = workdir
+    env['PYTHONPATH'] = TOP_DIR + os.pathsep + env.get ('PYTHONPATH', '')
+    env['no_proxy'] = '127.0.0.1,localhost'
+    command = [sys.executable, os.path.join (TOP_DIR, 'bin', 'plucker-build'),
+               '-q', '-P', workdir, '-p', workdir, '-f', 'bench', '-H', home_url,
+               '--metrics=' + metrics_file] + options
+    devnull = open (os.devnull, 'w')
+    start = time.perf_counter ()
+    child = subprocess.Popen (command, env=env, stdout=devnull, stderr=subprocess.PIPE)
+    # wait4() gives us the resource usage of just this child
+    (pid, status, rusage) = os.wait4 (child.pid, 0)
+    wall = time.perf_counter () - start
+    child.returncode = os.waitstatus_to_exitcode (status)
+    errors = child.stderr.read ().decode ('utf-8', 'replace')
+    child.stderr.close ()
+    devnull.close ()
+    if child.returncode != 0:
+        raise RuntimeError ("build failed with exit code %d:\n%s" % (child.returncode, errors))
+    peak_rss = rusage.ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss = peak_rss * 1024
+    f = open (metrics_file)
+    metrics = json.load (f)
+    f.close ()
+    return (wall, peak_rss, metrics)
+
+
+def run_configuration (name, repeat=1):
+    """Run configuration 'name' 'repeat' times and return a dictionary
+    of results for the fastest run"""
+    (parameters, options) = CONFIGURATIONS[name]
+    best = None
+    with SiteServer (SyntheticSite (parameters)) as server:
+        for i in range (repeat):
+            workdir = tempfile.mkdtemp (prefix='plucker-bench-')
+            try:
+                (wall, peak_rss, metrics) = run_build (server.home_url (), options, workdir)
+            finally:
+                shutil.rmtree (workdir, ignore_errors=True)
+            if best is None or wall < best[0]:
+                best = (wall, peak_rss, metrics)
+    (wall, peak_rss, metrics) = best
+    counters = metrics['counters']
+    pages = counters.get ('pages_fetched', 0)
+    bytes_in = counters.get ('bytes_in', 0)
+    return {'configuration': name,
+            'parameters': parameters,
+            'options': options,
+            'seconds': round (wall, 3),
+            'pages': pages,
+            'images': counters.get ('images_fetched', 0),
+            'failures': counters.get ('fetch_failures', 0),
+            'pages_per_second': round (pages / wall, 2),
+            'mb_per_second': round (bytes_in / wall / (1024.0 * 1024.0), 3),
+            'peak_rss_mb': round (peak_rss / (1024.0 * 1024.0), 1),
+            'output_bytes': metrics['values'].get ('pdb_bytes'),
+            'stages': dict ([(stage, entry['seconds']) for (stage, entry) in metrics['stages'].items ()])}
+
+
+def print_results (results):
+    print ("%-10s %8s %6s %6s %6s %9s %8s %9s %10s" % ("Config", "Seconds", "Pages", "Images", "Failed",
+                                                       "Pages/s", "MB/s", "Peak MB", "Output"))
+    for r in results:
+        print ("%-10s %8.2f %6d %6d %6d %9.1f %8.3f %9.1f %10s" % (r['configuration'], r['seconds'], r['pages'],
+                                                                  r['images'], r['failures'],
+                                                                  r['pages_per_second'], r['mb_per_second'],
+                                                                  r['peak_rss_mb'], r['output_bytes']))
+
+
+def usage ():
+    sys.stderr.write ("Usage: %s [-c <configuration>]... [--repeat=<n>] [--json=<file>] [--list] [<configuration>...]\n" % sys.argv[0])
+    sys.exit (1)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "c:h", ["config=", "repeat=", "json=", "list", "help"])
+    except getopt.error as text:
+        sys.stderr.write ("%s\n" % text)
+        usage ()
+    names = []
+    repeat = 1
+    json_file = None
+    for (opt, arg) in opts:
+        if opt in ("-c", "--config"):
+            if arg not in CONFIGURATIONS:
+                sys.stderr.write ("Unknown configuration '%s'\n" % arg)
+                usage ()
+            names.append (arg)
+        elif opt == "--repeat":
+            repeat = max (int (arg), 1)
+        elif opt == "--json":
+            json_file = arg
+        elif opt == "--list":
+            for name in sorted (CONFIGURATIONS.keys ()):
+                print ("%-10s %s %s" % (name, CONFIGURATIONS[name][0], " ".join (CONFIGURATIONS[name][1])))
+            return 0
+        else:
+            usage ()
+    for arg in args:
+        if arg not in CONFIGURATIONS:
+            sys.stderr.write ("Unknown configuration '%s'\n" % arg)
+            usage ()
+        names.append (arg)
+    if not names:
+        names = sorted (CONFIGURATIONS.keys ())
+
+    results = []
+    for name in names:
+        sys.stderr.write ("Running %s...\n" % name)
+        results.append (run_configuration (name, repeat))
+    print_results (results)
+    if json_file:
+        f = open (json_file, 'w')
+        json.dump ({'timestamp': int (time.time ()), 'python': sys.version.split ()[0],
+                    'results': results}, f, indent=1, sort_keys=True)
+        f.close ()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
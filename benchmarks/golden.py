@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+golden.py
+
+Golden output checks for optimisation work.
+
+benchmarks/golden/corpus holds a small site of pages and images.  For
+each case in CASES, the corpus is built with plucker-build and the
+output is compared with the golden output in benchmarks/golden/expected:
+a PDB file, or a cache directory for the 'cache' case.  Differences
+are reported per record: text records are disassembled with
+PluckerDocs.Undump_PluckerDocument and compared paragraph by paragraph
+and opcode by opcode, so a change shows up as e.g.
+
+    record 12 (text): paragraph 5, item 3: TEXT 'a b' != TEXT 'a  b'
+
+and a record which only got encoded differently (e.g. by a new
+compressor) but has the same contents is reported as such.  The dates
+in the PDB header are ignored.
+
+    python3 benchmarks/golden.py check [<case>...]    # exit code 1 on differences
+    python3 benchmarks/golden.py update [<case>...]   # rewrite the golden outputs
+    python3 benchmarks/golden.py diff <old> <new>     # compare two PDB files or cache dirs
+
+Image records depend on the Pillow version that converted them, so an
+update of Pillow may need an 'update' too.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, os, struct, getopt, shutil, subprocess, tempfile
+
+TOP_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+GOLDEN_DIR = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'golden')
+CORPUS_DIR = os.path.join (GOLDEN_DIR, 'corpus')
+EXPECTED_DIR = os.path.join (GOLDEN_DIR, 'expected')
+sys.path.insert (0, TOP_DIR)
+
+from PyPlucker import PluckerDocs, UtilFns
+from PyPlucker.helper import prc
+
+
+# name -> plucker-build options
+CASES = {
+    'doc':   ['-M', '4', '--bpp=4', '--maxwidth=150', '--alt-maxwidth=300'],
+    'zlib':  ['-M', '4', '--bpp=4', '--maxwidth=150', '--alt-maxwidth=300', '--zlib-compression'],
+    'color': ['-M', '4', '--bpp=8', '--maxwidth=150', '--alt-maxwidth=300', '--tables'],
+    'bpp16': ['-M', '4', '--bpp=16', '--maxwidth=150', '--alt-maxwidth=300', '--tables',
+              '--category=Golden'],
+    'cache': ['-M', '4', '--bpp=4', '--maxwidth=150', '--alt-maxwidth=300', '-c'],
+}
+
+_TYPE_NAMES = {
+    PluckerDocs.DOCTYPE_HTML: 'text',
+    PluckerDocs.DOCTYPE_HTML_COMPRESSED: 'text',
+    PluckerDocs.DOCTYPE_IMAGE: 'image',
+    PluckerDocs.DOCTYPE_IMAGE_COMPRESSED: 'image',
+    PluckerDocs.DOCTYPE_MAILTO: 'mailto',
+    PluckerDocs.DOCTYPE_LINK_INDEX: 'link index',
+    PluckerDocs.DOCTYPE_LINKS: 'links',
+    PluckerDocs.DOCTYPE_LINKS_COMPRESSED: 'links',
+    PluckerDocs.DOCTYPE_BOOKMARKS: 'bookmarks',
+    PluckerDocs.DOCTYPE_CATEGORY: 'category',
+    PluckerDocs.DOCTYPE_METADATA: 'metadata',
+    PluckerDocs.DOCTYPE_TABLE: 'table',
+    PluckerDocs.DOCTYPE_TABLE_COMPRESSED: 'table',
+    PluckerDocs.DOCTYPE_MULTIIMAGE: 'multi image',
+}
+
+# types whose body after the 8 byte header may be compressed
+_COMPRESSED_TYPES = (PluckerDocs.DOCTYPE_LINKS_COMPRESSED, PluckerDocs.DOCTYPE_TABLE_COMPRESSED)
+
+
+##
+## Reading outputs
+##
+
+def read_output (path):
+    """Return (header info, {record id: data}) for a PDB file or a
+    cache directory"""
+    records = {}
+    if os.path.isdir (path):
+        for name in os.listdir (path):
+            if name.isdigit ():
+                f = open (os.path.join (path, name), 'rb')
+                records[int (name)] = f.read ()
+                f.close ()
+        return ({}, records)
+    pdb = prc.File (path, read=1, write=0)
+    info = dict (pdb.getDBInfo ())
+    for key in ('createDate', 'modifyDate', 'backupDate'):
+        info.pop (key, None)
+    info['appBlock'] = pdb.getAppBlock ()
+    for record in pdb.data:
+        records[record.id] = record.raw
+    return (info, records)
+
+
+def _use_compression (records):
+    """Select the uncompression used for the records from the
+    compression type in the index record"""
+    index = records.get (1)
+    if index is not None and len (index) >= 6 and struct.unpack (">HHH", index[:6])[1] == PluckerDocs.DBTYPE_ZLIB:
+        PluckerDocs.UseZLibCompression ()
+    else:
+        PluckerDocs.UseDocCompression ()
+
+
+def _record_type (id, data):
+    if id == 1:
+        return (None, 'index')
+    if len (data) < 8:
+        return (None, 'short')
+    (uid, paragraphs, size, content_type, flags) = struct.unpack (">HHHBB", data[:8])
+    content_type = content_type << 8
+    return (content_type, _TYPE_NAMES.get (content_type, 'type %d' % (content_type >> 8)))
+
+
+def _short (value, length=40):
+    text = repr (value)
+    if len (text) > length:
+        text = text[:length - 5] + '...' + text[-2:]
+    return text
+
+
+def _paragraph_ops (paragraph):
+    ops = []
+    for (tag, value) in paragraph._items:
+        name = PluckerDocs.CMD_NAMES[tag - 1]
+        if value is None:
+            ops.append (name)
+        else:
+            ops.append ("%s %s" % (name, _short (value)))
+    return ops
+
+
+def _decode (id, data, content_type, name):
+    """Return the decoded contents of a record for comparison"""
+    if name == 'index':
+        (uid, compression, count) = struct.unpack (">HHH", data[:6])
+        return [("compression", compression)] + \
+               [struct.unpack (">HH", data[6 + i * 4:10 + i * 4]) for i in range (count)]
+    if name in ('text', 'image', 'mailto'):
+        doc = PluckerDocs.Undump_PluckerDocument ("record %d" % id, data)
+        if name == 'text':
+            return [(paragraph._extra_space, _paragraph_ops (paragraph))
+                    for paragraph in doc._paragraphs]
+        return doc._data
+    body = data[8:]
+    if content_type in _COMPRESSED_TYPES:
+        body = PluckerDocs.UncompressFunction (body)
+    return body
+
+
+##
+## Comparing
+##
+
+def _first_difference (a, b):
+    for i in range (min (len (a), len (b))):
+        if a[i] != b[i]:
+            return i
+    return min (len (a), len (b))
+
+
+def _describe_difference (id, old_records, new_records, max_items):
+    """Return lines describing how record 'id' changed.  Each side is
+    decoded with the compression of its own document."""
+    (old, new) = (old_records[id], new_records[id])
+    (old_type, old_name) = _record_type (id, old)
+    (new_type, new_name) = _record_type (id, new)
+    label = "record %d (%s)" % (id, new_name)
+    if old_name != new_name:
+        return ["record %d: type changed from %s to %s" % (id, old_name, new_name)]
+    try:
+        _use_compression (old_records)
+        old_contents = _decode (id, old, old_type, old_name)
+        _use_compression (new_records)
+        new_contents = _decode (id, new, new_type, new_name)
+    except Exception as text:
+        offset = _first_difference (old, new)
+        return ["%s: cannot decode (%s); bytes differ from offset %d (%d != %d bytes)"
+                % (label, text, offset, len (old), len (new))]
+
+    if old_contents == new_contents:
+        return ["%s: same contents, encoded differently (%d -> %d bytes)" % (label, len (old), len (new))]
+
+    lines = []
+    if old[:8] != new[:8] and old_name != 'index':
+        lines.append ("%s: header %s -> %s" % (label, struct.unpack (">HHHBB", old[:8]),
+                                              struct.unpack (">HHHBB", new[:8])))
+    if old_name == 'text':
+        if len (old_contents) != len (new_contents):
+            lines.append ("%s: %d -> %d paragraphs" % (label, len (old_contents), len (new_contents)))
+        for i in range (min (len (old_contents), len (new_contents))):
+            ((old_space, old_ops), (new_space, new_ops)) = (old_contents[i], new_contents[i])
+            if old_space != new_space:
+                lines.append ("%s: paragraph %d, extra space %d -> %d" % (label, i, old_space, new_space))
+            j = _first_difference (old_ops, new_ops)
+            if j < len (old_ops) or j < len (new_ops):
+                old_op = (j < len (old_ops) and old_ops[j]) or "(end)"
+                new_op = (j < len (new_ops) and new_ops[j]) or "(end)"
+                lines.append ("%s: paragraph %d, item %d: %s != %s" % (label, i, j, old_op, new_op))
+            if len (lines) >= max_items:
+                lines.append ("%s: ..." % label)
+                break
+    elif old_name == 'index':
+        lines.append ("%s: %s -> %s" % (label, old_contents, new_contents))
+    else:
+        offset = _first_difference (old_contents, new_contents)
+        lines.append ("%s: contents differ from offset %d (%d -> %d bytes)"
+                      % (label, offset, len (old_contents), len (new_contents)))
+    return lines
+
+
+def compare_outputs (old_path, new_path, max_items=10):
+    """Compare two outputs.  Returns a list of lines describing the
+    differences; empty if they are the same."""
+    (old_info, old_records) = read_output (old_path)
+    (new_info, new_records) = read_output (new_path)
+    lines = []
+    for key in sorted (set (old_info.keys ()) | set (new_info.keys ())):
+        if old_info.get (key) != new_info.get (key):
+            lines.append ("header %s: %s -> %s" % (key, _short (old_info.get (key)), _short (new_info.get (key))))
+    old_ids = set (old_records.keys ())
+    new_ids = set (new_records.keys ())
+    if old_ids - new_ids:
+        lines.append ("records missing: %s" % " ".join (map (str, sorted (old_ids - new_ids))))
+    if new_ids - old_ids:
+        lines.append ("records added: %s" % " ".join (map (str, sorted (new_ids - old_ids))))
+    for id in sorted (old_ids & new_ids):
+        if old_records[id] != new_records[id]:
+            lines.extend (_describe_difference (id, old_records, new_records, max_items))
+    return lines
+
+
+##
+## Building
+##
+
+def build_case (name, outdir):
+    """Build the corpus for case 'name' into 'outdir'.  Returns the
+    path of the output (PDB file or cache directory)."""
+    env = dict (os.environ)
+    env['HOME'] = outdir
+    env['PYTHONPATH'] = TOP_DIR + os.pathsep + env.get ('PYTHONPATH', '')
+    env.pop ('PLUCKERDIR', None)
+    env.pop ('PLUCKERHOME', None)
+    options = CASES[name]
+    if '-c' in options:
+        output = os.path.join (outdir, 'cache')
+        os.mkdir (output)
+    else:
+        output = os.path.join (outdir, name + '.pdb')
+        options = ['-f', name, '-N', 'Golden ' + name] + options
+    # plucker: URLs keep the location of the corpus out of the output
+    command = [sys.executable, os.path.join (TOP_DIR, 'bin', 'plucker-build'), '-q',
+               '-P', CORPUS_DIR, '-p', outdir, '-H', 'plucker:/index.html'] + options
+    result = subprocess.run (command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError ("building case %s failed:\n%s" % (name, result.stderr.decode ('utf-8', 'replace')))
+    return output
+
+
+def _expected_path (name):
+    if '-c' in CASES[name]:
+        return os.path.join (EXPECTED_DIR, name)
+    return os.path.join (EXPECTED_DIR, name + '.pdb')
+
+
+def check (names, verbose=0, max_items=10):
+    failed = 0
+    for name in names:
+        workdir = tempfile.mkdtemp (prefix='plucker-golden-')
+        try:
+            output = build_case (name, workdir)
+            lines = compare_outputs (_expected_path (name), output, max_items)
+        finally:
+            shutil.rmtree (workdir, ignore_errors=True)
+        if lines:
+            failed = failed + 1
+            print ("%s: DIFFERENT" % name)
+            for line in lines:
+                print ("  " + line)
+        else:
+            print ("%s: same" % name)
+    return failed
+
+
+def update (names):
+    if not os.path.isdir (EXPECTED_DIR):
+        os.makedirs (EXPECTED_DIR)
+    for name in names:
+        workdir = tempfile.mkdtemp (prefix='plucker-golden-')
+        try:
+            output = build_case (name, workdir)
+            expected = _expected_path (name)
+            if os.path.isdir (expected):
+                shutil.rmtree (expected)
+            elif os.path.exists (expected):
+                os.unlink (expected)
+            if os.path.isdir (output):
+                shutil.copytree (output, expected)
+            else:
+                shutil.copyfile (output, expected)
+        finally:
+            shutil.rmtree (workdir, ignore_errors=True)
+        print ("%s: updated %s" % (name, os.path.relpath (expected, TOP_DIR)))
+
+
+def usage ():
+    sys.stderr.write ("Usage: %s check|update [<case>...]\n"
+                      "       %s diff <old pdb or cache dir> <new pdb or cache dir>\n"
+                      "Options: --max-items=<n> (differences shown per record)\n"
+                      % (sys.argv[0], sys.argv[0]))
+    sys.exit (2)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "h", ["max-items=", "help"])
+    except getopt.error as text:
+        sys.stderr.write ("%s\n" % text)
+        usage ()
+    max_items = 10
+    for (opt, arg) in opts:
+        if opt == "--max-items":
+            max_items = int (arg)
+        else:
+            usage ()
+    if not args:
+        usage ()
+    UtilFns.CurrentVerbosityLevel = 0
+    command = args[0]
+    if command == 'diff':
+        if len (args) != 3:
+            usage ()
+        lines = compare_outputs (args[1], args[2], max_items)
+        for line in lines:
+            print (line)
+        return (lines and 1) or 0
+    names = args[1:] or sorted (CASES.keys ())
+    for name in names:
+        if name not in CASES:
+            sys.stderr.write ("Unknown case '%s'\n" % name)
+            usage ()
+    if command == 'check':
+        return (check (names, max_items=max_items) and 1) or 0
+    elif command == 'update':
+        update (names)
+        return 0
+    usage ()
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+"""
+micro.py
+
+Microbenchmarks for the CPU kernels of a build.
+
+Each benchmark times one kernel on fixed, generated input (pages from
+synthsite.py, generated images), so results are comparable between
+commits on the same machine.  Every kernel is run in loops of at
+least --min-time seconds, the loop is repeated --repeat times, and the
+fastest time per call is reported.
+
+    python3 benchmarks/micro.py                       # run everything
+    python3 benchmarks/micro.py -k compress -k image  # only matching kernels
+    python3 benchmarks/micro.py --json=results.json
+    python3 benchmarks/micro.py --save-baseline=mybox
+    python3 benchmarks/micro.py --compare=mybox       # exit code 1 on regression
+
+Baselines are the JSON results stored in benchmarks/baselines/<name>.json
+(or any file name given to --compare).  Timings only compare on the same
+machine and Python version, so keep one baseline per machine.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, os, io, gc, json, time, getopt, platform, tempfile, shutil, subprocess
+
+TOP_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+BASELINE_DIR = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'baselines')
+sys.path.insert (0, TOP_DIR)
+
+from synthsite import SyntheticSite
+
+
+##
+## Input data, shared by the benchmarks
+##
+
+class Inputs:
+
+    """Lazily built input data: configuration, pages, parsed
+    documents, images"""
+
+    def __init__ (self):
+        self._workdir = tempfile.mkdtemp (prefix='plucker-micro-')
+        self._site = SyntheticSite ({'pages': 40, 'fanout': 8, 'paragraphs': 12, 'images': 2,
+                                     'tables': 1, 'seed': 7})
+        self._cache = {}
+
+    def cleanup (self):
+        shutil.rmtree (self._workdir, ignore_errors=True)
+
+    def _get (self, name, function):
+        if name not in self._cache:
+            self._cache[name] = function ()
+        return self._cache[name]
+
+    def config (self):
+        def make ():
+            from PyPlucker import ConfigFiles
+            # keep the user's own config files out of it
+            os.environ['HOME'] = self._workdir
+            config = ConfigFiles.Configuration (self._workdir, self._workdir)
+            config.set ('verbosity', 0)
+            return config
+        return self._get ('config', make)
+
+    def pages (self):
+        """List of (url, html bytes)"""
+        return self._get ('pages', lambda: [("http://localhost/page/%d.html" % i, self._site.page (i))
+                                            for i in range (self._site.parameters['pages'])])
+
+    def documents (self):
+        """Parsed pages as a collection, as the spider would build it"""
+        def make ():
+            from PyPlucker import Parser
+            from PyPlucker.SeenSet import key_hash
+            collection = {}
+            for (url, html) in self.pages ():
+                doc = Parser.generic_parser (url, {'Content-Type': 'text/html', 'URL': url},
+                                             html, self.config (), {})
+                collection[key_hash (url + '\0')] = (url, doc)
+            return collection
+        return self._get ('documents', make)
+
+    def mapper (self):
+        def make ():
+            from PyPlucker.Writer import Mapper
+            mapper = Mapper (self.documents (), {})
+            for doc in mapper.get_docs ():
+                mapper.get_or_add (doc)
+                if doc.is_text_document ():
+                    doc.resolve_ids (mapper)
+            return mapper
+        return self._get ('mapper', make)
+
+    def paragraphs (self):
+        def make ():
+            self.mapper ()
+            result = []
+            for (url, doc) in self.documents ().values ():
+                for subdoc in doc.get_documents ():
+                    result.extend (subdoc._paragraphs)
+            return result
+        return self._get ('paragraphs', make)
+
+    def text_record (self):
+        """About 4 KB of uncompressed text record body"""
+        def make ():
+            data = b"".join ([p._dump_record_body (1, 1)[0] for p in self.paragraphs ()])
+            return data[:4096]
+        return self._get ('text_record', make)
+
+    def image_data (self, format='png', size=(320, 240)):
+        return self._get (('image', format, size),
+                          lambda: self._site.image ("micro-0.%s" % format, size[0], size[1])[1])
+
+    def records (self):
+        """List of (id, data) as written to a PDB"""
+        def make ():
+            mapper = self.mapper ()
+            result = []
+            for (url, doc) in self.documents ().values ():
+                for (url, id, dump) in doc.dump_record_with_splits (mapper):
+                    result.append ((id, dump))
+            result.sort ()
+            return result
+        return self._get ('records', make)
+
+
+##
+## The benchmarks.  Each one takes the Inputs and returns a function
+## doing one unit of work, and the number of bytes that unit
+## processes (or None).
+##
+
+def bench_doc_compress (inputs):
+    from PyPlucker.helper import doc_compress
+    data = inputs.text_record ()
+    return (lambda: doc_compress.compress (data), len (data))
+
+def bench_doc_compress_lazy (inputs):
+    from PyPlucker.helper import doc_compress
+    data = inputs.text_record ()
+    return (lambda: doc_compress.compress (data, lazy=1), len (data))
+
+def bench_doc_compress_reference (inputs):
+    from PyPlucker.helper import doc_compress
+    data = inputs.text_record ()
+    return (lambda: doc_compress.compress_reference (data), len (data))
+
+def _binary_record (inputs):
+    # image records are DOC compressed too: 4 KB of a 8 bpp Palm bitmap
+    from PIL import Image
+    import PyPlucker.PalmImagePlugin
+    out = io.BytesIO ()
+    Image.open (io.BytesIO (inputs.image_data ())).convert ('P').save (out, "Palm", bpp=8)
+    return out.getvalue ()[:4096]
+
+def bench_doc_compress_binary (inputs):
+    from PyPlucker.helper import doc_compress
+    data = _binary_record (inputs)
+    return (lambda: doc_compress.compress (data), len (data))
+
+def bench_doc_compress_reference_binary (inputs):
+    from PyPlucker.helper import doc_compress
+    data = _binary_record (inputs)
+    return (lambda: doc_compress.compress_reference (data), len (data))
+
+def bench_doc_compress_data (inputs):
+    # a whole record, compressed block by block
+    from PyPlucker import PluckerDocs
+    data = b"".join ([p._dump_record_body (1, 1)[0] for p in inputs.paragraphs ()])[:30000]
+    return (lambda: PluckerDocs.DocCompressData (data), len (data))
+
+def bench_doc_uncompress (inputs):
+    from PyPlucker.helper import doc_compress
+    data = inputs.text_record ()
+    compressed = doc_compress.compress (data)
+    return (lambda: doc_compress.uncompress (compressed), len (data))
+
+def bench_html_parse (inputs):
+    from PyPlucker.TextParser import StructuredHTMLParser
+    config = inputs.config ()
+    pages = inputs.pages ()[:10]
+    def run ():
+        for (url, html) in pages:
+            StructuredHTMLParser (url, html, {}, config, {}).get_plucker_doc ()
+    return (run, sum ([len (html) for (url, html) in pages]))
+
+def bench_doc_uncompress_reference (inputs):
+    from PyPlucker.helper import doc_compress
+    data = inputs.text_record ()
+    compressed = doc_compress.compress (data)
+    return (lambda: doc_compress.uncompress_reference (compressed), len (data))
+
+def bench_doc_uncompress_data (inputs):
+    # a whole record, as read back from a document
+    from PyPlucker import PluckerDocs
+    data = b"".join ([p._dump_record_body (1, 1)[0] for p in inputs.paragraphs ()])[:30000]
+    compressed = PluckerDocs.DocCompressData (data)
+    return (lambda: PluckerDocs.DocUncompressData (compressed), len (data))
+
+def _bench_zlib_compress (level, owner_id=None):
+    def bench (inputs):
+        # a whole record, as compressed with --zlib-compression
+        from PyPlucker import PluckerDocs
+        data = b"".join ([p._dump_record_body (1, 1)[0] for p in inputs.paragraphs ()])[:30000]
+        key = owner_id and PluckerDocs.OwnerIdKey (owner_id)
+        compressor = PluckerDocs.ZLibCompressor (key, level)
+        return (lambda: compressor (data), len (data))
+    return bench
+
+def bench_paragraph_dump (inputs):
+    paragraphs = inputs.paragraphs ()
+    def run ():
+        for p in paragraphs:
+            p._dump_record_body (1, 1)
+    return (run, sum ([len (p._dump_record_body (1, 1)[0]) for p in paragraphs]))
+
+def _bench_pillow_convert (bpp):
+    def bench (inputs):
+        from PyPlucker.ImageParser import PillowImageParser
+        parser = PillowImageParser ("http://localhost/image.png", "image/png",
+                                    inputs.image_data (), inputs.config (), {})
+        (width, height) = parser.size ()
+        return (lambda: parser.convert (width, height, bpp, None), None)
+    return bench
+
+def bench_palm_save_rgb (inputs):
+    from PIL import Image
+    import PyPlucker.PalmImagePlugin
+    image = Image.open (io.BytesIO (inputs.image_data ())).convert ('RGB')
+    def run ():
+        out = io.BytesIO ()
+        image.save (out, "Palm", bpp=16)
+    return (run, image.size[0] * image.size[1] * 3)
+
+def bench_mapper (inputs):
+    from PyPlucker.Writer import Mapper
+    collection = inputs.documents ()
+    return (lambda: Mapper (collection, {}), None)
+
+def _bench_prc_write (streaming):
+    def bench_prc_write (inputs):
+        from PyPlucker.helper import prc
+        records = inputs.records ()
+        filename = os.path.join (inputs._workdir, 'micro.pdb')
+        def run ():
+            if streaming:
+                pdb = prc.StreamFile (filename)
+                pdb.reserve ([id for (id, data) in records])
+            else:
+                pdb = prc.File (filename, read=0, write=1)
+            info = pdb.getDBInfo ()
+            info['name'] = 'micro'
+            info['type'] = 'Data'
+            info['creator'] = 'Plkr'
+            pdb.setDBInfo (info)
+            for (id, data) in records:
+                pdb.setRecord (attr=0, id=id, cat=0, data=data)
+            pdb.close ()
+        return (run, sum ([len (data) for (id, data) in records]))
+    return bench_prc_write
+
+def _bench_prc_read (mapped):
+    def bench_prc_read (inputs):
+        from PyPlucker.helper import prc
+        records = inputs.records ()
+        filename = os.path.join (inputs._workdir, 'micro-read.pdb')
+        pdb = prc.StreamFile (filename)
+        for (id, data) in records:
+            pdb.setRecord (attr=0, id=id, cat=0, data=data)
+        pdb.close ()
+        def run ():
+            if mapped:
+                pdb = prc.MappedFile (filename)
+                sizes = [len (pdb.getRecord (i)[0]) for i in range (pdb.getRecords ())]
+                pdb.close ()
+            else:
+                pdb = prc.File (filename, read=1, write=0)
+                sizes = [len (pdb.getRecord (i)[0]) for i in range (pdb.getRecords ())]
+        return (run, os.path.getsize (filename))
+    return bench_prc_read
+
+BENCHMARKS = [
+    ('doc_compress.compress', bench_doc_compress),
+    ('doc_compress.compress lazy', bench_doc_compress_lazy),
+    ('doc_compress.compress_reference', bench_doc_compress_reference),
+    ('doc_compress.compress binary', bench_doc_compress_binary),
+    ('doc_compress.compress_reference binary', bench_doc_compress_reference_binary),
+    ('PluckerDocs.DocCompressData 30KB', bench_doc_compress_data),
+    ('doc_compress.uncompress', bench_doc_uncompress),
+    ('doc_compress.uncompress_reference', bench_doc_uncompress_reference),
+    ('PluckerDocs.DocUncompressData 30KB', bench_doc_uncompress_data),
+    ('PluckerDocs.ZLibCompressor 30KB', _bench_zlib_compress (-1)),
+    ('PluckerDocs.ZLibCompressor 30KB owner-id', _bench_zlib_compress (-1, "Palm User")),
+    ('PluckerDocs.ZLibCompressor 30KB auto', _bench_zlib_compress ('auto')),
+    ('StructuredHTMLParser', bench_html_parse),
+    ('PluckerTextParagraph._dump_record_body', bench_paragraph_dump),
+    ('PillowImageParser.convert bpp=1', _bench_pillow_convert (1)),
+    ('PillowImageParser.convert bpp=2', _bench_pillow_convert (2)),
+    ('PillowImageParser.convert bpp=4', _bench_pillow_convert (4)),
+    ('PillowImageParser.convert bpp=8', _bench_pillow_convert (8)),
+    ('PillowImageParser.convert bpp=16', _bench_pillow_convert (16)),
+    ('PalmImagePlugin._save RGB', bench_palm_save_rgb),
+    ('Mapper', bench_mapper),
+    ('prc.File write', _bench_prc_write (0)),
+    ('prc.StreamFile write', _bench_prc_write (1)),
+    ('prc.File read', _bench_prc_read (0)),
+    ('prc.MappedFile read', _bench_prc_read (1)),
+]
+
+
+##
+## Running and comparing
+##
+
+def time_function (function, min_time, repeat):
+    """Return (best seconds per call, median seconds per call, loops)"""
+    # find a loop count taking at least min_time
+    loops = 1
+    while 1:
+        start = time.perf_counter ()
+        for i in range (loops):
+            function ()
+        elapsed = time.perf_counter () - start
+        if elapsed >= min_time:
+            break
+        loops = loops * max (2, min (10, int (min_time / max (elapsed, 1e-9)) + 1))
+    times = [elapsed / loops]
+    gc_was_enabled = gc.isenabled ()
+    gc.disable ()
+    try:
+        for i in range (repeat - 1):
+            start = time.perf_counter ()
+            for j in range (loops):
+                function ()
+            times.append ((time.perf_counter () - start) / loops)
+    finally:
+        if gc_was_enabled:
+            gc.enable ()
+    times.sort ()
+    return (times[0], times[len (times) // 2], loops)
+
+
+def _git_commit ():
+    try:
+        return subprocess.check_output (['git', 'rev-parse', '--short', 'HEAD'], cwd=TOP_DIR,
+                                        stderr=subprocess.DEVNULL).decode ('ascii').strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks (patterns=[], min_time=0.2, repeat=5):
+    from PyPlucker import UtilFns
+    UtilFns.CurrentVerbosityLevel = 0
+    inputs = Inputs ()
+    results = {}
+    try:
+        for (name, bench) in BENCHMARKS:
+            if patterns and not [p for p in patterns if p.lower () in name.lower ()]:
+                continue
+            (function, size) = bench (inputs)
+            (best, median, loops) = time_function (function, min_time, repeat)
+            entry = {'seconds': best, 'median_seconds': median, 'loops': loops}
+            if size:
+                entry['bytes'] = size
+                entry['mb_per_second'] = round (size / best / (1024.0 * 1024.0), 3)
+            results[name] = entry
+            sys.stderr.write ("%-42s %12.1f us%s\n" % (name, best * 1e6,
+                                                      (size and "  %8.2f MB/s" % entry['mb_per_second']) or ""))
+    finally:
+        inputs.cleanup ()
+    return {'timestamp': int (time.time ()),
+            'commit': _git_commit (),
+            'python': platform.python_version (),
+            'machine': platform.machine (),
+            'platform': platform.platform (),
+            'results': results}
+
+
+def _baseline_file (name):
+    if os.sep in name or name.endswith ('.json'):
+        return name
+    return os.path.join (BASELINE_DIR, name + '.json')
+
+
+def compare (current, baseline, threshold):
+    """Print the change against 'baseline' per kernel.  Returns the
+    names of the kernels which got slower by more than 'threshold'
+    (a factor, e.g. 1.1)"""
+    regressions = []
+    print ("%-42s %12s %12s %8s" % ("Kernel", "Baseline us", "Now us", "Change"))
+    for (name, entry) in sorted (current['results'].items ()):
+        old = baseline['results'].get (name)
+        if old is None:
+            print ("%-42s %12s %12.1f %8s" % (name, "-", entry['seconds'] * 1e6, "new"))
+            continue
+        ratio = entry['seconds'] / old['seconds']
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            regressions.append (name)
+        elif ratio < 1.0 / threshold:
+            flag = "  faster"
+        print ("%-42s %12.1f %12.1f %+7.1f%%%s" % (name, old['seconds'] * 1e6, entry['seconds'] * 1e6,
+                                                   (ratio - 1.0) * 100.0, flag))
+    return regressions
+
+
+def usage ():
+    sys.stderr.write ("Usage: %s [-k <pattern>]... [--min-time=<s>] [--repeat=<n>] [--json=<file>]\n"
+                      "       [--save-baseline=<name>] [--compare=<name>] [--threshold=<factor>] [--list]\n"
+                      % sys.argv[0])
+    sys.exit (2)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "k:h", ["min-time=", "repeat=", "json=", "save-baseline=",
+                                                        "compare=", "threshold=", "list", "help"])
+    except getopt.error as text:
+        sys.stderr.write ("%s\n" % text)
+        usage ()
+    patterns = []
+    min_time = 0.2
+    repeat = 5
+    json_file = None
+    save_baseline = None
+    compare_with = None
+    threshold = 1.10
+    for (opt, arg) in opts:
+        if opt == "-k":
+            patterns.append (arg)
+        elif opt == "--min-time":
+            min_time = float (arg)
+        elif opt == "--repeat":
+            repeat = max (int (arg), 1)
+        elif opt == "--json":
+            json_file = arg
+        elif opt == "--save-baseline":
+            save_baseline = arg
+        elif opt == "--compare":
+            compare_with = arg
+        elif opt == "--threshold":
+            threshold = float (arg)
+        elif opt == "--list":
+            for (name, bench) in BENCHMARKS:
+                print (name)
+            return 0
+        else:
+            usage ()
+
+    baseline = None
+    if compare_with:
+        f = open (_baseline_file (compare_with))
+        baseline = json.load (f)
+        f.close ()
+
+    current = run_benchmarks (patterns, min_time, repeat)
+
+    for filename in (json_file, save_baseline and _baseline_file (save_baseline)):
+        if filename:
+            f = open (filename, 'w')
+            json.dump (current, f, indent=1, sort_keys=True)
+            f.write ("\n")
+            f.close ()
+            sys.stderr.write ("Results written to %s\n" % filename)
+
+    if baseline is not None:
+        if baseline.get ('python') != current['python'] or baseline.get ('machine') != current['machine']:
+            sys.stderr.write ("Warning: baseline is from Python %s on %s\n"
+                              % (baseline.get ('python'), baseline.get ('machine')))
+        regressions = compare (current, baseline, threshold)
+        if regressions:
+            sys.stderr.write ("%d kernel(s) slower than the baseline by more than %d%%\n"
+                              % (len (regressions), round ((threshold - 1.0) * 100)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+pathological.py
+
+Worst-case inputs for the HTML parser, with bounds on time and memory.
+
+Some real pages make StructuredHTMLParser (and the sgmllib underneath
+it) crawl: megabyte-long lines, thousands of unclosed tags, deeply
+nested tables, giant attribute values, floods of entities.  Every case
+in CASES generates such a page for a size n; the page is parsed at
+sizes n, 2n and 4n, and the script checks
+
+  - that doubling the input no more than --growth times the parse
+    time (2.0 would be perfectly linear; quadratic behaviour, say in
+    goahead() rescanning its buffer, gives 4.0),
+  - that the parse time stays below the case's seconds per MB of
+    input, and
+  - that the peak memory allocated while parsing (from tracemalloc)
+    stays below the case's multiple of the input size.
+
+    python3 benchmarks/pathological.py                 # all cases, exit code 1 on violations
+    python3 benchmarks/pathological.py -k table        # only matching cases
+    python3 benchmarks/pathological.py --scale=4       # bigger inputs
+    python3 benchmarks/pathological.py --write=<dir>   # just write the inputs as files
+    python3 benchmarks/pathological.py --list
+
+The bounds are loose on purpose, so that a slow machine does not fail
+them; they are meant to catch a change of complexity, not a few
+percent.
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, os, gc, json, time, getopt, tempfile, shutil, tracemalloc
+
+TOP_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, TOP_DIR)
+
+
+##
+## Input generators.  Each takes a size n and returns the page as bytes.
+##
+
+_TEXT = b"The quick brown fox jumps over the lazy dog. "
+
+def long_line (n):
+    """One paragraph of n KB of text without a single newline"""
+    return b"<html><body><p>" + _TEXT * (n * 1024 // len (_TEXT)) + b"</p></body></html>"
+
+def unclosed_tags (n):
+    """n inline and block tags which are never closed"""
+    tags = (b"<b>", b"<i>", b"<font color=red>", b"<p>", b"<u>", b"<div>", b"<li>", b"<a name=x>")
+    out = [b"<html><body>"]
+    for i in range (n):
+        out.append (tags[i % len (tags)])
+        out.append (b"text %d " % i)
+    out.append (b"</body></html>")
+    return b"".join (out)
+
+def nested_tables (n):
+    """Tables nested n deep, each cell holding the next table"""
+    return (b"<html><body>" + b"<table border=1><tr><td>cell " * n + b"innermost"
+            + b"</td></tr></table>" * n + b"</body></html>")
+
+def wide_tables (n):
+    """n small tables of 8 x 8 cells in a row"""
+    row = b"<tr>" + b"<td>a b c</td>" * 8 + b"</tr>"
+    return b"<html><body>" + (b"<table border=1>" + row * 8 + b"</table>") * n + b"</body></html>"
+
+def giant_attributes (n):
+    """Links, images and fonts with attribute values of n KB"""
+    value = b"x" * (n * 1024)
+    return (b'<html><body><p><a href="http://localhost/' + value + b'">link</a>'
+            + b'<img src="i.png" alt="' + value + b'">'
+            + b'<font face="' + value + b'" color=' + value + b'>text</font>'
+            + b'<p title=\'' + value + b'\'>unquoted <div class=' + value + b'>end</div>'
+            + b'</body></html>')
+
+def entity_flood (n):
+    """n KB of named, numeric and bogus entity references"""
+    entities = b"&amp;&lt;&gt;&nbsp;&eacute;&#160;&#x263a;&#8364;&bogus;&amp &#;&"
+    return b"<html><body><p>" + entities * (n * 1024 // len (entities)) + b"</p></body></html>"
+
+def many_attributes (n):
+    """One tag with n attributes"""
+    attributes = b" ".join ([b'a%d="v%d"' % (i, i) for i in range (n)])
+    return b"<html><body><p " + attributes + b">text</p></body></html>"
+
+def unterminated (n):
+    """A comment, a declaration and a tag that are never closed, each
+    followed by n KB of text"""
+    text = _TEXT * (n * 1024 // len (_TEXT) // 3)
+    return (b"<html><body><p>" + text + b"<!-- " + text + b"<!DOCTYPE " + text
+            + b"<a href='" + text)
+
+
+# name -> (generator, base size, extra config, max seconds per MB, max peak memory per input byte)
+CASES = {
+    'long_line':        (long_line, 256, {}, 10.0, 60),
+    'unclosed_tags':    (unclosed_tags, 1000, {}, 40.0, 400),
+    'nested_tables':    (nested_tables, 50, {}, 200.0, 2000),
+    'nested_tables_on': (nested_tables, 20, {'tables': 1}, 2000.0, 20000),
+    'wide_tables':      (wide_tables, 20, {}, 40.0, 200),
+    'wide_tables_on':   (wide_tables, 20, {'tables': 1}, 200.0, 1000),
+    'giant_attributes': (giant_attributes, 64, {}, 10.0, 60),
+    'entity_flood':     (entity_flood, 64, {}, 40.0, 200),
+    'many_attributes':  (many_attributes, 2000, {}, 40.0, 200),
+    'unterminated':     (unterminated, 64, {}, 40.0, 200),
+}
+
+
+##
+## Measuring
+##
+
+class Parser:
+
+    """Parses pages as the spider would, with a private configuration"""
+
+    def __init__ (self):
+        from PyPlucker import ConfigFiles, UtilFns, PluckerDocs
+        UtilFns.CurrentVerbosityLevel = 0
+        self._workdir = tempfile.mkdtemp (prefix='plucker-patho-')
+        # keep the user's own config files out of it
+        os.environ['HOME'] = self._workdir
+        self._config = ConfigFiles.Configuration (self._workdir, self._workdir)
+        self._config.set ('verbosity', 0)
+        # normally set up by Spider.main
+        PluckerDocs.PluckerTextDocument.seamless_fragments = self._config.get_bool ('seamless_fragments', 1)
+        PluckerDocs.PluckerTextDocument.link_fragments = self._config.get_bool ('link_fragments', 0)
+
+    def cleanup (self):
+        shutil.rmtree (self._workdir, ignore_errors=True)
+
+    def parse (self, html, options):
+        from PyPlucker.TextParser import StructuredHTMLParser
+        for (key, value) in options.items ():
+            self._config.set (key, value)
+        try:
+            url = "http://localhost/pathological.html"
+            doc = StructuredHTMLParser (url, html, {'Content-Type': 'text/html', 'URL': url},
+                                        self._config, {}).get_plucker_doc ()
+            # laying out the tables happens when they are dumped
+            for table in doc.get_tables ():
+                table.dump_record (1)
+        finally:
+            for key in options.keys ():
+                self._config.set (key, None)
+
+
+def time_parse (parser, html, options, repeat):
+    """Best time of 'repeat' parses"""
+    best = None
+    for i in range (repeat):
+        gc.collect ()
+        start = time.perf_counter ()
+        parser.parse (html, options)
+        elapsed = time.perf_counter () - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory (parser, html, options):
+    """Peak number of bytes allocated while parsing"""
+    gc.collect ()
+    tracemalloc.start ()
+    try:
+        parser.parse (html, options)
+        (current, peak) = tracemalloc.get_traced_memory ()
+    finally:
+        tracemalloc.stop ()
+    return peak
+
+
+def run_case (parser, name, scale=1, growth=3.0, repeat=3):
+    """Run case 'name' at three sizes.  Returns (result dictionary,
+    list of violated bounds)"""
+    (generator, base, options, max_seconds_per_mb, max_memory_factor) = CASES[name]
+    sizes = []
+    problems = []
+    for n in (base * scale, base * scale * 2, base * scale * 4):
+        html = generator (n)
+        seconds = time_parse (parser, html, options, repeat)
+        peak = peak_memory (parser, html, options)
+        sizes.append ({'n': n, 'bytes': len (html), 'seconds': round (seconds, 6), 'peak_bytes': peak})
+        megabytes = len (html) / (1024.0 * 1024.0)
+        if seconds > max_seconds_per_mb * max (megabytes, 0.01):
+            problems.append ("%s: n=%d took %.3f s for %d bytes (bound %.1f s/MB)"
+                             % (name, n, seconds, len (html), max_seconds_per_mb))
+        if peak > max_memory_factor * len (html) + 1024 * 1024:
+            problems.append ("%s: n=%d used %.1f MB for %d bytes (bound %d x input)"
+                             % (name, n, peak / (1024.0 * 1024.0), len (html), max_memory_factor))
+    ratios = []
+    for i in range (1, len (sizes)):
+        ratio = sizes[i]['seconds'] / max (sizes[i - 1]['seconds'], 1e-6)
+        ratios.append (round (ratio, 2))
+    # one noisy step is tolerated, two are not
+    if min (ratios) > growth:
+        problems.append ("%s: time grows super-linearly, ratios %s for doubled input (bound %.1f)"
+                         % (name, " ".join (map (str, ratios)), growth))
+    return ({'case': name, 'sizes': sizes, 'growth': ratios}, problems)
+
+
+def print_result (result):
+    for entry in result['sizes']:
+        print ("%-18s n=%-7d %9d bytes %9.4f s %9.2f MB peak" % (result['case'], entry['n'], entry['bytes'],
+                                                                 entry['seconds'],
+                                                                 entry['peak_bytes'] / (1024.0 * 1024.0)))
+    print ("%-18s growth per doubling: %s" % (result['case'], " ".join (map (str, result['growth']))))
+
+
+def write_inputs (directory, names, scale):
+    if not os.path.isdir (directory):
+        os.makedirs (directory)
+    for name in names:
+        (generator, base) = CASES[name][:2]
+        filename = os.path.join (directory, "%s-%d.html" % (name, base * scale))
+        f = open (filename, 'wb')
+        f.write (generator (base * scale))
+        f.close ()
+        print (filename)
+
+
+def usage ():
+    sys.stderr.write ("Usage: %s [-k <pattern>]... [--scale=<n>] [--growth=<ratio>] [--repeat=<n>]\n"
+                      "       [--json=<file>] [--write=<dir>] [--list]\n" % sys.argv[0])
+    sys.exit (1)
+
+
+def main (argv):
+    try:
+        (opts, args) = getopt.getopt (argv[1:], "k:h", ["scale=", "growth=", "repeat=", "json=",
+                                                         "write=", "list", "help"])
+    except getopt.error as text:
+        sys.stderr.write ("%s\n" % text)
+        usage ()
+    patterns = []
+    scale = 1
+    growth = 3.0
+    repeat = 3
+    json_file = None
+    write_dir = None
+    for (opt, arg) in opts:
+        if opt == "-k":
+            patterns.append (arg)
+        elif opt == "--scale":
+            scale = max (int (arg), 1)
+        elif opt == "--growth":
+            growth = float (arg)
+        elif opt == "--repeat":
+            repeat = max (int (arg), 1)
+        elif opt == "--json":
+            json_file = arg
+        elif opt == "--write":
+            write_dir = arg
+        elif opt == "--list":
+            for name in sorted (CASES.keys ()):
+                print ("%-18s %s" % (name, CASES[name][0].__doc__))
+            return 0
+        else:
+            usage ()
+    names = [name for name in sorted (CASES.keys ())
+             if not patterns or [p for p in patterns if p.lower () in name.lower ()]]
+
+    if write_dir:
+        write_inputs (write_dir, names, scale)
+        return 0
+
+    parser = Parser ()
+    results = []
+    problems = []
+    try:
+        for name in names:
+            (result, case_problems) = run_case (parser, name, scale, growth, repeat)
+            print_result (result)
+            results.append (result)
+            problems.extend (case_problems)
+    finally:
+        parser.cleanup ()
+    if json_file:
+        f = open (json_file, 'w')
+        json.dump ({'timestamp': int (time.time ()), 'python': sys.version.split ()[0],
+                    'results': results, 'problems': problems}, f, indent=1, sort_keys=True)
+        f.close ()
+    for problem in problems:
+        print ("FAIL " + problem)
+    return (problems and 1) or 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+synthsite.py
+
+A generated web site served from a local HTTP server, for benchmarking
+PyPlucker builds offline and reproducibly.
+
+The site is never written to disk: every page and image is generated
+on request from the site parameters and a random seed, so the same
+parameters always give the same site.  Pages are numbered; page N
+lives at /page/N.html and links to 'fanout' other pages, optionally
+to pages on a slow host and a failing host, and embeds images and
+tables.
+
+Run it stand-alone to have a look at the site in a browser:
+
+    python3 benchmarks/synthsite.py --pages=50 --port=8000
+
+Distributable under the GNU General Public License Version 2 or newer.
+"""
+
+import sys, io, time, random, threading, getopt
+import http.server, socketserver
+
+
+DEFAULT_PARAMETERS = {
+    'pages': 100,               # number of pages
+    'fanout': 5,                # links from each page to other pages
+    'paragraphs': 8,            # paragraphs of text per page
+    'images': 1,                # images per page
+    'image_sizes': [(160, 120)],
+    'image_formats': ['png'],   # any format Pillow can write: png, gif, jpeg, ...
+    'tables': 0,                # tables per page
+    'slow_links': 0,            # links per page to the slow host
+    'slow_delay': 0.2,          # seconds the slow host waits before answering
+    'failing_links': 0,         # links per page to the failing host
+    'seed': 1,
+}
+
+_WORDS = ("palm plucker viewer document record paragraph image table link "
+          "handheld sync conduit spider parser compress memory stylus screen "
+          "graffiti category bookmark anchor offline channel reader page").split ()
+
+
+class SyntheticSite:
+
+    """Generates the pages and images of a site described by a
+    dictionary of parameters (see DEFAULT_PARAMETERS)"""
+
+    def __init__ (self, parameters={}):
+        self.parameters = dict (DEFAULT_PARAMETERS)
+        self.parameters.update (parameters)
+        self.slow_base = None
+        self.failing_base = None
+        self._image_cache = {}
+        self._lock = threading.Lock ()
+
+    def _random (self, *key):
+        return random.Random ("%s/%s" % (self.parameters['seed'], "/".join (map (str, key))))
+
+    def _sentence (self, rnd, words):
+        return " ".join ([rnd.choice (_WORDS) for i in range (words)]).capitalize () + "."
+
+    def page (self, number):
+        """Return the HTML text of page 'number', or None if there is
+        no such page"""
+        p = self.parameters
+        if number < 0 or number >= p['pages']:
+            return None
+        rnd = self._random ('page', number)
+        out = ["<html><head><title>Page %d</title></head><body>" % number,
+               "<h1>Page %d</h1>" % number]
+        for i in range (p['paragraphs']):
+            out.append ("<p>%s</p>" % " ".join ([self._sentence (rnd, rnd.randint (5, 15))
+                                                 for j in range (rnd.randint (2, 6))]))
+            if i == 0:
+                for j in range (p['images']):
+                    (width, height) = rnd.choice (p['image_sizes'])
+                    format = rnd.choice (p['image_formats'])
+                    out.append ('<img src="/image/%d-%d.%s?w=%d&h=%d" alt="image %d">'
+                                % (number, j, format, width, height, j))
+        for i in range (p['tables']):
+            out.append ("<table border=1>")
+            for row in range (rnd.randint (2, 8)):
+                out.append ("<tr>" + "".join (["<td>%s</td>" % self._sentence (rnd, 2)
+                                               for col in range (4)]) + "</tr>")
+            out.append ("</table>")
+        out.append ("<ul>")
+        # the next page first, so every page can be reached
+        targets = [(number + 1) % p['pages']]
+        targets = targets + [rnd.randrange (p['pages']) for i in range (p['fanout'] - 1)]
+        for target in targets:
+            out.append ('<li><a href="/page/%d.html">%s</a></li>' % (target, self._sentence (rnd, 3)))
+        for (count, base) in ((p['slow_links'], self.slow_base), (p['failing_links'], self.failing_base)):
+            if base:
+                for i in range (count):
+                    out.append ('<li><a href="%s/page/%d.html">elsewhere</a></li>'
+                                % (base, rnd.randrange (p['pages'])))
+        out.append ("</ul></body></html>")
+        return "\n".join (out).encode ('ascii')
+
+    def image (self, name, width, height):
+        """Return (content type, data) for image 'name' (as in
+        '3-0.png'), or None"""
+        format = name.split ('.')[-1].lower ()
+        key = (name, width, height)
+        with self._lock:
+            if key in self._image_cache:
+                return self._image_cache[key]
+        from PIL import Image, ImageDraw
+        rnd = self._random ('image', name)
+        image = Image.new ('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw (image)
+        for i in range (20):
+            x0 = rnd.randrange (width)
+            y0 = rnd.randrange (height)
+            draw.rectangle ((x0, y0, min (x0 + rnd.randrange (width // 2 + 1), width - 1),
+                             min (y0 + rnd.randrange (height // 2 + 1), height - 1)),
+                            fill=(rnd.randrange (256), rnd.randrange (256), rnd.randrange (256)))
+        buffer = io.BytesIO ()
+        if format == 'jpg':
+            format = 'jpeg'
+        try:
+            image.save (buffer, format)
+        except (KeyError, ValueError):
+            return None
+        result = ("image/" + format, buffer.getvalue ())
+        with self._lock:
+            self._image_cache[key] = result
+        return result
+
+
+class _Handler (http.server.BaseHTTPRequestHandler):
+
+    # set on the per-server subclass
+    site = None
+    mode = 'normal'
+
+    def log_message (self, format, *args):
+        pass
+
+    def _send (self, code, content_type, data):
+        self.send_response (code)
+        self.send_header ('Content-Type', content_type)
+        self.send_header ('Content-Length', str (len (data)))
+        self.end_headers ()
+        if self.command != 'HEAD':
+            self.wfile.write (data)
+
+    def do_GET (self):
+        if self.mode == 'failing':
+            self._send (500, 'text/plain', b'failing host')
+            return
+        if self.mode == 'slow':
+            time.sleep (self.site.parameters['slow_delay'])
+        (path, query) = (self.path.split ('?', 1) + [''])[:2]
+        if path == '/robots.txt':
+            self._send (200, 'text/plain', b'User-agent: *\nDisallow:\n')
+            return
+        if path == '/' or path == '/index.html':
+            path = '/page/0.html'
+        parts = path.split ('/')
+        result = None
+        if len (parts) == 3 and parts[1] == 'page' and parts[2][-5:] == '.html':
+            try:
+                data = self.site.page (int (parts[2][:-5]))
+            except ValueError:
+                data = None
+            if data is not None:
+                result = ('text/html', data)
+        elif len (parts) == 3 and parts[1] == 'image':
+            args = dict ([(item.split ('=') + [''])[:2] for item in query.split ('&') if item])
+            try:
+                result = self.site.image (parts[2], int (args.get ('w', 64)), int (args.get ('h', 64)))
+            except ValueError:
+                result = None
+        if result is None:
+            self._send (404, 'text/plain', b'not found')
+        else:
+            self._send (200, result[0], result[1])
+
+    do_HEAD = do_GET
+
+
+class _Server (socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = 1
+    allow_reuse_address = 1
+
+
+class SiteServer:
+
+    """Serve a SyntheticSite on localhost.  Besides the main server, a
+    slow and a failing server are started if the site links to them.
+    Use start() and stop(), or use it as a context manager."""
+
+    def __init__ (self, site, port=0):
+        self.site = site
+        self._servers = []
+        self._port = port
+        self.base_url = None
+
+    def _serve (self, mode, port):
+        handler = type ('Handler', (_Handler,), {'site': self.site, 'mode': mode})
+        server = _Server (('127.0.0.1', port), handler)
+        thread = threading.Thread (target=server.serve_forever, daemon=True)
+        thread.start ()
+        self._servers.append (server)
+        return "http://127.0.0.1:%d" % server.server_address[1]
+
+    def start (self):
+        p = self.site.parameters
+        if p['slow_links']:
+            self.site.slow_base = self._serve ('slow', 0)
+        if p['failing_links']:
+            self.site.failing_base = self._serve ('failing', 0)
+        self.base_url = self._serve ('normal', self._port)
+        return self
+
+    def home_url (self):
+        return self.base_url + "/page/0.html"
+
+    def stop (self):
+        for server in self._servers:
+            server.shutdown ()
+            server.server_close ()
+        self._servers = []
+
+    def __enter__ (self):
+        return self.start ()
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.stop ()
+        return 0
+
+
+def main (argv):
+    (opts, args) = getopt.getopt (argv[1:], "", ["port=", "pages=", "fanout=", "images=",
+                                                 "tables=", "slow-links=", "failing-links=", "seed="])
+    port = 8000
+    parameters = {}
+    for (opt, arg) in opts:
+        if opt == "--port":
+            port = int (arg)
+        else:
+            parameters[opt[2:].replace ('-', '_')] = int (arg)
+    server = SiteServer (SyntheticSite (parameters), port).start ()
+    print ("Serving %s (Ctrl-C to stop)" % server.home_url ())
+    try:
+        while 1:
+            time.sleep (3600)
+    except KeyboardInterrupt:
+        server.stop ()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main (sys.argv))
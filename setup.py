@@ -21,7 +21,7 @@ setup(
     install_requires=[
           'Pillow',
     ],
-    scripts=["bin/plucker-build"],
+    scripts=["bin/plucker-build", "bin/plucker-inspect"],
     packages=find_packages('.'),
     description='Web and document parser, converter and scraper for Plucker, the Palm OS app',
     long_description=get_long_description(),